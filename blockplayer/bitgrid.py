@@ -0,0 +1,67 @@
+# Andrew Miller <amiller@cs.ucf.edu> 2011
+#
+# BlockPlayer - 3D model reconstruction using the Lattice-First algorithm
+# See:
+#    "Interactive 3D Model Acquisition and Tracking of Building Block Structures"
+#    Andrew Miller, Brandyn White, Emiko Charbonneau, Zach Kanzler, and Joseph J. LaViola Jr.
+#    IEEE VR 2012, IEEE TVGC 2012
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Boolean voxel grids (occ, vac) packed 64 voxels to a word, for
+# hashalign to compare a word at a time and for keeping copies of grids
+# in an eighth of the room. The voxels are packed in the order of the
+# flattened grid, z fastest.
+import numpy as np
+import speedup_cy
+
+
+class BitGrid(object):
+    """A packed boolean grid. Make one with pack()."""
+    def __init__(self, words, shape):
+        self.words = words
+        self.shape = tuple(shape)
+        self.nbytes = words.nbytes
+
+    def unpack(self):
+        """The grid as a bool array."""
+        n = int(np.prod(self.shape))
+        return speedup_cy.unpack_bits(self.words, n).view(bool).reshape(
+            self.shape)
+
+    def rot90(self, r):
+        """Turned r quarter turns about y, the way hashalign turns grids."""
+        words, shape = speedup_cy.rot90_bits(self.words, *(self.shape +
+                                                           (r,)))
+        return BitGrid(words, shape)
+
+    def roll(self, bx, bz):
+        """np.roll(np.roll(grid, bx, 0), bz, 2)"""
+        return BitGrid(speedup_cy.roll_bits(self.words, *(self.shape +
+                                                          (bx, bz))),
+                       self.shape)
+
+    def apply_correction(self, bx, by, bz, rot):
+        """hashalign.apply_correction, packed."""
+        return self.rot90(rot).roll(bx, bz)
+
+
+def pack(a):
+    """A BitGrid of the bool (or 0/1) 3-d array a."""
+    a = np.ascontiguousarray(a)
+    if a.dtype != bool:
+        a = a.astype(bool)
+    a = a.view(np.uint8)
+    return BitGrid(speedup_cy.pack_bits(a.reshape(-1)), a.shape)
+
+
+def grid_error(occA, vacA, occB, vacB, bx, bz, term=10000):
+    """speedup_cy.grid_error of BitGrids: how badly occB, vacB disagree
+    with occA, vacA when moved by bx, bz. It gives up once the error is
+    well over term, returning something above it."""
+    assert occA.shape == vacA.shape == occB.shape == vacB.shape
+    return speedup_cy.grid_error_bits(occA.words, vacA.words,
+                                      occB.words, vacB.words,
+                                      *(occA.shape + (bx, bz, term)))
@@ -0,0 +1,106 @@
+# Andrew Miller <amiller@cs.ucf.edu> 2011
+#
+# BlockPlayer - 3D model reconstruction using the Lattice-First algorithm
+# See:
+#    "Interactive 3D Model Acquisition and Tracking of Building Block Structures"
+#    Andrew Miller, Brandyn White, Emiko Charbonneau, Zach Kanzler, and Joseph J. LaViola Jr.
+#    IEEE VR 2012, IEEE TVGC 2012
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Sparse voxel storage for grid.Grid (see grid.storage). Bounds here are in
+# grid coordinates, like config.bounds: ((xmin,ymin,zmin),(xmax,ymax,zmax)),
+# voxel (0,0,0) being the one just off the table's origin.
+import numpy as np
+
+
+def crop(a, bounds, box, fill=0):
+    """The part of a (an array over bounds) within box, as a new array over
+    box. Anything in box that's outside bounds is fill."""
+    gridmin, gridmax = np.array(bounds[0]), np.array(bounds[1])
+    boxmin, boxmax = np.array(box[0]), np.array(box[1])
+    out = np.empty(tuple(boxmax-boxmin) + a.shape[3:], a.dtype)
+    out[...] = fill
+    lo, hi = np.maximum(gridmin, boxmin), np.minimum(gridmax, boxmax)
+    if np.all(hi > lo):
+        out[tuple(slice(l, h) for l, h in zip(lo-boxmin, hi-boxmin))] = \
+            a[tuple(slice(l, h) for l, h in zip(lo-gridmin, hi-gridmin))]
+    return out
+
+
+class Bricks(object):
+    """A voxel array with no fixed bounds, kept as size^3 bricks in a dict
+    keyed by brick index. Bricks with nothing in them (all zero) aren't
+    kept, so this takes room and time in proportion to the part of the
+    workspace that's in use.
+    Params:
+        channels: the shape of each voxel, e.g. (3,) for colors
+    """
+    def __init__(self, dtype=bool, channels=(), size=8):
+        self.dtype = np.dtype(dtype)
+        self.channels = tuple(channels)
+        self.size = size
+        self.bricks = {}
+
+    def __len__(self):
+        return len(self.bricks)
+
+    def _aligned(self, bounds):
+        # The brick indices covering bounds, and those bricks' bounds
+        s = self.size
+        kmin = np.array(bounds[0]) // s
+        kmax = -(-np.array(bounds[1]) // s)
+        return kmin, kmax, (tuple((kmin*s).tolist()),
+                            tuple((kmax*s).tolist()))
+
+    def box(self):
+        """The bounds of the bricks that are kept, or None if there are
+        none."""
+        if not self.bricks:
+            return None
+        keys = np.array(self.bricks.keys())
+        return (tuple((keys.min(0)*self.size).tolist()),
+                tuple(((keys.max(0)+1)*self.size).tolist()))
+
+    def read(self, bounds):
+        """The voxels within bounds, as an array."""
+        s = self.size
+        kmin, kmax, aligned = self._aligned(bounds)
+        n = kmax - kmin
+        blocks = np.zeros(tuple(n) + (s,s,s) + self.channels, self.dtype)
+        if self.bricks:
+            keys = np.array(self.bricks.keys()) - kmin
+            inside = np.flatnonzero(np.all((keys >= 0) & (keys < n), 1))
+            if len(inside):
+                values = self.bricks.values()
+                kx, ky, kz = keys[inside].T
+                blocks[kx,ky,kz] = [values[i] for i in inside]
+        # (kx,ky,kz,x,y,z) -> (kx,x,ky,y,kz,z)
+        a = blocks.transpose((0,3,1,4,2,5) +
+                             tuple(range(6, 6+len(self.channels))))
+        a = a.reshape(tuple(n*s) + self.channels)
+        return crop(a, aligned, bounds)
+
+    def write(self, bounds, a):
+        """Set the voxels within bounds to a (an array over bounds)."""
+        s = self.size
+        kmin, kmax, aligned = self._aligned(bounds)
+        n = kmax - kmin
+        if aligned == (tuple(bounds[0]), tuple(bounds[1])):
+            full = a
+        else:
+            # Keep what's in the partly covered bricks outside bounds
+            full = self.read(aligned)
+            gridmin = np.array(bounds[0]) - aligned[0]
+            gridmax = np.array(bounds[1]) - aligned[0]
+            full[tuple(slice(l, h) for l, h in zip(gridmin, gridmax))] = a
+        blocks = full.reshape((n[0],s,n[1],s,n[2],s) + self.channels)
+        blocks = blocks.transpose((0,2,4,1,3,5) +
+                                  tuple(range(6, 6+len(self.channels))))
+        used = blocks.reshape(tuple(n) + (-1,)).any(-1)
+        for k in np.transpose(np.nonzero(used)):
+            self.bricks[tuple((k + kmin).tolist())] = blocks[tuple(k)].copy()
+        for k in np.transpose(np.nonzero(~used)):
+            self.bricks.pop(tuple((k + kmin).tolist()), None)
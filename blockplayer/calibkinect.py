@@ -52,7 +52,18 @@ def projection():
     return np.ascontiguousarray(mat)
 
 
-full_vu = np.mgrid[:480,:640].astype('f')
+_vu = {}
+
+
+def image_vu(shape):
+    """The (v,u) pixel coordinates of an image of this shape. Cached, so
+    don't write to them."""
+    shape = tuple(shape)
+    if not shape in _vu:
+        _vu[shape] = np.mgrid[:shape[0],:shape[1]].astype('f')
+    return _vu[shape]
+
+full_vu = image_vu((480,640))
 
 
 def convertOpenNI2Real_weave(depth, u=None, v=None,
@@ -64,7 +75,7 @@ def convertOpenNI2Real_weave(depth, u=None, v=None,
     assert mat.flags['C_CONTIGUOUS']
     assert depth.dtype == np.uint16
 
-    if u is None or v is None: v,u = full_vu
+    if u is None or v is None: v,u = image_vu(depth.shape)
     assert depth.shape == u.shape == v.shape
 
     X,Y = u,v
@@ -93,7 +104,7 @@ def convertOpenNI2Real_weave(depth, u=None, v=None,
 def convertOpenNI2Real_numpy(depth, u=None, v=None,
                        mat=np.linalg.inv(projection())):
 
-    if u is None or v is None: v,u = full_vu
+    if u is None or v is None: v,u = image_vu(depth.shape)
 
     X,Y,Z = u,v, recip_depth_openni(depth)
     x,y,z = [np.empty(depth.shape, 'f') for i in range(3)]
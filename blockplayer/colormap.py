@@ -19,14 +19,15 @@ t_gamma = (v * 6 * 256).astype('i4')
 
 
 def color_map(depth):
-    assert depth.shape == (480,640)
+    assert depth.ndim == 2
     assert depth.dtype == np.uint16
     depth_mid = np.empty((depth.shape[0],depth.shape[1],3),'u1')
+    N = int(depth.size)
     code = """
 // This comes from the openkinect project,
 // https://github.com/OpenKinect/libfreenect/blob/master/examples/glview.c
 
-for (int i = 0; i < 640*480; i++) {
+for (int i = 0; i < N; i++) {
     int pval = t_gamma[depth[i]];
     int lb = pval & 0xff;
     switch (pval>>8) {
@@ -67,5 +68,5 @@ for (int i = 0; i < 640*480; i++) {
         break;
      }
 }     """
-    scipy.weave.inline(code, ['depth_mid', 't_gamma', 'depth'])
+    scipy.weave.inline(code, ['depth_mid', 't_gamma', 'depth', 'N'])
     return depth_mid
@@ -31,6 +31,49 @@ def save(dir_path):
                          ), f)
 
 
+def image_size(bg=None):
+    """The (width, height) of the depth images the calibration bg (by
+    default, the one loaded) was made for. That's the kinect's 640x480 if
+    it has no background images to go by."""
+    if bg is None:
+        bg = globals()['bg']
+    if not 'bgHi' in bg:
+        return (640,480)
+    return bg['bgHi'].shape[::-1]
+
+
+def pixel_scale(size):
+    """How many pixels of an image of size (width, height) cover what one
+    pixel of a 640x480 image does, for the same field of view. The pixel
+    counts the tracker goes by were settled on for the kinect's 640x480,
+    and get multiplied by this."""
+    return size[0]*size[1] / (640*480.)
+
+
+def voxel_pixels(size):
+    """How many pixels must land on a voxel before occvac or stencil carve
+    go by it, in images of size (width, height)."""
+    return max(1, int(round(30 * pixel_scale(size))))
+
+
+def scale_bg(bg, factor, averaged=False):
+    """The calibration bg for depth images subsampled by factor, i.e.
+    depth[::factor,::factor]. factor=2 turns a kinect calibration into one
+    for 320x240 frames. With averaged=True, it's for images of block
+    averages instead (see preprocess.decimate), whose pixels are centered
+    (factor-1)/2 further along."""
+    bg = dict(bg)
+    S = np.diag([factor,factor,1,1]).astype('f')
+    if averaged:
+        S[:2,3] = (factor-1)/2.
+    bg['KK'] = np.ascontiguousarray(np.dot(bg['KK'], S), 'f')
+    for k in ('bgHi', 'bgLo'):
+        bg[k] = np.ascontiguousarray(bg[k][::factor,::factor])
+    if 'boundpts' in bg:
+        bg['boundpts'] = np.asarray(bg['boundpts'], 'f') / factor
+    return bg
+
+
 # Duplo block sizes
 LH = 0.0192
 LW = 0.016
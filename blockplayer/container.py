@@ -0,0 +1,282 @@
+# Andrew Miller <amiller@cs.ucf.edu> 2011
+#
+# BlockPlayer - 3D model reconstruction using the Lattice-First algorithm
+# See:
+#    "Interactive 3D Model Acquisition and Tracking of Building Block Structures"
+#    Andrew Miller, Brandyn White, Emiko Charbonneau, Zach Kanzler, and Joseph J. LaViola Jr.
+#    IEEE VR 2012, IEEE TVGC 2012
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# A single file holding all the depth and rgb frames of a dataset, in place
+# of the depth_%05d.npy.gz and rgb_%05d.png files. It lives next to the
+# config directory, as <dataset>/frames.bpf, and dataset.load_dataset uses
+# it when it's there.
+#
+# Layout:
+#   magic, then a json header (shapes, dtypes, chunk size, compression)
+#   chunks: chunk_frames consecutive frames of depth, then of rgb. Each is
+#           either the raw arrays, page aligned so they can be memory mapped,
+#           or the same bytes compressed with zlib
+#   index: the chunk table and the frame table (frame number, timestamp),
+#          as npy arrays
+#   footer: the offset of the index, then the magic again
+import numpy as np
+import mmap
+import json
+import zlib
+import struct
+import threading
+import os
+import glob
+import re
+
+MAGIC = 'BPFRAMES'
+VERSION = 1
+FILENAME = 'frames.bpf'
+ALIGN = 4096
+
+chunk_dtype = np.dtype([('depth_offset', '<u8'), ('depth_size', '<u8'),
+                        ('rgb_offset', '<u8'), ('rgb_size', '<u8'),
+                        ('frames', '<u4')])
+frame_dtype = np.dtype([('frame_num', '<i4'), ('timestamp', '<f8')])
+
+
+def container_path(dataset_path):
+    return os.path.join(dataset_path, FILENAME)
+
+
+def _write_npy(f, a):
+    np.lib.format.write_array(f, a)
+
+
+def _read_npy(f):
+    return np.lib.format.read_array(f)
+
+
+class Writer(object):
+    """Writes frames to a new container, chunk_frames at a time. Frames must
+    be added in increasing order of frame number.
+
+    Params:
+        compress: zlib level for the chunks, or 0 to store them raw (which
+                  lets the reader memory map them)
+    """
+    def __init__(self, path, depth_shape=(480,640), rgb_shape=(480,640,3),
+                 chunk_frames=32, compress=0):
+        self.path = path
+        self.depth_shape = tuple(depth_shape)
+        self.rgb_shape = tuple(rgb_shape)
+        self.chunk_frames = chunk_frames
+        self.compress = compress
+        self._depth = np.empty((chunk_frames,)+self.depth_shape, 'u2')
+        self._rgb = np.empty((chunk_frames,)+self.rgb_shape, 'u1')
+        self._count = 0
+        self._chunks = []
+        self._frames = []
+
+        self._f = open(path + '.tmp', 'wb')
+        header = json.dumps(dict(version=VERSION,
+                                 depth_shape=self.depth_shape,
+                                 rgb_shape=self.rgb_shape,
+                                 chunk_frames=chunk_frames,
+                                 compress=compress))
+        self._f.write(MAGIC)
+        self._f.write(struct.pack('<I', len(header)))
+        self._f.write(header)
+
+    def add(self, frame_num, depth, rgb, timestamp=np.nan):
+        assert depth.shape == self.depth_shape
+        assert rgb.shape == self.rgb_shape
+        if self._frames:
+            assert frame_num > self._frames[-1][0]
+        self._depth[self._count] = depth
+        self._rgb[self._count] = rgb
+        self._frames.append((frame_num, timestamp))
+        self._count += 1
+        if self._count == self.chunk_frames:
+            self._flush()
+
+    def _blob(self, a):
+        f = self._f
+        data = a.tostring()
+        if self.compress:
+            data = zlib.compress(data, self.compress)
+        else:
+            # Page align the raw chunks, so they map cleanly
+            pad = -f.tell() % ALIGN
+            f.write('\0' * pad)
+        offset = f.tell()
+        f.write(data)
+        return offset, len(data)
+
+    def _flush(self):
+        if self._count == 0:
+            return
+        n = self._count
+        depth_offset, depth_size = self._blob(self._depth[:n])
+        rgb_offset, rgb_size = self._blob(self._rgb[:n])
+        self._chunks.append((depth_offset, depth_size,
+                             rgb_offset, rgb_size, n))
+        self._count = 0
+
+    def close(self):
+        self._flush()
+        f = self._f
+        index = f.tell()
+        _write_npy(f, np.array(self._chunks, chunk_dtype))
+        _write_npy(f, np.array(self._frames, frame_dtype))
+        f.write(struct.pack('<Q', index))
+        f.write(MAGIC)
+        f.close()
+        # Only show up under the real name once complete
+        os.rename(self.path + '.tmp', self.path)
+
+    def __enter__(self):
+        return self
+
+    def abort(self):
+        """Give up on the container, leaving nothing behind."""
+        self._f.close()
+        os.remove(self.path + '.tmp')
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class Reader(object):
+    """Random access to the frames in a container. The file is memory
+    mapped; frames in raw chunks come back as read-only views of the map,
+    without a copy. Compressed chunks are decompressed whole, and the most
+    recent one is kept around for the frames that follow."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        m = self._map
+        if m[:8] != MAGIC or m[-8:] != MAGIC:
+            raise IOError('Not a frame container: %s' % path)
+        n, = struct.unpack('<I', m[8:12])
+        header = json.loads(m[12:12+n])
+        if header['version'] > VERSION:
+            raise IOError('Container version %d is too new' %
+                          header['version'])
+        self.depth_shape = tuple(header['depth_shape'])
+        self.rgb_shape = tuple(header['rgb_shape'])
+        self.chunk_frames = header['chunk_frames']
+        self.compressed = bool(header['compress'])
+
+        index, = struct.unpack('<Q', m[-16:-8])
+        f = _MapFile(m, index)
+        self.chunks = _read_npy(f)
+        self.frames = _read_npy(f)
+
+        # frame number -> position in the frame table, for O(1) seeks
+        self._lookup = np.empty(self.frames['frame_num'].max()+1
+                                if len(self.frames) else 0, 'i')
+        self._lookup[:] = -1
+        self._lookup[self.frames['frame_num']] = np.arange(len(self.frames))
+
+        self._lock = threading.Lock()
+        self._cached = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, frame_num):
+        return 0 <= frame_num < len(self._lookup) and \
+            self._lookup[frame_num] >= 0
+
+    def frame_nums(self):
+        return self.frames['frame_num'].copy()
+
+    def timestamp(self, frame_num):
+        return self.frames['timestamp'][self._position(frame_num)]
+
+    def _position(self, frame_num):
+        if not frame_num in self:
+            raise KeyError(frame_num)
+        return self._lookup[frame_num]
+
+    def _chunk(self, c):
+        chunk = self.chunks[c]
+        n = int(chunk['frames'])
+        shapes = ((n,)+self.depth_shape, (n,)+self.rgb_shape)
+        blobs = ((chunk['depth_offset'], chunk['depth_size'], 'u2'),
+                 (chunk['rgb_offset'], chunk['rgb_size'], 'u1'))
+        if not self.compressed:
+            return [np.frombuffer(self._map, dtype, int(np.prod(shape)),
+                                  int(offset)).reshape(shape)
+                    for (offset, size, dtype), shape in zip(blobs, shapes)]
+
+        with self._lock:
+            if not self._cached is None and self._cached[0] == c:
+                return self._cached[1]
+        arrays = []
+        for (offset, size, dtype), shape in zip(blobs, shapes):
+            data = zlib.decompress(self._map[offset:offset+size])
+            arrays.append(np.frombuffer(data, dtype).reshape(shape))
+        with self._lock:
+            self._cached = (c, arrays)
+        return arrays
+
+    def read(self, frame_num):
+        """Returns (depth, rgb) for frame_num. These are read-only."""
+        i = self._position(frame_num)
+        depth, rgb = self._chunk(i // self.chunk_frames)
+        return depth[i % self.chunk_frames], rgb[i % self.chunk_frames]
+
+    def close(self):
+        # Arrays from read() may still be looking at the map, and hold a
+        # reference to it. It's unmapped when the last of them goes.
+        self._map = None
+        self._cached = None
+
+
+class _MapFile(object):
+    # Just enough of a file over an mmap for np.lib.format.read_array
+    def __init__(self, m, pos):
+        self.m = m
+        self.pos = pos
+
+    def read(self, n):
+        data = self.m[self.pos:self.pos+n]
+        self.pos += len(data)
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+
+def convert(dataset_path, chunk_frames=32, compress=0):
+    """Pack the depth_%05d.npy.gz/rgb_%05d.png frames of a dataset, and
+    their timestamps if it has them, into <dataset_path>/frames.bpf. The
+    original files are left alone."""
+    import dataset
+    names = glob.glob(os.path.join(dataset_path, 'depth_*.npy.gz'))
+    nums = sorted(int(re.match('.*depth_(\d+)\.npy\.gz$', n).group(1))
+                  for n in names)
+    if not nums:
+        raise IOError('No frames in %s' % dataset_path)
+
+    timestamps = dataset.load_timestamps(dataset_path)
+    depth, rgb = dataset.load_frame(dataset_path, nums[0])
+    with Writer(container_path(dataset_path), depth.shape, rgb.shape,
+                chunk_frames, compress) as w:
+        for n in nums:
+            depth, rgb = dataset.load_frame(dataset_path, n, (depth, rgb))
+            w.add(n, depth, rgb, timestamps.get(n, np.nan))
+    return len(nums)
+
+
+if __name__ == "__main__":
+    import sys
+    for path in sys.argv[1:]:
+        print "%s: %d frames" % (path, convert(path))
@@ -20,37 +20,299 @@ import opencl
 import os
 import grid
 import cv
+import threading
+import atexit
+import time
+import container
 
 depth = None
 
 current_path = None
 frame_num = None
+# When the current frame was captured, in seconds, if the dataset has
+# timestamps (see record.Recorder), otherwise None
+timestamp = None
+timestamps = {}
+
+# The container.Reader for current_path, if it has a frames.bpf, otherwise
+# None and the frames are read from the depth_*/rgb_* files
+current_container = None
+
+# How many frames to decode ahead of the one being tracked, on background
+# threads. 0 reads each frame in advance() instead.
+prefetch = int(os.environ.get('BLOCKPLAYER_PREFETCH', 8))
+prefetch_threads = 2
+
+if not 'reader' in globals():
+    reader = None
+
+
+class EndOfDataset(IOError):
+    """Raised by advance() when there are no more frames. It's an IOError,
+    which is what running off the end looked like before."""
+
+
+def depth_path(path, frame_num):
+    return '%s/depth_%05d.npy.gz' % (path, frame_num)
+
+
+def rgb_path(path, frame_num):
+    return '%s/rgb_%05d.png' % (path, frame_num)
+
+
+def timestamps_path(path):
+    return os.path.join(path, 'timestamps.txt')
+
+
+def load_timestamps(path):
+    """The capture time of each frame of the dataset at path, as a dict from
+    frame number to seconds. Empty if it was recorded without them."""
+    try:
+        with open(timestamps_path(path)) as f:
+            lines = f.read().split()
+    except IOError:
+        return {}
+    return dict((int(n), float(t)) for n,t in zip(lines[::2], lines[1::2]))
+
+
+def _load_npy(f, out=None):
+    # np.load, but reading into out if it has the right shape and type
+    version = np.lib.format.read_magic(f)
+    if version == (1,0):
+        shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+    if out is None or out.shape != shape or out.dtype != dtype:
+        out = np.empty(shape, dtype)
+    data = f.read(out.nbytes)
+    if len(data) != out.nbytes:
+        raise ValueError('Truncated array data')
+    out[:] = np.frombuffer(data, dtype).reshape(shape,
+                                                order='F' if fortran else 'C')
+    return out
+
+
+def load_frame(path, frame_num, out=(None,None)):
+    """Read and decode one frame of the dataset at path, from its
+    depth_*/rgb_* files. Raises EndOfDataset if there's no such frame.
+    Params:
+        out: (depth, rgb) arrays to decode into, if they fit
+    Returns:
+        depth, rgb
+    """
+    out_depth, out_rgb = out
+    if not os.path.exists(depth_path(path, frame_num)):
+        raise EndOfDataset('No frame %d in %s' % (frame_num, path))
+    with gzip.open(depth_path(path, frame_num), 'rb') as f:
+        depth = _load_npy(f, out_depth)
+    rgb = cv.LoadImage(rgb_path(path, frame_num))
+    cv.CvtColor(rgb, rgb, cv.CV_RGB2BGR)
+    shape = (rgb.height, rgb.width, 3)
+    if out_rgb is None or out_rgb.shape != shape:
+        out_rgb = np.empty(shape, 'u1')
+    out_rgb[:] = np.fromstring(rgb.tostring(),'u1').reshape(shape)
+    return depth, out_rgb
+
+
+def container_frame(frames, frame_num):
+    """Like load_frame, from a container.Reader. For raw containers the
+    arrays are read-only views of the file."""
+    try:
+        return frames.read(frame_num)
+    except KeyError:
+        raise EndOfDataset('No frame %d in %s' % (frame_num, frames.path))
+
+
+class FrameReader(object):
+    """Reads the frames of a dataset in order, decoding up to `ahead` of them
+    in advance on `threads` background threads. The frames come from the
+    container if one is given, otherwise from the files in path.
+
+    The arrays read() returns are reused for later frames: they stay valid
+    until the next call to read(). Copy them to keep them longer.
+    """
+    def __init__(self, path, frame_num=0, skip=1, ahead=8, threads=2,
+                 frames=None):
+        self.path = path
+        self.frames = frames
+        self.frame_num = frame_num
+        self.skip = skip
+        self._cond = threading.Condition()
+        self._next = frame_num + skip
+        self._ready = {}
+        self._free = [(None,None) for _ in range(ahead)]
+        self._held = None
+        self._end = None
+        self._closed = False
+        self._threads = [threading.Thread(target=self._work)
+                         for _ in range(threads)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def _work(self):
+        cond = self._cond
+        while True:
+            with cond:
+                while not self._closed and (not self._free or
+                                            (not self._end is None and
+                                             self._next > self._end)):
+                    cond.wait()
+                if self._closed:
+                    return
+                n = self._next
+                self._next += self.skip
+                out = self._free.pop()
+
+            try:
+                if self.frames is None:
+                    result = load_frame(self.path, n, out)
+                else:
+                    result = container_frame(self.frames, n)
+            except Exception as e:
+                result = e
+
+            with cond:
+                if isinstance(result, Exception):
+                    self._free.append(out)
+                    if self._end is None or n < self._end:
+                        self._end = n
+                self._ready[n] = result
+                cond.notify_all()
+
+    def read(self):
+        """Returns (frame_num, depth, rgb) for the next frame, or raises
+        EndOfDataset if there isn't one."""
+        n = self.frame_num + self.skip
+        with self._cond:
+            if not self._held is None:
+                self._free.append(self._held)
+                self._held = None
+                self._cond.notify_all()
+            while not n in self._ready:
+                if self._closed:
+                    raise ValueError('FrameReader is closed')
+                if not self._end is None and n > self._end:
+                    raise EndOfDataset('No frame %d in %s' % (n, self.path))
+                self._cond.wait()
+            result = self._ready.pop(n)
+            if not isinstance(result, Exception):
+                self._held = result
+        self.frame_num = n
+
+        if isinstance(result, Exception):
+            raise result
+        depth, rgb = result
+        return n, depth, rgb
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+
+def close_reader():
+    global reader
+    if not reader is None:
+        reader.close()
+        reader = None
+atexit.register(close_reader)
 
 
 def advance(skip=1):
-    # Load the image
-    global frame_num, depth, rgb
-    frame_num += skip
-    with gzip.open('%s/depth_%05d.npy.gz' % (current_path, frame_num),
-                   'rb') as f:
-        depth = np.load(f)
+    """Load the next frame into depth, rgb and frame_num. When prefetch is on,
+    the arrays are reused for later frames, so copy them to keep them past
+    the next advance(). Raises EndOfDataset after the last frame."""
+    global frame_num, depth, rgb, reader, timestamp
+    frames = current_container
+    # Raw containers are mapped straight from the file, there's nothing to
+    # gain by reading them ahead
+    if not prefetch or (not frames is None and not frames.compressed):
+        n = frame_num + skip
+        try:
+            if frames is None:
+                depth, rgb = load_frame(current_path, n)
+            else:
+                depth, rgb = container_frame(frames, n)
+        finally:
+            frame_num = n
+        timestamp = _timestamp(frame_num)
+        return
+
+    # Start reading ahead from wherever we are now
+    if (reader is None or reader.path != current_path or
+        reader.frames is not frames or
+        reader.skip != skip or reader.frame_num != frame_num):
+        close_reader()
+        reader = FrameReader(current_path, frame_num, skip,
+                             prefetch, prefetch_threads, frames)
     try:
-        rgb = cv.LoadImage('%s/rgb_%05d.png' % (current_path, frame_num))
-        cv.CvtColor(rgb, rgb, cv.CV_RGB2BGR)
-        rgb = np.fromstring(rgb.tostring(),'u1').reshape(480,640,3)
-    except KeyboardInterrupt:
-        rgb = None
+        _, depth, rgb = reader.read()
+    finally:
+        frame_num = reader.frame_num
+    timestamp = _timestamp(frame_num)
+
+
+def _timestamp(n):
+    if not current_container is None:
+        t = current_container.timestamp(n)
+        return None if np.isnan(t) else float(t)
+    return timestamps.get(n)
+
+
+_pace_start = None
+
+
+def pace():
+    """Sleep until the current frame is due, so that frames replay at the
+    rate they were recorded. Call it after each advance(). It starts the
+    clock on the first call after load_dataset or seek, and does nothing for
+    datasets without timestamps."""
+    global _pace_start
+    if timestamp is None:
+        return
+    now = time.time()
+    if _pace_start is None:
+        _pace_start = now - timestamp
+    delay = _pace_start + timestamp - now
+    if delay > 0:
+        time.sleep(delay)
 
 
 def setup_opencl():
     opencl.setup_kernel((config.bg['KK'],config.bg['Ktable']))
 
 
+def seek(n):
+    """Make frame n the one the next advance() loads."""
+    global frame_num, _pace_start
+    frame_num = n - 1
+    _pace_start = None
+
+
+def close_container():
+    global current_container
+    if not current_container is None:
+        current_container.close()
+        current_container = None
+
+
 def load_dataset(pathname):
-    global current_path, frame_num
+    """Load the config for the dataset at pathname. Its frames are read from
+    pathname/frames.bpf if there is one (see container.convert), otherwise
+    from the depth_*/rgb_* files."""
+    global current_path, frame_num, current_container, timestamps, timestamp
+    global _pace_start
 
     # Check for consistency, count the number of images
+    close_reader()
+    close_container()
     current_path = pathname
+    if os.path.exists(container.container_path(pathname)):
+        current_container = container.Reader(
+            container.container_path(pathname))
 
     # Load the config
     config.load(current_path)
@@ -61,6 +323,9 @@ def load_dataset(pathname):
 
     setup_opencl()
 
+    timestamps = load_timestamps(pathname)
+    timestamp = None
+    _pace_start = None
     frame_num = 0
 
 
@@ -18,6 +18,9 @@ import config
 import os
 import dataset
 import stencil
+import spacecarve
+import bricks
+import bitgrid
 
 
 from ctypes import POINTER as PTR, c_byte, c_size_t, c_float
@@ -26,24 +29,326 @@ speedup_ctypes = np.ctypeslib.load_library('speedup_ctypes.so',
 speedup_ctypes.histogram.argtypes = [PTR(c_byte), PTR(c_float), PTR(c_float),
                                      c_size_t, c_size_t, c_size_t, c_size_t]
 
+# How a Grid keeps its voxels:
+#   'dense':  arrays over all of config.bounds, which every stage works on
+#   'sparse': bricks (see bricks.Bricks) of just the part of the workspace
+#             in use. Each frame works on arrays over a window around the
+#             structure (see Grid.frame_window), so the cost goes with the
+#             size of the structure, not of config.bounds.
+# Set BLOCKPLAYER_GRID to choose at import time.
+if not 'storage' in globals():
+    storage = os.environ.get('BLOCKPLAYER_GRID', 'dense')
+
+# The voxel arrays of a Grid, and the dtype and shape of each voxel
+layers = dict(occ=(bool, ()), vac=(bool, ()),
+              color=('u1', (3,)), color_count=('i', ()), stable=('i2', ()))
+
+
+class Grid(object):
+    """The voxel estimate of one structure, plus the pose and stencil
+    statistics from the previous frame. Each Tracker (see main) owns one.
+
+    The voxels are in occ, vac, color and color_count, arrays over bounds.
+    That's config.bounds, unless the grid is sparse (see storage).
+
+    stable counts the merges in a row that each voxel has been occupied (or
+    vacant) without anything saying otherwise. After freeze_after of them
+    the voxel is frozen: stencil_carve leaves it out of the blocks it draws
+    and counts, so a structure that isn't changing costs little to keep
+    up. A frozen voxel thaws (stable goes back to 0) as soon as the frame's
+    estimate disagrees with it, and every audit_every frames all of the
+    voxels are drawn, to thaw any the stencil statistics disagree with.
+    Frozen voxels no longer hide the ones behind them, so the grids differ
+    from those made without freezing. freeze_after=0, the default, never
+    freezes anything.
+
+    The module level functions (initialize, merge_with_previous, ...) operate
+    on grid.default, and mirror its attributes into the module globals
+    (grid.occ, grid.vac, ...) afterwards.
+    """
+    def __init__(self, sparse=None, freeze_after=0, audit_every=10):
+        if sparse is None:
+            assert storage in ('dense', 'sparse'), storage
+            sparse = storage == 'sparse'
+        self.sparse = sparse
+        self.freeze_after = freeze_after
+        self.audit_every = audit_every
+        self.occ_stencil = self.vac_stencil = None
+        self.b_occ = self.b_vac = self.b_total = None
+        self.stencil_stats = None
+        self.initialize()
+
+    def initialize(self):
+        self.good_alignment = False
+        self.previous_estimate = None
+        self._since_audit = 0
+        self._packed = None
+        if self.sparse:
+            self._bricks = dict((name, bricks.Bricks(dtype, channels))
+                                for name, (dtype, channels) in layers.items())
+            self.bounds = None
+            self.set_window(self.window())
+            return
+
+        b_width = [config.bounds[1][i]-config.bounds[0][i]
+                   for i in range(3)]
+
+        self.bounds = config.bounds
+        self.occ = np.zeros(b_width)>0
+        self.vac = np.zeros(b_width)>0
+        self.color = np.zeros((b_width[0], b_width[1], b_width[2], 3),'u1')
+        self.color_count = np.zeros(b_width,'i')
+        self.stable = np.zeros(b_width,'i2')
+
+    def initialize_with_groundtruth(self, GT):
+        self.initialize()
+        if self.sparse:
+            # Vacant only around the structure, not all over the workspace
+            self._bricks['occ'].write(config.bounds, GT)
+            self.bounds = None
+            self.set_window(self.window())
+            self.vac[:] = ~self.occ
+            self._store()
+            return
+        self.occ[:,:] = GT
+        self.vac[:,:] = ~GT
+        self.stable[:] = 0
+
+    def dense(self, name='occ'):
+        """One of the voxel arrays (occ, vac, color, color_count, stable)
+        over all of config.bounds."""
+        if not self.sparse:
+            return getattr(self, name)
+        return self._bricks[name].read(config.bounds)
+
+    def window(self, box=None):
+        """Bounds (for set_window) taking in the occupied part of a sparse
+        grid, box too if it's given, and a brick to spare. They're centered
+        on the table's origin in x and z, so they stay the same when
+        hashalign turns the grid about it."""
+        size = self._bricks['occ'].size
+        h = top = size
+        for b in (self._bricks['occ'].box(), box):
+            if not b is None:
+                (x0,_,z0),(x1,y1,z1) = b
+                h = max(h, -x0, x1, -z0, z1)
+                top = max(top, y1)
+        gridmin, gridmax = config.bounds
+        h = min(-(-h//size)*size + size,
+                -gridmin[0], gridmax[0], -gridmin[2], gridmax[2])
+        top = min(-(-top//size)*size + size, gridmax[1])
+        return (-h, gridmin[1], -h), (h, top, h)
+
+    def set_window(self, bounds):
+        """Make occ, vac, color, color_count and stable the voxels of a
+        sparse grid within bounds."""
+        if bounds == self.bounds:
+            return
+        self.bounds = bounds
+        self._packed = None
+        for name in layers:
+            setattr(self, name, self._bricks[name].read(bounds))
+        if not self.previous_estimate is None:
+            self.previous_estimate.update((name, getattr(self, name))
+                                          for name in layers)
+
+    def _store(self):
+        # Put the window of a sparse grid back into its bricks
+        for name in layers:
+            self._bricks[name].write(self.bounds, getattr(self, name))
+
+    def frame_window(self, R_aligned, occ, vac):
+        """Choose the part of the grid to work on for a frame, given its
+        occvac estimate (occ, vac, over config.bounds), and set_window to
+        it. The estimate is moved to the middle of the grid first, by whole
+        voxels, so that the window only needs to be as big as the
+        structure. Dense grids always work on all of config.bounds.
+        Returns:
+            R_aligned, occ, vac: moved the same way, and cropped to the
+                                 window
+        """
+        if not self.sparse:
+            return R_aligned, occ, vac
+        gridmin, gridmax = config.bounds
+        seen = occ | vac
+        x, = np.nonzero(seen.any(2).any(1))
+        y, = np.nonzero(seen.any(2).any(0))
+        z, = np.nonzero(seen.any(1).any(0))
+        if not len(x):
+            self.set_window(self.window())
+            return (R_aligned, bricks.crop(occ, config.bounds, self.bounds),
+                    bricks.crop(vac, config.bounds, self.bounds))
+
+        bx = -((x[0] + x[-1] + 1)//2 + gridmin[0])
+        bz = -((z[0] + z[-1] + 1)//2 + gridmin[2])
+        self.set_window(self.window(((x[0]+gridmin[0]+bx, 0,
+                                      z[0]+gridmin[2]+bz),
+                                     (x[-1]+1+gridmin[0]+bx,
+                                      y[-1]+1+gridmin[1],
+                                      z[-1]+1+gridmin[2]+bz))))
+        moved = ((gridmin[0]+bx, gridmin[1], gridmin[2]+bz),
+                 (gridmax[0]+bx, gridmax[1], gridmax[2]+bz))
+        R_aligned = R_aligned.copy()
+        R_aligned[0,3] += bx*config.LW
+        R_aligned[2,3] += bz*config.LW
+        return (R_aligned, bricks.crop(occ, moved, self.bounds),
+                bricks.crop(vac, moved, self.bounds))
+
+    def packed(self):
+        """occ and vac as BitGrids (see bitgrid), for
+        hashalign.find_best_alignment. They're kept until the grid changes,
+        so the frames that aren't merged don't pack them again. Only the
+        changes made by the Grid's own methods are noticed."""
+        if self._packed is None:
+            self._packed = bitgrid.pack(self.occ), bitgrid.pack(self.vac)
+        return self._packed
+
+    def has_previous_estimate(self):
+        return not self.previous_estimate is None
+
+    def frozen(self):
+        """The voxels that stencil_carve leaves alone (see stable), or None
+        if freezing is off."""
+        if not self.freeze_after:
+            return None
+        return self.stable >= self.freeze_after
+
+    def thaw(self, mask):
+        """Unfreeze the voxels in mask, starting their counts over."""
+        self.stable[mask] = 0
+        if self.sparse:
+            self._bricks['stable'].write(self.bounds, self.stable)
+
+    def stencil_carve(self, depth, rect, R_correct, occ, vac, rgb=None,
+                      bg=None):
+        if not self.previous_estimate is None:
+            occ_old = self.previous_estimate['occ']
+            cands = occ_old | occ
+        else:
+            cands = occ
+        # Only the voxels seen through rect can be counted
+        bounds = config.bounds if self.bounds is None else self.bounds
+        box = spacecarve.visible_box(R_correct, rect or
+                                     ((0,0), depth.shape[::-1]),
+                                     bounds, bg, cubes=True)
+
+        frozen = self.frozen()
+        audit = False
+        if not frozen is None:
+            self._since_audit += 1
+            audit = self._since_audit >= self.audit_every
+            if audit:
+                self._since_audit = 0
+            changed = frozen & (self.occ & vac | self.vac & occ)
+            if changed.any():
+                self.thaw(changed)
+                frozen &= ~changed
+            if not audit:
+                # Only the blocks being drawn get counts, so the box can
+                # shrink to them
+                cands = cands & ~frozen
+                drawn = occupied_box(cands, bounds)
+                if not drawn is None and not box is None:
+                    lo = np.maximum(box[0], drawn[0])
+                    hi = np.minimum(box[1], drawn[1])
+                    if np.all(hi > lo):
+                        box = tuple(lo.tolist()), tuple(hi.tolist())
+
+        stats = stencil.stencil_stats(depth, R_correct, cands, rgb, rect, bg,
+                                      bounds, box)
+        self.stencil_stats = stats
+        b_occ = self.b_occ = stats['b_occ']
+        b_vac = self.b_vac = stats['b_vac']
+        b_total = self.b_total = stats['b_total']
+
+        threshold = config.voxel_pixels(depth.shape[::-1])
+        self.occ_stencil = (b_occ/(b_total+1.)>0.9) & (b_total>threshold)
+        self.vac_stencil = (b_vac/(b_total+1.)>0.6) & (b_total>threshold)
+
+        if b_total.sum() > 0:
+            self.good_alignment = float(b_occ.sum())/b_total.sum()
+
+        if audit:
+            self.thaw(frozen & (self.occ & self.vac_stencil |
+                                self.vac & self.occ_stencil))
+
+        return self.occ_stencil, self.vac_stencil
+
+    def merge_with_previous(self, occ_, vac_, occ_stencil, vac_stencil,
+                            color_=None):
+        # Only allow 'uncarving' of elements attached to known blocks
+        import scipy.ndimage
+        self._packed = None
+        occ, vac = self.occ, self.vac
+        color, color_count = self.color, self.color_count
+        cmask = scipy.ndimage.binary_dilation(occ)
+        if self.freeze_after:
+            occ_before, vac_before = occ.copy(), vac.copy()
+            disagree = (occ & (vac_ | vac_stencil) |
+                        vac & (occ_ | occ_stencil))
+
+        vac |= vac_
+        vac[occ_stencil] = 0
+        if occ.sum() > 0:
+            occ_ &= cmask
+        occ_ &= occ_stencil
+
+        if not color_ is None:
+            colormask = occ_stencil&(self.b_occ>color_count)
+            color[colormask,:] = color_[colormask,:]
+            color_count[colormask] = self.b_occ[colormask]
+            #print np.sum(colormask)
+        occ |= occ_
+        occ[vac] = 0
+        color_count[~occ] = 0
+        if self.freeze_after:
+            same = ((occ == occ_before) & (vac == vac_before) & (occ | vac) &
+                    ~disagree)
+            stable = self.stable
+            stable[~same] = 0
+            stable[same & (stable < self.freeze_after)] += 1
+        if self.sparse:
+            self._store()
+
+    def update_previous_estimate(self, R_correct):
+        self.previous_estimate = dict(vac=self.vac,
+                                      occ=self.occ,
+                                      R_correct=R_correct,
+                                      color=self.color,
+                                      color_count=self.color_count)
+
+
+def publish(g):
+    """Mirror the state of Grid g into the module globals (grid.occ, ...)"""
+    globals().update(g.__dict__)
+    if g.sparse:
+        globals().update((name, g.dense(name)) for name in layers)
 
-def initialize():
-    b_width = [config.bounds[1][i]-config.bounds[0][i]
-               for i in range(3)]
 
-    global occ, vac, color, color_count, previous_estimate, good_alignment
-    occ = np.zeros(b_width)>0
-    vac = np.zeros(b_width)>0
-    color = np.zeros((b_width[0], b_width[1], b_width[2], 3),'u1')
-    color_count = np.zeros(b_width,'i')
-    good_alignment = False
-    previous_estimate = None
+def initialize():
+    default.initialize()
+    publish(default)
 
 
 if not 'previous_estimate' in globals():
-    previous_estimate=occ=vac=occ_stencil=vac_stencil=color=color_count=None
-    good_alignment=None
-    initialize()
+    default = Grid()
+    publish(default)
+
+
+def occupied_box(a, bounds=None):
+    """The smallest box (like bounds) holding every True voxel of a, an
+    array over bounds (by default config.bounds), or None if there are
+    none."""
+    if bounds is None:
+        bounds = config.bounds
+    x, = np.nonzero(a.any(2).any(1))
+    if not len(x):
+        return None
+    y, = np.nonzero(a.any(2).any(0))
+    z, = np.nonzero(a.any(1).any(0))
+    gridmin = bounds[0]
+    return ((x[0]+gridmin[0], y[0]+gridmin[1], z[0]+gridmin[2]),
+            (x[-1]+1+gridmin[0], y[-1]+1+gridmin[1], z[-1]+1+gridmin[2]))
 
 
 def gt2grid(gtstr, chars='*rR'):
@@ -64,10 +369,8 @@ def grid2gt(occ):
 
 
 def initialize_with_groundtruth(GT):
-    initialize()
-    global occ, vac
-    occ[:,:] = GT
-    vac[:,:] = ~GT
+    default.initialize_with_groundtruth(GT)
+    publish(default)
 
 
 def window_correction(occA, vacA, occB, vacB):
@@ -178,8 +481,7 @@ def show_votegrid(vg, color=(1,0,0), opacity=1):
 
 
 def has_previous_estimate():
-    global previous_estimate
-    return not previous_estimate is None
+    return default.has_previous_estimate()
 
 
 def apply_correction(grid, bx,bz,rot):
@@ -188,9 +490,11 @@ def apply_correction(grid, bx,bz,rot):
         bx, 0), bz, 2)
 
 
-def center(R_aligned, occ_new, vac_new):
-    bx,_,bz = [config.GRIDRAD-int(np.round(_.mean()))
-               for _ in occ_new.nonzero()]
+def center(R_aligned, occ_new, vac_new, bounds=None):
+    if bounds is None:
+        bounds = config.bounds
+    bx,_,bz = [-bounds[0][i]-int(np.round(_.mean()))
+               for i,_ in enumerate(occ_new.nonzero())]
     occ_new = apply_correction(occ_new, bx, bz, 0)
     vac_new = apply_correction(vac_new, bx, bz, 0)
     R_correct = R_aligned.copy()
@@ -248,52 +552,17 @@ def align_with_previous(R_aligned, occ_new, vac_new):
 
 
 def stencil_carve(depth, rect, R_correct, occ, vac, rgb=None):
-    global previous_estimate
-    if not previous_estimate is None:
-        occ_old = previous_estimate['occ']
-        cands = occ_old | occ
-    else:
-        cands = occ
-    global b_occ, b_vac, b_total
-    b_occ, b_vac, b_total = stencil.stencil_carve(depth, R_correct,
-                                                  cands, rgb, rect)
-
-    global occ_stencil, vac_stencil
-    occ_stencil = (b_occ/(b_total+1.)>0.9) & (b_total>30)
-    vac_stencil = (b_vac/(b_total+1.)>0.6) & (b_total>30)
-
-    global good_alignment
-    good_alignment = float(b_occ.sum())/b_total.sum()
-
-    return occ_stencil, vac_stencil
+    result = default.stencil_carve(depth, rect, R_correct, occ, vac, rgb)
+    publish(default)
+    stencil.publish(default.stencil_stats)
+    return result
 
 
 def merge_with_previous(occ_, vac_, occ_stencil, vac_stencil, color_=None):
-    # Only allow 'uncarving' of elements attached to known blocks
-    import scipy.ndimage
-    global occ, vac, color, color_count
-    cmask = scipy.ndimage.binary_dilation(occ)
-
-    vac |= vac_
-    vac[occ_stencil] = 0
-    if occ.sum() > 0:
-        occ_ &= cmask
-    occ_ &= occ_stencil
-
-    if not color_ is None:
-        colormask = occ_stencil&(stencil.b_occ>color_count)
-        color[colormask,:] = color_[colormask,:]
-        color_count[colormask] = stencil.b_occ[colormask]
-        #print np.sum(colormask)
-    occ |= occ_
-    occ[vac] = 0
-    color_count[~occ] = 0
+    default.merge_with_previous(occ_, vac_, occ_stencil, vac_stencil, color_)
+    publish(default)
 
 
 def update_previous_estimate(R_correct):
-    global previous_estimate
-    previous_estimate = dict(vac=vac,
-                             occ=occ,
-                             R_correct=R_correct,
-                             color=color,
-                             color_count=color_count)
+    default.update_previous_estimate(R_correct)
+    publish(default)
@@ -20,6 +20,18 @@ import dataset
 import stencil
 import config
 import speedup_cy
+import bitgrid
+
+# How find_best_alignment looks for the alignment:
+#   'features': score the translations that matching corner features vote
+#               for (the best 4 of each rotation). Fails on structures with
+#               no corners.
+#   'fft':      score every translation of every rotation (see
+#               alignment_errors), at a cost that depends only on the size
+#               of the grid
+# Set BLOCKPLAYER_ALIGN to choose at import time.
+if not 'search' in globals():
+    search = os.environ.get('BLOCKPLAYER_ALIGN', 'features')
 
 
 def features_weave(Ar):
@@ -94,6 +106,8 @@ def diff_coord(a, b, ashape):
 
 
 def apply_correction(grid, bx, by, bz,rot):
+    if isinstance(grid, bitgrid.BitGrid):
+        return grid.apply_correction(bx, by, bz, rot)
     return np.roll(np.roll(\
             np.swapaxes(np.rot90(np.swapaxes(grid,1,2),rot),1,2),
         bx, 0), bz, 2)
@@ -123,16 +137,133 @@ def correction2modelmat(R_aligned, x, y, z, r):
     return R_correct
 
 
+def nearest_correction(R_aligned, R_previous):
+    """The correction that puts R_aligned nearest to R_previous, rounding
+    to the nearest quarter turn and block (like grid.nearest).
+    Returns:
+       correction (x,0,z,r), and how far the corrected pose still is from
+       R_previous: the angle (radians) and the most in x or z (blocks)
+    """
+    R = [correction2modelmat(R_aligned, 0, 0, 0, r) for r in range(4)]
+    r = int(np.argmax([np.dot(R_[0,:3], R_previous[0,:3]) for R_ in R]))
+    c = (np.trace(np.dot(R[r][:3,:3], R_previous[:3,:3].T)) - 1) / 2
+    d = (R_previous[[0,2],3] - R[r][[0,2],3]) / config.LW
+    x, z = [int(v) for v in np.round(d)]
+    return ((x, 0, z, r), np.arccos(np.clip(c, -1, 1)),
+            np.max(np.abs(d - np.round(d))))
+
+
+def snap_to_previous(occA, vacA, occB, vacB, R_aligned, R_previous,
+                     max_angle=np.radians(10), max_shift=0.25,
+                     max_disagreement=0.1):
+    """A quick alternative to find_best_alignment for when the pose has
+    hardly changed since the last frame: take the nearest correction (see
+    nearest_correction), as long as the pose is within max_angle (radians)
+    and max_shift (blocks) of R_previous, and B corrected that way disagrees
+    with A (occupied against vacant, either way round) in at most
+    max_disagreement voxels for each that's occupied in both.
+    Returns:
+       correction (x,y,z,r), and occB and vacB corrected, or None if the
+       search is needed
+    """
+    c, angle, shift = nearest_correction(R_aligned, R_previous)
+    if angle > max_angle or shift > max_shift:
+        return None
+    occB = apply_correction(occB, *c)
+    vacB = apply_correction(vacB, *c)
+    agree = np.count_nonzero(occA & occB)
+    disagree = np.count_nonzero(occA & vacB) + np.count_nonzero(vacA & occB)
+    if not agree or disagree > max_disagreement * agree:
+        return None
+    return c, occB, vacB
+
+
+def rotation_scores(R_aligned=None, prev_R_Correct=None):
+    """A measure of how each candidate rotation lines up with the previous
+    estimate (1 is best), for weighting the alignment errors."""
+    dotscores = [1, 1, 1, 1]
+    if not R_aligned is None and not prev_R_Correct is None:
+        for r in range(4):
+            R = correction2modelmat(R_aligned, 0, 0, 0, r)
+            # The score is the angle between the forward vectors of the
+            # proposed matrix and the previous estimated matrix
+            dotscores[r] = 1 + 3*(1 - (np.dot(R[:3,0], prev_R_Correct[:3,0])))
+    return dotscores
+
+
+def alignment_errors(occA, vacA, occB, vacB):
+    """The error (as speedup_cy.grid_error gives it, without giving up) of
+    occB, vacB turned r quarter turns and moved by bx, bz against occA, vacA,
+    for every r, bx and bz. grid_error is a sum of products of the flattened
+    grids, shifted against each other by bz + bx*WY*WZ, so it's a cross
+    correlation, and these are all found at once with FFTs.
+
+    Returns:
+       errors: (4, 2*WX-1, 2*WZ-1) array, errors[r, bx+WX-1, bz+WZ-1]
+    """
+    WX, WY, WZ = occA.shape
+    assert WX == WZ and occB.shape == occA.shape
+    n = occA.size
+    # Long enough that the shifts don't wrap around onto each other. The FFT
+    # is quickest at powers of 2, and nearly as quick at 3 times one
+    L = 1 << int(np.ceil(np.log2(2*n - 1)))
+    if 3*L//4 >= 2*n - 1:
+        L = 3*L//4
+
+    def rfft(a):
+        return np.fft.rfft(np.reshape(a, a.shape[:-3] + (n,)), L)
+
+    def rot(a):
+        return np.array([np.swapaxes(np.rot90(np.swapaxes(a, 1, 2), r), 1, 2)
+                         for r in range(4)])
+
+    fA_o, fA_v = rfft(occA.astype('f')), rfft(vacA.astype('f'))
+    fB_o, fB_v = rfft(rot(occB).astype('f')), rfft(rot(vacB).astype('f'))
+
+    # corr[d] = sum_i a[i] b[i-d]
+    corr = np.fft.irfft(2*fA_o*np.conj(fB_v) + 2*fA_v*np.conj(fB_o) -
+                        fA_o*np.conj(fB_o), L)
+
+    bx = np.arange(-WX+1, WX).reshape(-1, 1)
+    bz = np.arange(-WZ+1, WZ).reshape(1, -1)
+    total = np.round(corr[:, (bz + bx*WY*WZ) % L])
+    return total/2. + 100
+
+
+def find_best_alignment_fft(occA, vacA, occB, vacB,
+                            R_aligned=None, prev_R_Correct=None):
+    """find_best_alignment, trying every translation (see
+    alignment_errors) rather than the ones the features vote for."""
+    if not np.any(occA) or not np.any(occB):
+        raise ValueError('Empty grid')
+    WX, _, WZ = occA.shape
+    errors = alignment_errors(occA, vacA, occB, vacB)
+    errors = errors.reshape(4, -1)
+    best = np.argmin(errors, 1)
+    besterror = errors[range(4), best]
+
+    dotscores = rotation_scores(R_aligned, prev_R_Correct)
+    r = int(np.argmin(besterror + 10*np.array(dotscores)))
+    bx, bz = np.unravel_index(best[r], (2*WX-1, 2*WZ-1))
+    return (int(bx)-WX+1, 0, int(bz)-WZ+1, r), float(besterror[r])
+
+
 def find_best_alignment(occA, vacA, occB, vacB,
-                        R_aligned=None, prev_R_Correct=None):
+                        R_aligned=None, prev_R_Correct=None, packedA=None):
     """
     R_aligned are used to weight the objective function with a previous,
     specifically to avoid 180 degree and 90 degree ambiguity with symmetric
     structures.
 
+    packedA: occA and vacA already packed (see bitgrid and Grid.packed),
+    to save packing them again.
+
     Returns:
        correction (x,y,z,r): use this with correc2modelmat or apply
     """
+    if search == 'fft':
+        return find_best_alignment_fft(occA, vacA, occB, vacB,
+                                       R_aligned, prev_R_Correct)
 
     def error(occA, vacA, occB, vacB):
         return np.sum(np.minimum(vacB,occA) + np.minimum(occB,vacA) -
@@ -185,53 +316,45 @@ def find_best_alignment(occA, vacA, occB, vacB,
     if not len(featureA) or not len(featureB):
         raise ValueError('Empty feature')
 
-    matches = speedup_cy.match_features(featureA, featureB, A.shape[0])
-    #matches_ = speedup_cy.match_features(featureA, featureB, A.shape[0])
-
-    # Sort the matches by number of corroborating features
-    matches = sorted(matches, key=lambda m: matches[m], reverse=True)
-
-    # Group the matches by the rotation
-    matches = [[m for m in matches if m[3] == r] for r in range(4)]
+    # The 4 most corroborated feature matches of each rotation,
+    # (x,y,z,r,votes) grouped by the rotation
+    matches = speedup_cy.match_features(featureA, featureB, A.shape[0], 4)
+    matches = [matches[matches[:,3] == r, :4].tolist() for r in range(4)]
 
     # Store a measure of how each candidate rotation lines up with
     # the current estimate
-    dotscores = [1, 1, 1, 1]
-    if not R_aligned is None and not prev_R_Correct is None:
-        for r in range(4):
-            R = correction2modelmat(R_aligned, 0, 0, 0, r)
-            # The score is the angle between the forward vectors of the
-            # proposed matrix and the previous estimated matrix
-            dotscores[r] = 1 + 3*(1 - (np.dot(R[:3,0], prev_R_Correct[:3,0])))
+    dotscores = rotation_scores(R_aligned, prev_R_Correct)
 
     bestmatch = 4*[None]
     besterror = 4*[10000]
 
-    # Only consider the top 8 most corroborated feature matches
+    # Compare the grids 64 voxels at a time (see bitgrid)
+    if packedA is None:
+        packedA = bitgrid.pack(occA), bitgrid.pack(vacA)
+    occA_, vacA_ = packedA
+    occB_, vacB_ = bitgrid.pack(occB), bitgrid.pack(vacB)
+
     for r in range(4):
-        oBr = np.ascontiguousarray(np.swapaxes(
-            np.rot90(np.swapaxes(occB, 1, 2), r), 1, 2))
-        vBr = np.ascontiguousarray(np.swapaxes(
-            np.rot90(np.swapaxes(vacB, 1, 2), r), 1, 2))
-        for match in matches[r][:4]:
+        if not matches[r]:
+            continue
+        oBr = occB_.rot90(r)
+        vBr = vacB_.rot90(r)
+        for match in matches[r]:
             #oB = apply_correction(occB, *match)
             #vB = apply_correction(vacB, *match)
             #err_np = error(occA, vacA, oB, vB)
 
             bx,_,bz,_ = match
             #err = error_weave(occA, vacA, oBr, vBr, bx, bz, term=besterror[r])
-            err = speedup_cy.grid_error(occA.astype('u1'),
-                                        vacA.astype('u1'),
-                                        oBr.astype('u1'),
-                                        vBr.astype('u1'), bx, bz,
-                                        term=besterror[r])
+            err = bitgrid.grid_error(occA_, vacA_, oBr, vBr, bx, bz,
+                                     term=besterror[r])
             #assert err_ == err
             #print [bx, bz, r], err, err_np
             #err = err_np
             #assert err == err_weave
 
             if err < besterror[r]:
-                bestmatch[r] = match
+                bestmatch[r] = tuple(match)
                 besterror[r] = err
 
     # Use the previouse_estimate score with a weight to select the best
@@ -0,0 +1,239 @@
+# Andrew Miller <amiller@cs.ucf.edu> 2011
+#
+# BlockPlayer - 3D model reconstruction using the Lattice-First algorithm
+# See:
+#    "Interactive 3D Model Acquisition and Tracking of Building Block Structures"
+#    Andrew Miller, Brandyn White, Emiko Charbonneau, Zach Kanzler, and Joseph J. LaViola Jr.
+#    IEEE VR 2012, IEEE TVGC 2012
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Choosing which frames main.Tracker reconstructs. ChangeDetector finds the
+# frames that are the same as the last one worked on, which can be skipped
+# altogether. Of the rest, every frame gets the mask, normals and lattice,
+# which are enough to follow the pose from one frame to the next (see
+# hashalign.nearest_correction). occvac, spacecarve, the alignment, stencil
+# carve and merge only run on keyframes (see Scheduler): when the pose
+# can't be followed that way, when the camera has moved or the depth has
+# changed since the last keyframe, when the lattice hasn't been sure of
+# itself for a while, or when it's been too long.
+import numpy as np
+import config
+import speedup_cy
+
+
+class Scheduler(object):
+    """Decides, frame by frame, which are keyframes. Pass one to
+    main.Tracker.
+
+    Params:
+        target_latency: the average time (seconds) to spend on a frame.
+            Keyframes are spaced out so that the average stays under it, by
+            keeping track of how long keyframes and other frames take. None
+            allows a keyframe whenever something has changed.
+        max_interval: a keyframe at least this often (frames)
+        max_angle, max_shift: the furthest (radians, blocks) a pose can be
+            from the previous one and still be followed without aligning
+            the voxels (see hashalign.snap_to_previous)
+        move, turn: camera motion since the last keyframe (blocks,
+            radians) that calls for another
+        max_unsure: the frames since the last keyframe whose lattice
+            estimates can't be trusted (see lattice.is_valid_estimate) that
+            call for another. Their poses can drift, which only aligning the
+            voxels puts right.
+        change: the fraction of the pixels in the mask's rect whose depth
+            has changed by more than tolerance (mm) since the last keyframe
+            that calls for another
+
+    self.counts has how many frames were keyframes for each reason, and
+    how many weren't ('tracked').
+    """
+    def __init__(self, target_latency=None, max_interval=30,
+                 max_angle=np.radians(10), max_shift=0.25,
+                 move=0.5, turn=np.radians(5), max_unsure=3, change=0.02,
+                 tolerance=10):
+        self.target_latency = target_latency
+        self.max_interval = max_interval
+        self.max_angle = max_angle
+        self.max_shift = max_shift
+        self.move = move
+        self.turn = turn
+        self.max_unsure = max_unsure
+        self.change = change
+        self.tolerance = tolerance
+        self.counts = dict(first=0, lost=0, interval=0, moved=0, unsure=0,
+                           changed=0, tracked=0)
+        self.key_cost = self.frame_cost = None
+        self.min_interval = 1
+        self.reset()
+
+    def reset(self):
+        """Start over: the next frame is a keyframe."""
+        self.since_key = self.unsure = None
+        self.key_pose = self.key_depth = None
+
+    def keyframe(self, depth, rect, angle, shift, R_correct, valid):
+        """Whether this frame should be a keyframe.
+        Params:
+            depth, rect: the depth image and the mask's rect
+            angle, shift: how far the pose is from the previous one once
+                          rounded to it (see hashalign.nearest_correction)
+            R_correct: the pose, rounded that way
+            valid: whether the lattice estimate could be trusted (see
+                   lattice.is_valid_estimate). Only those frames are made
+                   keyframes for a change in depth, since only they'd be
+                   merged.
+        Returns:
+            the reason it's a keyframe ('first', 'lost', 'interval',
+            'moved', 'unsure', 'changed'), or None if it isn't
+        """
+        self._valid = valid
+        if self.since_key is None:
+            return 'first'
+        if angle > self.max_angle or shift > self.max_shift:
+            return 'lost'
+        if self.since_key + 1 >= self.max_interval:
+            return 'interval'
+        if self.since_key + 1 < self.min_interval:
+            return None
+
+        d = np.sqrt(np.sum((R_correct[:3,3] - self.key_pose[:3,3])**2))
+        c = (np.trace(np.dot(R_correct[:3,:3], self.key_pose[:3,:3].T))-1)/2
+        if d > self.move*config.LW or np.arccos(np.clip(c,-1,1)) > self.turn:
+            return 'moved'
+        if not valid:
+            if self.unsure + 1 >= self.max_unsure:
+                return 'unsure'
+            return None
+
+        (L,T),(R,B) = rect
+        if R > L and B > T:
+            a = depth[T:B,L:R].astype('i4')
+            b = self.key_depth[T:B,L:R]
+            changed = np.count_nonzero(np.abs(a - b) > self.tolerance)
+            if changed > self.change * a.size:
+                return 'changed'
+        return None
+
+    def update(self, reason, R_correct=None, depth=None):
+        """Count the frame, and remember it if it was a keyframe (reason)
+        that got as far as a pose."""
+        self.counts[reason or 'tracked'] += 1
+        if reason is None:
+            self.since_key += 1
+            self.unsure += not self._valid
+        elif not R_correct is None:
+            self.since_key = self.unsure = 0
+            self.key_pose = R_correct
+            self.key_depth = depth.astype('i4')
+
+    def record(self, seconds, key, alpha=0.1):
+        """How long a frame took, and whether it was a keyframe. Works out
+        min_interval, the fewest frames from one keyframe to the next (but
+        for 'first', 'lost' and 'interval') that keeps to target_latency on
+        average."""
+        if key:
+            self.key_cost = seconds if self.key_cost is None else \
+                (1-alpha)*self.key_cost + alpha*seconds
+        else:
+            self.frame_cost = seconds if self.frame_cost is None else \
+                (1-alpha)*self.frame_cost + alpha*seconds
+        if self.target_latency is None or self.key_cost is None:
+            return
+        k, f = self.key_cost, self.frame_cost or 0.
+        if k <= self.target_latency:
+            self.min_interval = 1
+        elif f >= self.target_latency:
+            self.min_interval = self.max_interval
+        else:
+            # One keyframe every n frames: (k + (n-1)*f)/n <= target
+            n = int(np.ceil((k - f) / (self.target_latency - f)))
+            self.min_interval = min(max(n, 1), self.max_interval)
+
+
+# The kinect's depth step (mm) at depth z (mm) is about quantum*z**2 (see
+# synthetic.kinect_disparity)
+quantum = 3.07e-6
+
+
+class ChangeDetector(object):
+    """Tells when the depth hasn't changed since the last frame main.Tracker
+    worked on, so that it can keep what it had and skip the frame. The
+    image is cut into tiles, and the mean depth of each tile around the
+    mask's rect, and how many pixels it has with a depth, are compared with
+    the last frame that wasn't skipped. Pass one to main.Tracker.
+
+    Params:
+        tile: the size of the tiles (pixels)
+        margin: how far around the rect to look (pixels)
+        steps: how far the mean depth of a tile can move, in steps of the
+               kinect's depth at that depth (quantum)
+        dropout: the fraction of a tile's pixels that can gain or lose a
+                 depth
+        max_skip: work on a frame at least this often (frames), to catch
+                  changes outside the rect
+
+    self.counts has how many frames were skipped and how many weren't.
+    """
+    def __init__(self, tile=16, margin=32, steps=3, dropout=0.1,
+                 max_skip=30):
+        self.tile = tile
+        self.margin = margin
+        self.steps = steps
+        self.dropout = dropout
+        self.max_skip = max_skip
+        self.counts = dict(skipped=0, processed=0)
+        self.reset()
+
+    def reset(self):
+        """Forget the last frame: the next one is worked on."""
+        self.sums = self.pixels = None
+        self.skipped = 0
+
+    def unchanged(self, depth, rect=None):
+        """Whether depth is the same as the last frame that wasn't skipped,
+        around rect (the mask's rect from that frame, or all of the image
+        if None). If it isn't, it becomes the one to compare with."""
+        t = self.tile
+        H, W = depth.shape
+        shape = ((H+t-1)//t, (W+t-1)//t)
+        if self.sums is None or self.sums.shape != shape or \
+           self.skipped + 1 >= self.max_skip:
+            return self._keep(depth, shape)
+
+        if rect is None:
+            rect = ((0,0),(W,H))
+        (L,T),(R,B) = rect
+        i0, j0 = max((T-self.margin)//t, 0), max((L-self.margin)//t, 0)
+        i1 = min((B+self.margin+t-1)//t, shape[0])
+        j1 = min((R+self.margin+t-1)//t, shape[1])
+        speedup_cy.tile_sums(depth, self._sums, self._pixels, t,
+                             i0, j0, i1, j1)
+        inside = (slice(i0, i1), slice(j0, j1))
+        s, n = self._sums[inside], self._pixels[inside]
+        s0, n0 = self.sums[inside], self.pixels[inside]
+        if np.any(np.abs(n - n0) > self.dropout*t*t):
+            return self._keep(depth, shape)
+        both = (n > 0) & (n0 > 0)
+        m = s[both] / n[both].astype('f8')
+        m0 = s0[both] / n0[both].astype('f8')
+        if np.any(np.abs(m - m0) > self.steps*quantum*m0*m0):
+            return self._keep(depth, shape)
+        self.skipped += 1
+        self.counts['skipped'] += 1
+        return True
+
+    def _keep(self, depth, shape):
+        # Remember depth's tiles, to compare the next frames with
+        if self.sums is None or self.sums.shape != shape:
+            self.sums = np.empty(shape, 'i8')
+            self.pixels = np.empty(shape, 'i4')
+            self._sums = np.empty(shape, 'i8')
+            self._pixels = np.empty(shape, 'i4')
+        speedup_cy.tile_sums(depth, self.sums, self.pixels, self.tile,
+                             0, 0, shape[0], shape[1])
+        self.skipped = 0
+        self.counts['processed'] += 1
+        return False
@@ -47,7 +47,7 @@ def project(X, Y, Z, mat):
   return x*w, y*w, z*w
 
 
-def orientation_opencl(noshow=None):
+def orientation_opencl(noshow=None, buffers=None):
   """Find the orientation of the lattice using the (labeled) surface normals.
       (see normals.normals_opencl)
   """
@@ -59,8 +59,10 @@ def orientation_opencl(noshow=None):
   v0 = np.cross(v1,v2)
   mat = np.hstack((np.vstack((v0,v1,v2)),[[0],[0],[0]]))
 
-  opencl.compute_flatrot(mat.astype('f'))
-  sq = opencl.reduce_flatrot()
+  if buffers is None:
+    buffers = opencl.default_buffers()
+  buffers.compute_flatrot(mat.astype('f'))
+  sq = buffers.reduce_flatrot()
 
   qqx = sq[0] / sq[3]
   qqz = sq[2] / sq[3]
@@ -111,7 +113,7 @@ def orientation_numpy(normals,weights):
   return axes
 
 
-def translation_opencl(R_oriented, init_t=None):
+def translation_opencl(R_oriented, init_t=None, buffers=None):
   """
   Params:
       mat:
@@ -125,19 +127,33 @@ def translation_opencl(R_oriented, init_t=None):
       correction by [-meanx, 0, -meany] that must be applied to modelxyz,
       and passed as a parameter to opencl.computegridinds.
   """
-  assert R_oriented.dtype == np.float32
   global modelmat
+  modelmat, estimate = translation_estimate(R_oriented, init_t, buffers)
+  publish(estimate)
+  return modelmat
+
+
+def translation_estimate(R_oriented, init_t=None, buffers=None):
+  """Same as translation_opencl, but leaves the module globals alone.
+
+  Returns:
+      modelmat: a 4x4 matrix
+      estimate: dict(meanx, meanz, dmx, dmy, countx, county, cxyz_, qx2qz2),
+          the values translation_opencl stores as globals. Pass it to
+          is_valid_estimate(), and meanx/meanz to occvac.carve().
+  """
+  assert R_oriented.dtype == np.float32
   modelmat = np.array(R_oriented)
+  if buffers is None:
+    buffers = opencl.default_buffers()
 
   # Returns warped coordinates, and sincos values for the lattice
-  opencl.compute_lattice2(modelmat[:3,:4], LW)
+  buffers.compute_lattice2(modelmat[:3,:4], LW)
 
-  global cx,cz,face
   # If we don't have a good initialization for the model space translation,
   # use the centroid of the surface points.
   if init_t:
-    global face
-    X,Y,Z,face = np.rollaxis(opencl.get_modelxyz(),1)
+    X,Y,Z,face = np.rollaxis(buffers.get_modelxyz(),1)
     cx,_,cz,_ = np.rollaxis(np.frombuffer(np.array(face).data,
                                           dtype='i1').reshape(-1,2),1)
 
@@ -145,7 +161,7 @@ def translation_opencl(R_oriented, init_t=None):
                                0,
                                Z[cx!=0].mean()/LW,
                                0])*LW
-    opencl.compute_lattice2(modelmat[:3,:4], LW)
+    buffers.compute_lattice2(modelmat[:3,:4], LW)
 
   # Find the circular mean, using weights
   def cmean(mxy,c):
@@ -154,19 +170,31 @@ def translation_opencl(R_oriented, init_t=None):
     if np.isnan(a2): a2 = 0
     return a2, np.sqrt(x**2 + y**2), c
 
-  global meanx,meanz,cxyz_,qx2qz2, dmx, dmy, countx, county
-  cxyz_,qx2qz2 = opencl.reduce_lattice2()
+  cxyz_,qx2qz2 = buffers.reduce_lattice2()
   meanx,dmx,countx = cmean(qx2qz2[:2],cxyz_[0])
   meanz,dmy,county = cmean(qx2qz2[2:],cxyz_[2])
   modelmat[:,3] -= np.array([meanx, 0, meanz, 0])
 
-  return modelmat
+  estimate = dict(meanx=meanx, meanz=meanz,
+                  dmx=dmx, dmy=dmy,
+                  countx=countx, county=county,
+                  cxyz_=cxyz_, qx2qz2=qx2qz2)
+  return modelmat, estimate
+
+
+def publish(estimate):
+  """Store a translation_estimate() result in the module globals, where
+  is_valid_estimate() and occvac.carve() look for them by default."""
+  globals().update(estimate)
 
 
-def is_valid_estimate():
-  global dmx, dmy, countx, county
-  return (dmx >= 0.7 and dmy >= 0.7 and
-          countx > 100 and county >= 100)
+def is_valid_estimate(estimate=None, scale=1.0):
+  """Whether both lattice axes were seen clearly, by enough pixels: 100 in a
+  640x480 image, times scale (see config.pixel_scale) in others."""
+  if estimate is None:
+    estimate = globals()
+  return (estimate['dmx'] >= 0.7 and estimate['dmy'] >= 0.7 and
+          estimate['countx'] > 100*scale and estimate['county'] >= 100*scale)
 
 
 def translation_numpy(n,w,depth,mat,matxyz,rect,init_t=None):
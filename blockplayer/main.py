@@ -11,6 +11,8 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import numpy as np
+import os
+import time
 import config
 import preprocess
 import normals
@@ -22,103 +24,373 @@ import stencil
 import occvac
 import dataset
 import hashalign
+import timing
 
 R_display = None
 
+# Find the normals and the lattice on depth images shrunk by this factor
+# (1, 2 or 4), for speed. occvac and stencil carve still see every pixel.
+# Set BLOCKPLAYER_DECIMATE to choose, or pass decimate to Tracker.
+if not 'decimate' in globals():
+    decimate = int(os.environ.get('BLOCKPLAYER_DECIMATE', '1'))
 
-def initialize():
-    grid.initialize()
-    global R_display
-    R_display = None
 
+def matrix_slerp(matA, matB, alpha=0.6):
+    if matA is None:
+        return matB
+    import transformations
+    qA = transformations.quaternion_from_matrix(matA)
+    qB = transformations.quaternion_from_matrix(matB)
+    qC =transformations.quaternion_slerp(qA, qB, alpha)
+    mat = matB.copy()
+    mat[:3,3] = (alpha)*matA[:3,3] + (1-alpha)*matB[:3,3]
+    mat[:3,:3] = transformations.quaternion_matrix(qC)[:3,:3]
+    return mat
 
-def update_frame(depth, rgb=None):
-    def from_rect(m,rect):
-        (l,t),(r,b) = rect
-        return m[t:b,l:r]
 
-    global mask, rect, modelmat
+class Tracker(object):
+    """Tracks one structure through a stream of depth/rgb frames.
 
-    try:
-        (mask,rect) = preprocess.threshold_and_mask(depth,config.bg)
-    except IndexError:
-        grid.initialize()
-        modelmat = None
-        return
+    A Tracker owns all the state that update_frame carries from one frame to
+    the next: the voxel grid (a grid.Grid), the opencl buffers, and the most
+    recent pose estimates. Several trackers can run side by side on different
+    threads. The stencil step renders with OpenGL, so each thread needs its
+    own GL context made current before calling update_frame.
 
-    # Compute the surface normals
-    normals.normals_opencl(depth, mask, rect)
+    Params:
+        bg: calibration dict (see config.bg). Defaults to config.bg at the
+            time of each frame.
+        buffers: an opencl.Buffers (or opencl_numpy.Buffers). Allocated on
+            the first frame if None.
+        grid_: a grid.Grid. A new one is created if None.
+        decimate: see the module's decimate, which is the default.
+        roi_band: look for the object only this many pixels around where it
+                  was in the last frame (see preprocess.track_mask), or
+                  everywhere if 0.
+        roi_refresh: search the whole image at least this often (frames),
+                  to find anything new outside the band.
+        snap: when the pose has hardly moved and the voxels agree with the
+              grid, keep to the previous pose rather than searching for the
+              alignment (see hashalign.snap_to_previous). Off by default,
+              since the poses (and so the grids) then differ from the
+              search's on noisy frames.
+        scheduler: a keyframes.Scheduler, to reconstruct (occvac through
+              merge) only on the frames it picks, and just follow the pose
+              on the rest. If None, every frame is reconstructed.
+        detector: a keyframes.ChangeDetector, to skip the frames whose depth
+              is the same as the last one's that wasn't skipped, keeping the
+              pose and grid from then (outcome 'unchanged').
 
-    # Find the lattice orientation and then translation
-    global R_oriented, R_aligned, R_correct
-    R_oriented = lattice.orientation_opencl()
-    R_aligned = lattice.translation_opencl(R_oriented)
+    Per stage timings of update_frame are kept in self.timings (a
+    timing.Timings), how many frames were searched near the last rect
+    and how many all over in self.roi_searches, and how many frames were
+    aligned by snapping to the previous pose and how many by searching in
+    self.aligns. self.keyframe is why the last frame was a keyframe (see
+    keyframes.Scheduler.keyframe), or None if it wasn't one. The detector
+    counts the frames it skipped.
+    """
+    def __init__(self, bg=None, buffers=None, grid_=None, decimate=None,
+                 roi_band=32, roi_refresh=30, snap=False, scheduler=None,
+                 detector=None):
+        self.bg = bg
+        self.buffers = buffers
+        self.decimate = globals()['decimate'] if decimate is None else decimate
+        self._small = self._small_for = None
+        self.roi_band = roi_band
+        self.roi_refresh = roi_refresh
+        self.roi_searches = dict(band=0, full=0)
+        self._since_full = 0
+        self.snap = snap
+        self.aligns = dict(snap=0, search=0)
+        self.scheduler = scheduler
+        self.detector = detector
+        self.keyframe = None
+        self._scheduled = False
+        self.grid = grid.Grid() if grid_ is None else grid_
+        self.mask = self.rect = None
+        self.modelmat = None
+        self.estimate = None
+        self.occ = self.vac = None
+        self.R_oriented = self.R_aligned = self.R_correct = None
+        self.R_display = None
+        self.outcome = None
+        self.timings = timing.Timings()
 
-    # Use occvac to estimate the voxels from just the current frame
-    occ, vac = occvac.carve_opencl()
+    def initialize(self):
+        self.grid.initialize()
+        self.R_display = None
+        if not self.scheduler is None:
+            self.scheduler.reset()
+        if not self.detector is None:
+            self.detector.reset()
 
-    # Further carve out the voxels using spacecarve
-    warn = np.seterr(invalid='ignore')
-    try:
-        vac = vac | spacecarve.carve(depth, R_aligned)
-    except np.linalg.LinAlgError:
-        return
-    np.seterr(divide=warn['invalid'])
+    def calibration(self):
+        return config.bg if self.bg is None else self.bg
+
+    def _buffers(self):
+        if self.buffers is None:
+            mats = None
+            if not self.bg is None:
+                mats = (self.bg['KK'], self.bg['Ktable'])
+            self.buffers = opencl.make_buffers(mats)
+        return self.buffers
+
+    def _small_buffers(self, bg):
+        # Buffers for the decimated images, calibrated for them
+        if not self._small_for is bg:
+            small = config.scale_bg(bg, self.decimate, averaged=True)
+            self._small = opencl.make_buffers((small['KK'], small['Ktable']))
+            self._small_for = bg
+        return self._small
+
+    def _threshold_and_mask(self, depth, bg):
+        # The mask is written into the same buffer every frame
+        if self.mask is None or self.mask.shape != depth.shape:
+            self.mask = np.empty(depth.shape, 'u1')
+        found = None
+        if self.roi_band and not self.rect is None and \
+           self._since_full < self.roi_refresh:
+            found = preprocess.track_mask(depth, bg, self.rect, self.roi_band,
+                                        self.mask)
+        if found is None:
+            self.roi_searches['full'] += 1
+            self._since_full = 0
+            return preprocess.threshold_and_mask(depth, bg, self.mask)
+        self.roi_searches['band'] += 1
+        self._since_full += 1
+        return found
+
+    def update_frame(self, depth, rgb=None):
+        """Track one frame. How long each stage took, and whether the frame
+        made it all the way through (outcome 'ok', or 'tracked' if it wasn't
+        a keyframe) or why not, are added to self.timings."""
+        t0 = time.time()
+        self._scheduled = False
+        with self.timings.stage('update_frame'):
+            self.outcome = self._update_frame(depth, rgb, self.timings.stage)
+        self.timings.outcome(self.outcome)
+        if self._scheduled:
+            posed = self.outcome in ('ok', 'invalid_estimate')
+            self.scheduler.update(self.keyframe,
+                                  self.R_correct if posed else None, depth)
+            self.scheduler.record(time.time() - t0, not self.keyframe is None)
+
+    def _update_frame(self, depth, rgb, stage):
+        bg = self.calibration()
+        buffers = self._buffers()
+        g = self.grid
+
+        if not self.detector is None:
+            with stage('detect_change'):
+                if self.detector.unchanged(depth, self.rect):
+                    return 'unchanged'
 
-    if grid.has_previous_estimate() and np.any(grid.occ):
         try:
-            c,err = hashalign.find_best_alignment(grid.occ, grid.vac,
-                                                  occ, vac,
-                                                  R_aligned,
-                                                  grid.previous_estimate['R_correct'])
-        except ValueError:
-            #print 'could not align previous'
-            return None
+            with stage('threshold_and_mask'):
+                (self.mask,self.rect) = self._threshold_and_mask(depth, bg)
+        except IndexError:
+            g.initialize()
+            self.modelmat = None
+            self.rect = None
+            return 'no_mask'
+        mask, rect = self.mask, self.rect
 
-        R_correct = hashalign.correction2modelmat(R_aligned, *c)
-        occ = occvac.occ = hashalign.apply_correction(occ, *c)
-        vac = occvac.vac = hashalign.apply_correction(vac, *c)
-
-    elif np.any(occ):
-        # If this is the first estimate (bootstrap) then try to center the grid
-        if np.any(grid.occ):
-            # Initialize with ground truth
-            try:
-                c,err = hashalign.find_best_alignment(grid.occ, grid.vac,
-                                                      occ, vac, R_aligned)
-                R_correct = hashalign.correction2modelmat(R_aligned, *c)
-                occ = occvac.occ = hashalign.apply_correction(occ, *c)
-                vac = occvac.vac = hashalign.apply_correction(vac, *c)
-            except ValueError:
-                #print 'could not align bootstrap'
-                return None
+        # Compute the surface normals, on a smaller image if decimating
+        lattice_buffers, size = buffers, depth.shape[::-1]
+        if self.decimate > 1:
+            lattice_buffers = self._small_buffers(bg)
+            with stage('decimate'):
+                small = preprocess.decimate(depth, mask, rect, self.decimate)
+            size = small[0].shape[::-1]
+        with stage('normals_opencl'):
+            if self.decimate > 1:
+                normals.normals_opencl(*small, buffers=lattice_buffers)
+            else:
+                normals.normals_opencl(depth, mask, rect, buffers=buffers)
+
+        # Find the lattice orientation and then translation
+        with stage('orientation_opencl'):
+            R_oriented = lattice.orientation_opencl(buffers=lattice_buffers)
+        with stage('translation_estimate'):
+            R_aligned, estimate = lattice.translation_estimate(
+                R_oriented, buffers=lattice_buffers)
+        self.R_oriented, self.R_aligned = R_oriented, R_aligned
+        self.estimate = estimate
+
+        if not self.scheduler is None:
+            with stage('keyframe'):
+                R_correct = self._schedule(depth, rect, R_aligned, estimate,
+                                           size)
+            if self.keyframe is None:
+                self.R_correct = R_correct
+                self.R_display = matrix_slerp(self.R_display, R_correct)
+                g.update_previous_estimate(R_correct)
+                return 'tracked'
+
+        if self.decimate > 1:
+            # occvac needs the labels of every pixel. Now that the lattice is
+            # known, that's the normals and one pass of lattice2
+            with stage('full_normals'):
+                normals.normals_opencl(depth, mask, rect, buffers=buffers)
+                buffers.compute_lattice2(R_oriented[:3,:4], config.LW)
+
+        # Use occvac to estimate the voxels from just the current frame
+        with stage('carve_buffers'):
+            occ, vac = occvac.carve_buffers(estimate['meanx'],
+                                            estimate['meanz'], buffers,
+                                            config.voxel_pixels(
+                                                depth.shape[::-1]))
+
+        # The part of the grid to work on (all of it, unless it's sparse)
+        with stage('frame_window'):
+            R_aligned, occ, vac = g.frame_window(R_aligned, occ, vac)
+
+        # Further carve out the voxels using spacecarve
+        warn = np.seterr(invalid='ignore')
+        try:
+            with stage('spacecarve'):
+                vac = vac | spacecarve.carve(depth, R_aligned, bg,
+                                             g.bounds).astype(bool)
+        except np.linalg.LinAlgError:
+            return 'spacecarve_failed'
+        np.seterr(divide=warn['invalid'])
+
+        if g.has_previous_estimate() and np.any(g.occ):
+            R_previous = g.previous_estimate['R_correct']
+            snapped = None
+            if self.snap:
+                with stage('snap_to_previous'):
+                    snapped = hashalign.snap_to_previous(g.occ, g.vac,
+                                                         occ, vac,
+                                                         R_aligned,
+                                                         R_previous)
+            if snapped is None:
+                self.aligns['search'] += 1
+                try:
+                    with stage('find_best_alignment'):
+                        c,err = hashalign.find_best_alignment(g.occ, g.vac,
+                                                              occ, vac,
+                                                              R_aligned,
+                                                              R_previous,
+                                                              g.packed())
+                except ValueError:
+                    #print 'could not align previous'
+                    return 'align_failed'
+                occ = hashalign.apply_correction(occ, *c)
+                vac = hashalign.apply_correction(vac, *c)
+            else:
+                self.aligns['snap'] += 1
+                c, occ, vac = snapped
+
+            R_correct = hashalign.correction2modelmat(R_aligned, *c)
+
+        elif np.any(occ):
+            # If this is the first estimate (bootstrap) then try to center the grid
+            if np.any(g.occ):
+                # Initialize with ground truth
+                try:
+                    with stage('find_best_alignment'):
+                        c,err = hashalign.find_best_alignment(g.occ, g.vac,
+                                                              occ, vac,
+                                                              R_aligned,
+                                                              None,
+                                                              g.packed())
+                    R_correct = hashalign.correction2modelmat(R_aligned, *c)
+                    occ = hashalign.apply_correction(occ, *c)
+                    vac = hashalign.apply_correction(vac, *c)
+                except ValueError:
+                    #print 'could not align bootstrap'
+                    return 'bootstrap_align_failed'
+            else:
+                R_correct, occ, vac = grid.center(R_aligned, occ, vac,
+                                                  g.bounds)
+        else:
+            #print 'nothing happened'
+            return 'no_blocks'
+
+        self.occ, self.vac = occ, vac
+        self.R_correct = R_correct
+        self.R_display = matrix_slerp(self.R_display, R_correct)
+
+        with stage('stencil_carve'):
+            occ_stencil, vac_stencil = g.stencil_carve(depth, rect,
+                                                       R_correct, occ, vac,
+                                                       rgb, bg)
+        outcome = 'ok'
+        if lattice.is_valid_estimate(estimate, config.pixel_scale(size)):
+            # Run stencil carve and merge
+            color = g.stencil_stats['RGB'] if not rgb is None else None
+            with stage('merge_with_previous'):
+                g.merge_with_previous(occ, vac, occ_stencil, vac_stencil,
+                                      color)
         else:
-            R_correct, occ, vac = grid.center(R_aligned, occ, vac)
-            occvac.occ, occvac.vac = occ, vac
-    else:
-        #print 'nothing happened'
-        return
-
-    def matrix_slerp(matA, matB, alpha=0.6):
-        if matA is None:
-            return matB
-        import transformations
-        qA = transformations.quaternion_from_matrix(matA)
-        qB = transformations.quaternion_from_matrix(matB)
-        qC =transformations.quaternion_slerp(qA, qB, alpha)
-        mat = matB.copy()
-        mat[:3,3] = (alpha)*matA[:3,3] + (1-alpha)*matB[:3,3]
-        mat[:3,:3] = transformations.quaternion_matrix(qC)[:3,:3]
-        return mat
+            outcome = 'invalid_estimate'
+        g.update_previous_estimate(R_correct)
+        return outcome
+
+    def _schedule(self, depth, rect, R_aligned, estimate, size):
+        # Ask the scheduler whether this is a keyframe. If it isn't, the pose
+        # is R_aligned rounded to the previous one, which is returned
+        g = self.grid
+        self._scheduled = True
+        if not g.has_previous_estimate() or not np.any(g.occ):
+            self.scheduler.reset()
+            self.keyframe = 'first'
+            return None
+        c, angle, shift = hashalign.nearest_correction(
+            R_aligned, g.previous_estimate['R_correct'])
+        R_correct = hashalign.correction2modelmat(R_aligned, *c)
+        valid = lattice.is_valid_estimate(estimate, config.pixel_scale(size))
+        self.keyframe = self.scheduler.keyframe(depth, rect, angle, shift,
+                                                R_correct, valid)
+        return R_correct
+
+
+if not 'tracker' in globals():
+    tracker = None
+
 
+def default_tracker():
+    """The Tracker driven by the module level update_frame(). It works on
+    grid.default and opencl.default_buffers(), so the demos can keep reading
+    grid.occ, main.R_correct, opencl.get_xyz() and so on."""
+    global tracker
+    if tracker is None:
+        tracker = Tracker(buffers=opencl.default_buffers(),
+                          grid_=grid.default)
+    return tracker
+
+
+def publish(t):
+    """Mirror the state of Tracker t into the module globals of main, grid,
+    lattice, occvac and stencil, where the demos look for it."""
+    globals().update((k, getattr(t, k))
+                     for k in ('mask', 'R_oriented', 'R_aligned',
+                               'R_correct', 'R_display', 'timings')
+                     if not getattr(t, k) is None)
+    # These are None after a frame with no mask, so that nothing draws or
+    # carves with the last frame's
+    globals().update(rect=t.rect, modelmat=t.modelmat)
+    grid.publish(t.grid)
+    if not t.estimate is None:
+        lattice.publish(t.estimate)
+    if not t.occ is None:
+        occvac.occ, occvac.vac = t.occ, t.vac
+    if not t.grid.stencil_stats is None:
+        stencil.publish(t.grid.stencil_stats)
+
+
+def initialize():
+    t = default_tracker()
+    t.initialize()
     global R_display
-    R_display = matrix_slerp(R_display, R_correct)
-
-    occ_stencil, vac_stencil = grid.stencil_carve(depth, rect,
-                                                  R_correct, occ, vac,
-                                                  rgb)
-    if lattice.is_valid_estimate():
-        # Run stencil carve and merge
-        color = stencil.RGB if not rgb is None else None
-        grid.merge_with_previous(occ, vac, occ_stencil, vac_stencil, color)
-    grid.update_previous_estimate(R_correct)
+    R_display = None
+    grid.publish(t.grid)
+
+
+def update_frame(depth, rgb=None):
+    t = default_tracker()
+    try:
+        return t.update_frame(depth, rgb)
+    finally:
+        publish(t)
@@ -32,12 +32,25 @@ speedup.normals.argtypes = [matarg, matarg, matarg,
                             matarg, ctypes.c_int, ctypes.c_int]
 
 
-def normals_opencl(depth, mask=None, rect=((0,0),(640,480)), win=6):
+def normals_opencl(depth, mask=None, rect=None, win=None,
+                   buffers=None):
+    """
+    Params:
+        win: width of the smoothing filter, in pixels. By default 6 for a
+             640 pixel wide image, and in proportion for others.
+    """
     def from_rect(m,rect):
         (l,t),(r,b) = rect
         return m[t:b,l:r]
 
-    opencl.set_rect(rect)
+    if rect is None:
+        rect = ((0,0),depth.shape[::-1])
+    if win is None:
+        win = max(2, int(round(6 * depth.shape[1] / 640.)))
+
+    if buffers is None:
+        buffers = opencl.default_buffers()
+    buffers.set_rect(rect)
     depth = from_rect(depth,rect)
     (l,t),(r,b) = rect
     assert depth.dtype == np.uint16
@@ -53,19 +66,21 @@ def normals_opencl(depth, mask=None, rect=((0,0),(640,480)), win=6):
     depth = np.ascontiguousarray(depth)
     depth = calibkinect.recip_depth_openni(depth)
     filt = scipy.ndimage.uniform_filter(depth,win)
-    opencl.load_filt(filt)
-    opencl.load_raw(depth)
-    opencl.load_mask(mask)
-    return opencl.compute_normals().wait()
+    buffers.load_filt(filt)
+    buffers.load_raw(depth)
+    buffers.load_mask(mask)
+    return buffers.compute_normals().wait()
 
 
 def normal_show(nx,ny,nz):
     return np.dstack((nx/2+.5,ny/2+.5,nz/2+.5))
 
 
-def normals_numpy(depth, rect=((0,0),(640,480)), win=7, mat=None):
+def normals_numpy(depth, rect=None, win=7, mat=None):
     assert depth.dtype == np.float32
     from scipy.ndimage.filters import uniform_filter
+    if rect is None:
+        rect = ((0,0),depth.shape[::-1])
     (l,t),(r,b) = rect
     v,u = np.mgrid[t:b,l:r]
     depth = depth[v,u]
@@ -97,9 +112,11 @@ def normals_numpy(depth, rect=((0,0),(640,480)), win=7, mat=None):
     return np.dstack((x/w,y/w,z/w)), weights
 
 
-def normals_c(depth, rect=((0,0),(640,480)), win=7):
+def normals_c(depth, rect=None, win=7):
     assert depth.dtype == np.uint16
     from scipy.ndimage.filters import uniform_filter
+    if rect is None:
+        rect = ((0,0),depth.shape[::-1])
     (l,t),(r,b) = rect
     v,u = np.mgrid[t:b,l:r]
     depth = depth[v,u]
@@ -21,7 +21,57 @@ def carve_opencl(*args, **kwargs):
     return carve(*args, **kwargs)
 
 
-def carve(xfix=None, zfix=None, use_opencl=True):
+def carve_buffers(xfix, zfix, buffers=None, threshold=30):
+    """Histogram the grid indices into occupancy and vacancy grids. This all
+    happens on the device, and only the grids are read back. Unlike carve(),
+    this keeps no module globals, so it's safe to call from several trackers
+    at once. Voxels need more than threshold pixels (see
+    config.voxel_pixels) to count.
+    Returns:
+        occ, vac: boolean grids, config.bounds sized
+    """
+    gridmin = np.zeros((4,),'f')
+    gridmax = np.zeros((4,),'f')
+    gridmin[:3] = config.bounds[0]
+    gridmax[:3] = config.bounds[1]
+
+    if buffers is None:
+        buffers = opencl.default_buffers()
+
+    buffers.compute_occvac(xfix,zfix,
+                           config.LW, config.LH,
+                           gridmin, gridmax, threshold)
+    return buffers.get_occvac()
+
+
+def carve_gridinds(xfix, zfix, buffers=None, threshold=30):
+    """The same as carve_buffers, but reads back the per pixel grid indices
+    and histograms them on the host with speedup_cy.occvac. Kept as a
+    reference for the fused kernel."""
+    gridmin = np.zeros((4,),'f')
+    gridmax = np.zeros((4,),'f')
+    gridmin[:3] = config.bounds[0]
+    gridmax[:3] = config.bounds[1]
+
+    if buffers is None:
+        buffers = opencl.default_buffers()
+
+    buffers.compute_gridinds(xfix,zfix,
+                             config.LW, config.LH,
+                             gridmin, gridmax)
+    gridinds = buffers.get_gridinds()
+
+    shape = [int(gridmax[i]-gridmin[i]) for i in range(3)]
+    occ = np.zeros(shape, 'u1')
+    vac = np.zeros(shape, 'u1')
+    speedup_cy.occvac(gridinds, occ, vac,
+                      gridmin.astype('i'),
+                      gridmax.astype('i'), threshold)
+    return occ.astype('bool'), vac.astype('bool')
+
+
+def carve(xfix=None, zfix=None, use_opencl=True, buffers=None,
+          threshold=30):
     global gridinds, inds, grid
     gridmin = np.zeros((4,),'f')
     gridmax = np.zeros((4,),'f')
@@ -33,38 +83,16 @@ def carve(xfix=None, zfix=None, use_opencl=True):
         import lattice
         xfix, zfix = lattice.meanx, lattice.meanz
 
+    if buffers is None:
+        buffers = opencl.default_buffers()
+
     if use_opencl:
-        opencl.compute_gridinds(xfix,zfix,
-                                config.LW, config.LH,
-                                gridmin, gridmax)
-        gridinds = opencl.get_gridinds()
-
-        if 0:
-            inds = gridinds[gridinds[:,0,3]!=0,:,:3]
-            if len(inds) == 0:
-                return None
-            bins = [np.arange(0,gridmax[i]-gridmin[i]+1)
-                    for i in range(3)]
-            global occ, vac
-            occH,_ = np.histogramdd(inds[:,0,:], bins)
-            vacH,_ = np.histogramdd(inds[:,1,:], bins)
-
-            vac = vacH>30
-            occ = occH>30
-
-            return occ, vac
-        else:
-            shape = [gridmax[i]-gridmin[i] for i in range(3)]
-            occ = np.zeros(shape, 'u1')
-            vac = np.zeros(shape, 'u1')
-            speedup_cy.occvac(gridinds, occ, vac,
-                              gridmin.astype('i'),
-                              gridmax.astype('i'))
-            return occ.astype('bool'), vac.astype('bool')
+        occ, vac = carve_buffers(xfix, zfix, buffers, threshold)
+        return occ, vac
 
     else:
         global X,Y,Z, XYZ
-        X,Y,Z,face = np.rollaxis(opencl.get_modelxyz(),1)
+        X,Y,Z,face = np.rollaxis(buffers.get_modelxyz(),1)
         XYZ = np.array((X,Y,Z)).transpose()
         fix = np.array((xfix,0,zfix))
         cxyz = np.frombuffer(np.array(face).data,
@@ -79,8 +107,8 @@ def carve(xfix=None, zfix=None, use_opencl=True):
         gi = np.rollaxis(gi, 1)
 
         def get_gridinds():
-            (L,T),(R,B) = opencl.rect
-            length = opencl.length
+            (L,T),(R,B) = buffers.rect
+            length = buffers.length
             return (gridinds[:length,:,:].reshape(T-B,R-L,2,3),
                     gridinds[length:,:,:].reshape(T-B,R-L,2,3))
 
@@ -97,7 +125,7 @@ def carve(xfix=None, zfix=None, use_opencl=True):
         occH,_ = np.histogramdd(inds[:,0,:], bins)
         vacH,_ = np.histogramdd(inds[:,1,:], bins)
 
-        vac = vacH>30
-        occ = occH>30
+        vac = vacH>threshold
+        occ = occH>threshold
 
         return occ, vac
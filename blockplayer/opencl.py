@@ -13,9 +13,14 @@
 from OpenGL.GL import *
 from OpenGL.GLU import *
 import calibkinect
-import pyopencl as cl
 import numpy as np
 import preprocess
+import os
+import threading
+try:
+    import pyopencl as cl
+except ImportError:
+    cl = None
 
 
 def print_info(obj, info_cls):
@@ -29,99 +34,46 @@ def print_info(obj, info_cls):
 
             print "%s: %s" % (info_name, info_value)
 
-platform = cl.get_platforms()[0]
-device = platform.get_devices()[0]
-context = cl.Context(devices=[device])
-queue = cl.CommandQueue(context)
-mf = cl.mem_flags
-sampler = cl.Sampler(context, True,
-                     cl.addressing_mode.CLAMP,
-                     cl.filter_mode.LINEAR)
 
-
-def normal_maker(name, mat, matw, matr):
-  def tup(i):
-    return '(float4)' + repr(tuple(mat[i].tolist()))
-
-  def tupw(i):
-    return '(float4)' + repr(tuple(matw[i].tolist()))
-
-  def tupr(i):
-    return '(float4)' + repr(tuple(matr[i].tolist()))
-
-  return """
-  inline float4 matmul3_%s(const float4 r1) {
-    return (float4)(dot(%s,r1),dot(%s,r1),dot(%s,r1),0);
-  }
-
-  inline float4 matmul4_%s(const float4 r1) {
-    return (float4)(dot(%s,r1),dot(%s,r1),dot(%s,r1),dot(%s,r1));
-  }
-
-  inline float4 matmul3z_%s(const float4 r1) {
-    return (float4)(dot(%s,r1),dot(%s,r1),dot(%s,r1),0);
-  }
-
-
-  // Main Kernel code
-  kernel void normal_compute_%s(
-  	global float4 *output,
-  	global float4 *xoutput,
-  	global const float *filt,
-        global const float *raw,
-  	global const char *mask,
-  	const float4 bounds, const int offset
-  )
-  {	
-  	unsigned int x = get_global_id(0);
-        unsigned int y = get_global_id(1);
-  	unsigned int width = get_global_size(0);
-  	unsigned int height = get_global_size(1);
-  	unsigned int index = (y * width) + x + offset;
-
-  	if (x<1 || x>=width-1 || y<1 || y>=height-1 ||
-            !mask[index] || filt[index]<-1000) {
-  	   output[index] = (float4)(0);
-  	  xoutput[index] = (float4)(0);
-  	  return;
-  	}
-  	x += bounds.s0;
-  	y += bounds.s1;
-
-    float dx = (filt[index+1] - filt[index-1])/2;
-    float dy = (filt[index+width] - filt[index-width])/2;
-
-    if (fabs(dx)+fabs(dy)>10) {
-       output[index] = (float4)(0);
-      xoutput[index] = (float4)(0);
-      return;
-    }
-
-    // Project the normal vector
-    float4  XYZW = (float4)(-dx, -dy, 1, -(-dx*x + -dy*y + filt[index]));
-    float4  xyz = matmul3_%s ( XYZW);
-    
-    //float4 xXYZW = (float4)(  x,   y, filt[index], 1);
-    float4 xXYZW = (float4)(  x,   y, raw[index], 1);
-
-    float4 _xyz = matmul4_%s (xXYZW);
-    _xyz /= _xyz.w;
-    xyz = normalize(xyz);
-    if (xyz.z < 0) xyz = -xyz;
-    float w = (xyz.z>0.1);
-    xyz.w = 1;
-    xyz = matmul3z_%s(xyz);
-    xyz.w = w;
-
-    output[index] =  xyz; // this is the normals
-    xoutput[index] = _xyz; // this is the table_points
-  }
-  """ % (name, tup (0), tup (1), tup (2), 
-         name, tupw(0), tupw(1), tupw(2), tupw(3),
-         name, tupr(0), tupr(1), tupr(2),
-         name, name, name, name)
-
-kernel_normals_template = """
+# Which implementation of the kernels the module level functions use:
+#   'opencl': the kernels below, on the first OpenCL device
+#   'numpy':  opencl_numpy, which runs anywhere
+# Set BLOCKPLAYER_BACKEND to choose at import time, or call set_backend().
+# If OpenCL can't be set up we fall back to numpy.
+#
+# Nothing is set up at import time. The context is created, and the program
+# built, the first time a Buffers needs them.
+if not 'backend' in globals():
+    backend = os.environ.get('BLOCKPLAYER_BACKEND', 'opencl')
+    context = None
+    program = None
+    _init_lock = threading.RLock()
+
+# Compiled programs are cached here, keyed by a hash of the kernel source,
+# the build options and the device/driver, so only the first run on a machine
+# pays for the compile.
+cache_dir = os.environ.get('BLOCKPLAYER_CL_CACHE',
+                           os.path.expanduser('~/.blockplayer/clcache'))
+
+
+def setup_context():
+    global platform, device, context, queue, mf, sampler
+    with _init_lock:
+        if not context is None:
+            return
+        if cl is None:
+            raise ImportError('pyopencl is not installed')
+        platform = cl.get_platforms()[0]
+        device = platform.get_devices()[0]
+        queue = cl.CommandQueue(cl.Context(devices=[device]))
+        context = queue.context
+        mf = cl.mem_flags
+        sampler = cl.Sampler(context, True,
+                             cl.addressing_mode.CLAMP,
+                             cl.filter_mode.LINEAR)
+
+
+kernel_normals = """
 
 __constant float EPSILON = 1e-5;
 __constant float TAU = 6.2831853071;
@@ -144,8 +96,71 @@ inline float4 color_axis(float4 n)
   return cm;
 }
 
-// Normal kernels go here
-%s
+// A float16 holds a row-major 4x4 matrix
+inline float4 matmul3_16(const float16 mat, const float4 r1) {
+  return (float4)(dot(mat.s0123,r1),dot(mat.s4567,r1),dot(mat.s89ab,r1),0);
+}
+
+inline float4 matmul4_16(const float16 mat, const float4 r1) {
+  return (float4)(dot(mat.s0123,r1),dot(mat.s4567,r1),dot(mat.s89ab,r1),
+                  dot(mat.scdef,r1));
+}
+
+// The calibration comes in as arguments (see normal_matrices), so the
+// program doesn't depend on it and only has to be built once.
+kernel void normal_compute_ONE(
+	global float4 *output,
+	global float4 *xoutput,
+	global const float *filt,
+	global const float *raw,
+	global const char *mask,
+	const float4 bounds, const int offset,
+	const float16 mat, const float16 matw, const float16 matr
+)
+{
+  unsigned int x = get_global_id(0);
+  unsigned int y = get_global_id(1);
+  unsigned int width = get_global_size(0);
+  unsigned int height = get_global_size(1);
+  unsigned int index = (y * width) + x + offset;
+
+  if (x<1 || x>=width-1 || y<1 || y>=height-1 ||
+      !mask[index] || filt[index]<-1000) {
+     output[index] = (float4)(0);
+    xoutput[index] = (float4)(0);
+    return;
+  }
+  x += bounds.s0;
+  y += bounds.s1;
+
+  float dx = (filt[index+1] - filt[index-1])/2;
+  float dy = (filt[index+width] - filt[index-width])/2;
+
+  if (fabs(dx)+fabs(dy)>10) {
+     output[index] = (float4)(0);
+    xoutput[index] = (float4)(0);
+    return;
+  }
+
+  // Project the normal vector
+  float4  XYZW = (float4)(-dx, -dy, 1, -(-dx*x + -dy*y + filt[index]));
+  float4  xyz = matmul3_16(mat, XYZW);
+
+  //float4 xXYZW = (float4)(  x,   y, filt[index], 1);
+  float4 xXYZW = (float4)(  x,   y, raw[index], 1);
+
+  float4 _xyz = matmul4_16(matw, xXYZW);
+  _xyz /= _xyz.w;
+  xyz = normalize(xyz);
+  if (xyz.z < 0) xyz = -xyz;
+  float w = (xyz.z>0.1);
+  xyz.w = 1;
+  xyz = matmul3_16(matr, xyz);
+  xyz.w = w;
+
+  output[index] =  xyz; // this is the normals
+  xoutput[index] = _xyz; // this is the table_points
+}
 
 kernel void flatrot_compute(
 	global float4 *output,
@@ -252,24 +267,22 @@ kernel void lattice2_compute(
 }
 
 
-kernel void gridinds_compute(
-  global char4 *gridinds,
-  global const float4 *modelxyz,
-  const float xfix, const float zfix, 
+// The occupied voxel behind a face pixel, and the vacant one in front of it.
+// w holds the face label, or 0 if the voxel falls outside the grid.
+inline void gridinds_one(
+  const float4 xyzf, const float xfix, const float zfix,
   const float LW, const float LH,
-  const float4 gridmin, const float4 gridmax
+  const float4 gridmin, const float4 gridmax,
+  float4 *occ_, float4 *vac_
 )
 {
-  unsigned int index = get_global_id(0);
-
-  float4 xyzf = modelxyz[index];
   unsigned int asdf = as_uint(xyzf.w);
   float4 cxyz_;
-  cxyz_.x = (asdf & 0xFF) - 1.0;
-  cxyz_.y = ((asdf >>  8) & 0xFF) - 1.0;
-  cxyz_.z = ((asdf >> 16) & 0xFF) - 1.0;
+  cxyz_.x = (asdf & 0xFF) - 1.0f;
+  cxyz_.y = ((asdf >>  8) & 0xFF) - 1.0f;
+  cxyz_.z = ((asdf >> 16) & 0xFF) - 1.0f;
 
-  float4 f1 = cxyz_ * 0.5;
+  float4 f1 = cxyz_ * 0.5f;
   float4 fix = (float4)(xfix,0,zfix,0);  
   float4 mod = (float4)(LW,LH,LW,1);
 
@@ -287,233 +300,516 @@ kernel void gridinds_compute(
   if (vac.x >= (gridmax.x-gridmin.x-1) ||
       vac.y >= (gridmax.y-gridmin.y-1) ||
       vac.z >= (gridmax.z-gridmin.z-1)) vac.w = 0;
-  
+
+  *occ_ = occ;
+  *vac_ = vac;
+}
+
+
+kernel void gridinds_compute(
+  global char4 *gridinds,
+  global const float4 *modelxyz,
+  const float xfix, const float zfix, 
+  const float LW, const float LH,
+  const float4 gridmin, const float4 gridmax
+)
+{
+  unsigned int index = get_global_id(0);
+  float4 occ, vac;
+  gridinds_one(modelxyz[index], xfix, zfix, LW, LH, gridmin, gridmax,
+               &occ, &vac);
   gridinds[2*index+0] = convert_char4(occ);
   gridinds[2*index+1] = convert_char4(vac);
 }
+
+
+// Same as gridinds_compute followed by speedup_cy.occvac, without the
+// gridinds ever leaving the device: each pixel bumps the counters of its
+// two voxels. Run occvac_finish afterwards.
+kernel void occvac_compute(
+  global uint *occ_count,
+  global uint *vac_count,
+  global const float4 *modelxyz,
+  const float xfix, const float zfix, 
+  const float LW, const float LH,
+  const float4 gridmin, const float4 gridmax
+)
+{
+  unsigned int index = get_global_id(0);
+  float4 occ, vac;
+  gridinds_one(modelxyz[index], xfix, zfix, LW, LH, gridmin, gridmax,
+               &occ, &vac);
+
+  int wy = gridmax.y-gridmin.y;
+  int wz = gridmax.z-gridmin.z;
+  int4 o = convert_int4(occ);
+  int4 v = convert_int4(vac);
+  if (o.w != 0) atomic_inc(&occ_count[o.x*wy*wz + o.y*wz + o.z]);
+  if (v.w != 0) atomic_inc(&vac_count[v.x*wy*wz + v.y*wz + v.z]);
+}
+
+
+// One work item per voxel. Keeps the voxels counted more than threshold
+// times, like speedup_cy.occvac (whose counters saturate just past it; the
+// counts here are uints, which can't overflow). The counters are cleared
+// for the next frame.
+kernel void occvac_finish(
+  global uchar *occ,
+  global uchar *vac,
+  global uint *occ_count,
+  global uint *vac_count,
+  const uint threshold
+)
+{
+  unsigned int index = get_global_id(0);
+  occ[index] = occ_count[index] > threshold;
+  vac[index] = vac_count[index] > threshold;
+  occ_count[index] = 0;
+  vac_count[index] = 0;
+}
 """
 
 
-def setup_kernel(mats=None):
-    if mats is None:
-        mats = (np.ascontiguousarray(np.linalg.inv(calibkinect.projection())),
-                np.eye(4))
+def default_mats():
+    return (np.ascontiguousarray(np.linalg.inv(calibkinect.projection())),
+            np.eye(4))
 
-    KK, RT = mats
 
-    kernel_normals = kernel_normals_template % (
-        normal_maker('ONE',
-                     np.linalg.inv(KK).transpose(),
-                     np.dot(RT, KK),
-                     np.linalg.inv(RT).transpose()),
-        )
-    
+def normal_matrices(mats):
+    """The matrices normal_compute_ONE takes, given the calibration
+    (KK, Ktable), each flattened into a float16."""
+    KK, RT = mats
+    return [np.ascontiguousarray(m, dtype='f').reshape(16)
+            for m in (np.linalg.inv(KK).transpose(),
+                      np.dot(RT, KK),
+                      np.linalg.inv(RT).transpose())]
+
+
+def cache_key(source, options):
+    import hashlib
+    h = hashlib.sha1()
+    h.update(source)
+    h.update(options)
+    for info in (platform.version, device.name, device.vendor,
+                 device.version, device.driver_version):
+        h.update(info)
+    return h.hexdigest()
+
+
+def build_program(source=kernel_normals, options="-cl-mad-enable"):
+    """Build the program, or load it from the binary cache in cache_dir."""
+    setup_context()
+    path = os.path.join(cache_dir, '%s.bin' % cache_key(source, options))
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                binary = f.read()
+            return cl.Program(context, [device], [binary]).build(options)
+        except (IOError, cl.Error):
+            # Stale or corrupt, build it again below
+            pass
+
+    prog = cl.Program(context, source).build(options)
+    log = prog.get_build_info(device, cl.program_build_info.LOG).strip()
+    if log:
+        print log
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Write under a temporary name first, so a concurrent process
+        # never reads half a binary
+        tmp = '%s.%d' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(prog.get_info(cl.program_info.BINARIES)[0])
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        print "Couldn't cache the opencl program in [%s]: %s" % (cache_dir, e)
+    return prog
+
+
+def get_program():
+    """The program, built the first time it's needed."""
     global program
-    program = cl.Program(context, kernel_normals).build("-cl-mad-enable")
+    with _init_lock:
+        if program is None:
+            program = build_program()
+    return program
+
+
+def setup_kernel(mats=None):
+    """Set the calibration (KK, Ktable) used by the Buffers that weren't
+    given their own. This is cheap: the matrices are kernel arguments."""
+    global kernel_mats
+    kernel_mats = default_mats() if mats is None else mats
+if not 'kernel_mats' in globals():
+    setup_kernel()
+
+
+def resolve_backend():
+    """Settle on a backend the first time one is needed: opencl if there is a
+    device to run it on, numpy otherwise."""
+    global backend
+    with _init_lock:
+        if backend == 'opencl':
+            try:
+                setup_context()
+            except Exception as e:
+                print "OpenCL is not available (%s), using numpy" % e
+                backend = 'numpy'
+    return backend
 
-    # I have no explanation for this workaround. Presumably it's fixed in 
-    # another version of pyopencl. Wtf. Getting the kernel like this
-    # makes it go much faster when we __call__ it.
-    def workaround(self):
-        return self
-    cl.Kernel.workaround = workaround
-    program.flatrot_compute = program.flatrot_compute.workaround()
-    program.normal_compute_ONE = program.normal_compute_ONE.workaround()
-    program.lattice2_compute = program.lattice2_compute.workaround()
-    program.float4_sum = program.float4_sum.workaround()
-    program.gridinds_compute = program.gridinds_compute.workaround()
-setup_kernel()
 
-print program.get_build_info(context.devices[0], cl.program_build_info.LOG)
+def set_backend(name):
+    """Switch the module level functions (and Trackers created afterwards)
+    to the 'opencl' or the 'numpy' implementation of the kernels."""
+    assert name in ('opencl', 'numpy'), name
+    global backend, _default
+    if name == 'opencl':
+        setup_context()
+    backend = name
+    _default = None
 
 
 def print_all():
+  setup_context()
   print_info(context.devices[0], cl.device_info)
-  print_info(program, cl.program_info)
+  print_info(get_program(), cl.program_info)
   print_info(program.normal_compute, cl.kernel_info)
   print_info(queue, cl.command_queue_info)
 
 
 #print_all()
-mask_buf    = cl.Buffer(context, mf.READ_WRITE, 480*640)
-
-normals_buf = cl.Buffer(context, mf.READ_WRITE, 480*640*4*4)
-xyz_buf     = cl.Buffer(context, mf.READ_WRITE, 480*640*4*4)
-filt_buf    = cl.Buffer(context, mf.READ_WRITE, 480*640*4)
-raw_buf     = cl.Buffer(context, mf.READ_WRITE, 480*640*4)
-
-qxdyqz_buf  = cl.Buffer(context, mf.READ_WRITE, 480*640*4*4)
-
-face_buf    = cl.Buffer(context, mf.READ_WRITE, 480*640*4*4)
-qxqz_buf    = cl.Buffer(context, mf.READ_WRITE, 480*640*4*4)
-model_buf   = cl.Buffer(context, mf.READ_WRITE, 480*640*4*4)
+class Buffers(object):
+  """Device buffers, command queue and kernels for one stream of frames.
+
+  Everything that changes from frame to frame (the rect, the intermediate
+  normals/xyz/gridinds results) lives here rather than in the module, so
+  several trackers can share one OpenCL context. Kernel objects hold their
+  arguments between set_args and enqueue, so each instance also gets its own.
+
+  The module level functions (set_rect, compute_normals, ...) operate on
+  default_buffers(). opencl_numpy.Buffers has the same interface for the
+  numpy backend; use make_buffers() to get whichever is selected.
+
+  Params:
+      mats: (KK, Ktable) calibration for this stream. If None, whatever
+            was last passed to setup_kernel is used.
+  """
+  def __init__(self, mats=None):
+    setup_context()
+    self.queue = cl.CommandQueue(context)
+    self.rect = None
+    self.length = None
+    self.mats = mats
+    self._kernels = {}
+    self._matrices = None
+    self._matrices_for = None
+    self._grid_shape = None
+
+    self.capacity = 0
+    self._allocate(480*640)
+
+    self.reduce_buf    = cl.Buffer(context, mf.READ_WRITE, 8*4*100)
+    self.reduce_scratch = cl.LocalMemory(64*8*4)
+
+  def _allocate(self, N):
+    # Per-pixel buffers, for rects of up to N pixels. They start out at the
+    # size of a kinect frame, and set_rect grows them for bigger images
+    self.mask_buf    = cl.Buffer(context, mf.READ_WRITE, N)
+
+    self.normals_buf = cl.Buffer(context, mf.READ_WRITE, N*4*4)
+    self.xyz_buf     = cl.Buffer(context, mf.READ_WRITE, N*4*4)
+    self.filt_buf    = cl.Buffer(context, mf.READ_WRITE, N*4)
+    self.raw_buf     = cl.Buffer(context, mf.READ_WRITE, N*4)
+
+    self.qxdyqz_buf  = cl.Buffer(context, mf.READ_WRITE, N*4*4)
+
+    self.face_buf    = cl.Buffer(context, mf.READ_WRITE, N*4*4)
+    self.qxqz_buf    = cl.Buffer(context, mf.READ_WRITE, N*4*4)
+    self.model_buf   = cl.Buffer(context, mf.READ_WRITE, N*4*4)
+
+    self.gridinds_buf = cl.Buffer(context, mf.READ_WRITE, N*4*2)
+    self.capacity = N
+
+  def kernel(self, name):
+    if not name in self._kernels:
+      self._kernels[name] = cl.Kernel(get_program(), name)
+    return self._kernels[name]
+
+  def matrices(self):
+    mats = kernel_mats if self.mats is None else self.mats
+    if not self._matrices_for is mats:
+      self._matrices = normal_matrices(mats)
+      self._matrices_for = mats
+    return self._matrices
+
+  def set_rect(self, rect):
+    self.rect = rect
+    (L,T),(R,B) = rect;
+    self.length = (B-T)*(R-L)
+    if self.length > self.capacity:
+      self._allocate(self.length)
+
+  def load_mask(self, mask):
+    (L,T),(R,B) = self.rect
+    assert mask.dtype == np.uint8
+    assert mask.shape[0] == B-T
+    assert mask.shape[1] == R-L
+    return cl.enqueue_write_buffer(self.queue, self.mask_buf, mask,
+                                   is_blocking=False)
+
+  def load_raw(self, depth):
+    (L,T),(R,B) = self.rect
+    assert depth.dtype == np.float32
+    assert depth.shape[0] == B-T 
+    assert depth.shape[1] == R-L
+    return cl.enqueue_write_buffer(self.queue, self.raw_buf, depth,
+                                   is_blocking=False)
+
+  def load_filt(self, filt):
+    (L,T),(R,B) = self.rect
+    assert filt.dtype == np.float32
+    assert filt.shape[0] == B-T 
+    assert filt.shape[1] == R-L
+    return cl.enqueue_write_buffer(self.queue, self.filt_buf, filt,
+                                   is_blocking=False)
+
+  def get_xyz(self):
+    xyz = np.empty((self.length,4),'f')
+    cl.enqueue_read_buffer(self.queue, self.xyz_buf, xyz).wait()
+    return xyz
+
+  def get_normals(self):
+    (L,T),(R,B) = self.rect
+    normals = np.empty((self.length,4), 'f')
+    cl.enqueue_read_buffer(self.queue, self.normals_buf, normals).wait()
+    return normals.reshape(T-B,R-L,4)
+
+  def get_flatrot(self):
+    qxdyqz = np.empty((self.length,4),'f')
+    cl.enqueue_read_buffer(self.queue, self.qxdyqz_buf, qxdyqz).wait()
+    return qxdyqz
+
+  def get_modelxyz(self):
+    model   = np.empty((self.length,4),'f')
+    cl.enqueue_read_buffer(self.queue, self.model_buf, model).wait()
+    return model
+
+  def get_face_debug(self):
+    (L,T),(R,B) = self.rect
+
+    face = np.empty((self.length,4), 'f')
+    cl.enqueue_read_buffer(self.queue, self.face_buf, face).wait()
+
+    _,_,_,face_ = np.rollaxis(self.get_modelxyz(),1)
+    cxyz_ = np.frombuffer(np.array(face_).data,
+                          dtype='i1').reshape(-1,4)
 
-gridinds_buf = cl.Buffer(context, mf.READ_WRITE, 480*640*4*2)
+    return (face.reshape(T-B,R-L,4),
+            cxyz_.reshape(T-B,R-L,4))
 
-#debug_buf     = cl.Buffer(context, mf.READ_WRITE, 480*640*4*4)
-reduce_buf    = cl.Buffer(context, mf.READ_WRITE, 8*4*100)
-reduce_scratch = cl.LocalMemory(64*8*4)
+  def get_gridinds_debug(self):
+    (L,T),(R,B) = self.rect
+    return self.get_gridinds().reshape(T-B,R-L,2,4)
+
+  def get_gridinds(self):
+    gridinds = np.empty((self.length,2,4), 'i1')
+    cl.enqueue_read_buffer(self.queue, self.gridinds_buf, gridinds).wait()
+    return gridinds
+
+  def compute_normals(self):
+    (L,T),(R,B) = self.rect; bounds = np.array((L,T,R,B),'f')
+
+    mat, matw, matr = self.matrices()
+    kernel = self.kernel('normal_compute_ONE')
+    evt = kernel(self.queue, (R-L,B-T), None,
+                 self.normals_buf, self.xyz_buf,
+                 self.filt_buf, self.raw_buf, self.mask_buf,
+                 bounds, np.int32(0),  # offset unused (0)
+                 mat, matw, matr)
+    return evt
+
+  def compute_flatrot(self, mat):
+    assert mat.dtype == np.float32
+    assert mat.shape == (3,4)
+
+    def f(m): return m.astype('f')
+
+    evt = self.kernel('flatrot_compute')(self.queue, (self.length,), None,
+      self.qxdyqz_buf, self.normals_buf,
+      f(mat[0,:]), f(mat[1,:]), f(mat[2,:]))
+    return evt
+
+  def compute_lattice2(self, modelmat, modulo):
+    assert modelmat.dtype == np.float32
+    assert modelmat.shape == (3,4)
+
+    def f(m): return m.astype('f')
+
+    evt = self.kernel('lattice2_compute')(self.queue, (self.length,), None,
+      self.face_buf, self.qxqz_buf, self.model_buf,
+      self.normals_buf, self.xyz_buf, np.float32(1.0/modulo),
+      f(modelmat[0,:]), f(modelmat[1,:]), f(modelmat[2,:]))
+    return evt
+
+  def compute_gridinds(self, xfix, zfix, LW, LH, gridmin, gridmax):
+    # The model x and z coordinates from the lattice2 step are off by the
+    # translation component found in that stage. Pass them along here.
+    assert gridmin.shape == (4,)
+    assert gridmin.dtype == np.float32
+    assert gridmin[3] == 0
+    assert gridmax.shape == (4,)
+    assert gridmax.dtype == np.float32
+    assert gridmax[3] == 0
+
+    evt = self.kernel('gridinds_compute')(self.queue, (self.length,), None,
+      self.gridinds_buf, self.model_buf,
+      np.float32(xfix), np.float32(zfix),
+      np.float32(LW), np.float32(LH),
+      gridmin, gridmax)
+    return evt
+
+  def _grid_buffers(self, shape):
+    # Sized for the grid, which only changes if config.bounds does
+    if not self._grid_shape == shape:
+      size = int(np.prod(shape))
+      zeros = np.zeros(size, 'u4')
+      self.occ_count_buf = cl.Buffer(context, mf.READ_WRITE|mf.COPY_HOST_PTR,
+                                     hostbuf=zeros)
+      self.vac_count_buf = cl.Buffer(context, mf.READ_WRITE|mf.COPY_HOST_PTR,
+                                     hostbuf=zeros)
+      self.occ_buf = cl.Buffer(context, mf.READ_WRITE, size)
+      self.vac_buf = cl.Buffer(context, mf.READ_WRITE, size)
+      self._grid_shape = shape
+
+  def compute_occvac(self, xfix, zfix, LW, LH, gridmin, gridmax,
+                     threshold=30):
+    """Histogram the grid indices (see compute_gridinds) into the occupancy
+    and vacancy grids, on the device. Voxels seen by more than threshold
+    pixels are kept. Read them with get_occvac()."""
+    assert gridmin.shape == (4,)
+    assert gridmin.dtype == np.float32
+    assert gridmin[3] == 0
+    assert gridmax.shape == (4,)
+    assert gridmax.dtype == np.float32
+    assert gridmax[3] == 0
+
+    shape = tuple(int(w) for w in (gridmax-gridmin)[:3])
+    self._grid_buffers(shape)
+    self.kernel('occvac_compute')(self.queue, (self.length,), None,
+      self.occ_count_buf, self.vac_count_buf, self.model_buf,
+      np.float32(xfix), np.float32(zfix),
+      np.float32(LW), np.float32(LH),
+      gridmin, gridmax)
+    evt = self.kernel('occvac_finish')(self.queue, (int(np.prod(shape)),),
+      None, self.occ_buf, self.vac_buf,
+      self.occ_count_buf, self.vac_count_buf, np.uint32(threshold))
+    return evt
+
+  def get_occvac(self):
+    occ = np.empty(self._grid_shape, 'u1')
+    vac = np.empty(self._grid_shape, 'u1')
+    cl.enqueue_read_buffer(self.queue, self.occ_buf, occ)
+    cl.enqueue_read_buffer(self.queue, self.vac_buf, vac).wait()
+    return occ.astype('bool'), vac.astype('bool')
+
+  def _float4_sum(self, buf):
+    sums = np.empty((8,4),'f')
+    self.kernel('float4_sum')(self.queue, (64*8,), (64,),
+      self.reduce_buf, self.reduce_scratch,
+      buf, np.int32(self.length))
+    cl.enqueue_read_buffer(self.queue, self.reduce_buf, sums).wait()
+    return sums.sum(0)
+
+  def reduce_flatrot(self):
+    return self._float4_sum(self.qxdyqz_buf)
+
+  def reduce_lattice2(self):
+    qxqz = self._float4_sum(self.qxqz_buf)
+    cxcz = self._float4_sum(self.face_buf)
+    return cxcz,qxqz
+
+
+if not '_default' in globals():
+  _default = None
+
+
+def make_buffers(mats=None):
+  """A new Buffers (see above) for the selected backend."""
+  if resolve_backend() == 'numpy':
+    import opencl_numpy
+    return opencl_numpy.Buffers(mats)
+  return Buffers(mats)
+
+
+def default_buffers():
+  """The Buffers instance used by the module level functions."""
+  global _default
+  if _default is None:
+    _default = make_buffers()
+  return _default
 
 
 def set_rect(_rect):
-  global rect
-  rect = _rect
-  (L,T),(R,B) = rect;
-  global length
-  length = (B-T)*(R-L)
-  assert length <= 480*640
+  default_buffers().set_rect(_rect)
 
 
 def load_mask(mask):
-  (L,T),(R,B) = rect
-  assert mask.dtype == np.uint8
-  assert mask.shape[0] == B-T
-  assert mask.shape[1] == R-L
-  return cl.enqueue_write_buffer(queue, mask_buf, mask, is_blocking=False)
+  return default_buffers().load_mask(mask)
 
 
 def load_raw(depth):
-  (L,T),(R,B) = rect
-  assert depth.dtype == np.float32
-  assert depth.shape[0] == B-T 
-  assert depth.shape[1] == R-L
-  return cl.enqueue_write_buffer(queue, raw_buf, depth, is_blocking=False)
+  return default_buffers().load_raw(depth)
 
 
 def load_filt(filt):
-  (L,T),(R,B) = rect
-  assert filt.dtype == np.float32
-  assert filt.shape[0] == B-T 
-  assert filt.shape[1] == R-L
-  return cl.enqueue_write_buffer(queue, filt_buf, filt, is_blocking=False)
+  return default_buffers().load_filt(filt)
+
 
-  
 def get_xyz():
-  xyz = np.empty((length,4),'f')
-  cl.enqueue_read_buffer(queue, xyz_buf, xyz).wait()
-  return xyz
-  
+  return default_buffers().get_xyz()
+
 def get_normals():
-  (L,T),(R,B) = rect
-  normals = np.empty((length,4), 'f')
-  cl.enqueue_read_buffer(queue, normals_buf, normals).wait()
-  return normals.reshape(T-B,R-L,4)
+  return default_buffers().get_normals()
 
 def get_flatrot():
-  qxdyqz = np.empty((length,4),'f')
-  cl.enqueue_read_buffer(queue, qxdyqz_buf, qxdyqz).wait()
-  return qxdyqz
-  
+  return default_buffers().get_flatrot()
+
 def get_modelxyz():
-  model   = np.empty((length,4),'f')
-  cl.enqueue_read_buffer(queue, model_buf, model).wait()
-  return model
+  return default_buffers().get_modelxyz()
 
 def get_face_debug():
-    (L,T),(R,B) = rect
-  
-    face = np.empty((length,4), 'f')
-    cl.enqueue_read_buffer(queue, face_buf, face).wait()
-
-    _,_,_,face_ = np.rollaxis(get_modelxyz(),1)
-    cxyz_ = np.frombuffer(np.array(face_).data,
-                          dtype='i1').reshape(-1,4)
-
-    return (face.reshape(T-B,R-L,4),         
-            cxyz_.reshape(T-B,R-L,4))
-       
+  return default_buffers().get_face_debug()
 
 def get_gridinds_debug():
-    (L,T),(R,B) = rect
-    gridinds = np.empty((length,2,4), 'i1')
-    cl.enqueue_read_buffer(queue, gridinds_buf, gridinds).wait()
-    return gridinds.reshape(T-B,R-L,2,4)
+  return default_buffers().get_gridinds_debug()
 
 def get_gridinds():
-  gridinds = np.empty((length,2,4), 'i1')
-  cl.enqueue_read_buffer(queue, gridinds_buf, gridinds).wait()
-  return gridinds
+  return default_buffers().get_gridinds()
 
 def compute_normals():
-  (L,T),(R,B) = rect; bounds = np.array((L,T,R,B),'f')
-
-  kernel = program.normal_compute_ONE
-  evt = kernel(queue, (R-L,B-T), None, normals_buf, xyz_buf,
-               filt_buf, raw_buf, mask_buf,
-               bounds, np.int32(0))  # offset unused (0)
-  #import main
-  #if main.WAIT_COMPUTE: evt.wait()
-  return evt
+  return default_buffers().compute_normals()
 
 def compute_flatrot(mat):
-  assert mat.dtype == np.float32
-  assert mat.shape == (3,4)
+  return default_buffers().compute_flatrot(mat)
 
-  def f(m): return m.astype('f')
-  
-  evt = program.flatrot_compute(queue, (length,), None,
-    qxdyqz_buf, normals_buf, f(mat[0,:]), f(mat[1,:]), f(mat[2,:]))
-  
-  #import main
-  #if main.WAIT_COMPUTE: evt.wait()
-  return evt
-  
 def compute_lattice2(modelmat, modulo):
-  assert modelmat.dtype == np.float32
-  assert modelmat.shape == (3,4)
+  return default_buffers().compute_lattice2(modelmat, modulo)
 
-  def f(m): return m.astype('f')
-  
-  evt = program.lattice2_compute(queue, (length,), None, 
-    face_buf, qxqz_buf, model_buf,
-    normals_buf, xyz_buf, np.float32(1.0/modulo),
-    f(modelmat[0,:]), f(modelmat[1,:]), f(modelmat[2,:]))
-
-  #import main
-  #if main.WAIT_COMPUTE: evt.wait()
-  return evt
-  
 def compute_gridinds(xfix, zfix, LW, LH, gridmin, gridmax):
-  # The model x and z coordinates from the lattice2 step are off by the
-  # translation component found in that stage. Pass them along here.
-  assert gridmin.shape == (4,)
-  assert gridmin.dtype == np.float32
-  assert gridmin[3] == 0
-  assert gridmax.shape == (4,)
-  assert gridmax.dtype == np.float32
-  assert gridmax[3] == 0
-  
-  evt = program.gridinds_compute(queue, (length,), None,
-    gridinds_buf, model_buf,
-    np.float32(xfix), np.float32(zfix), 
-    np.float32(LW), np.float32(LH), 
-    gridmin, gridmax)
-    
-  #import main
-  #if main.WAIT_COMPUTE: evt.wait()
-  return evt  
+  return default_buffers().compute_gridinds(xfix, zfix, LW, LH,
+                                            gridmin, gridmax)
+
+def compute_occvac(xfix, zfix, LW, LH, gridmin, gridmax, threshold=30):
+  return default_buffers().compute_occvac(xfix, zfix, LW, LH,
+                                          gridmin, gridmax, threshold)
+
+def get_occvac():
+  return default_buffers().get_occvac()
 
 def reduce_flatrot():
-  sums = np.empty((8,4),'f')  
-  evt = program.float4_sum(queue, (64*8,), (64,), 
-    reduce_buf, reduce_scratch, 
-    qxdyqz_buf, np.int32(length))
-  cl.enqueue_read_buffer(queue, reduce_buf, sums).wait()
-  return sums.sum(0)
-    
-def reduce_lattice2():
-  sums = np.empty((8,4),'f') 
-  
-  evt = program.float4_sum(queue, (64*8,), (64,), 
-    reduce_buf, reduce_scratch, 
-    qxqz_buf, np.int32(length))
-  cl.enqueue_read_buffer(queue, reduce_buf, sums).wait()
-  qxqz = sums.sum(0)  
-  
-  evt = program.float4_sum(queue, (64*8,), (64,), 
-    reduce_buf, reduce_scratch, 
-    face_buf, np.int32(length))
-  cl.enqueue_read_buffer(queue, reduce_buf, sums).wait()
-  cxcz = sums.sum(0)
+  return default_buffers().reduce_flatrot()
 
-  return cxcz,qxqz
+def reduce_lattice2():
+  return default_buffers().reduce_lattice2()
@@ -0,0 +1,323 @@
+# Andrew Miller <amiller@cs.ucf.edu> 2011
+#
+# BlockPlayer - 3D model reconstruction using the Lattice-First algorithm
+# See:
+#    "Interactive 3D Model Acquisition and Tracking of Building Block Structures"
+#    Andrew Miller, Brandyn White, Emiko Charbonneau, Zach Kanzler, and Joseph J. LaViola Jr.
+#    IEEE VR 2012, IEEE TVGC 2012
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Numpy versions of the kernels in opencl.py, for machines without an OpenCL
+# device. Buffers here has the same interface as opencl.Buffers, and is
+# selected with opencl.set_backend('numpy') (or BLOCKPLAYER_BACKEND=numpy).
+# Each compute_* follows its kernel line for line, including the memory
+# layout of the outputs, so get_modelxyz() and get_gridinds() can be read
+# the same way as on the device.
+import numpy as np
+
+TAU = 6.2831853071
+CLIM = 0.9486
+
+# lattice2_compute packs the face labels into the w component of modelxyz,
+# as_float((char4)1) is what it writes for pixels without a normal.
+_ONES = np.array([1,1,1,1],'u1').view('f')[0]
+
+
+class _Event(object):
+  """Stands in for a pyopencl event. Everything here runs synchronously."""
+  def wait(self):
+    pass
+
+
+class Buffers(object):
+  """Host arrays standing in for the device buffers in opencl.Buffers. They
+  are allocated at the size of a kinect frame (and grown by set_rect for
+  bigger images), and each frame works in the first `length` entries.
+
+  Params:
+      mats: (KK, Ktable) to use for normal_compute. If None, the calibration
+            last passed to opencl.setup_kernel is used.
+  """
+  def __init__(self, mats=None):
+    self.rect = None
+    self.length = None
+    self._mats = mats
+    self._matrices = None
+    self._matrices_for = None
+
+    self.capacity = 0
+    self._allocate(480*640)
+
+  def _allocate(self, N):
+    self.mask_buf    = np.zeros(N, 'u1')
+    self.filt_buf    = np.zeros(N, 'f')
+    self.raw_buf     = np.zeros(N, 'f')
+
+    self.normals_buf = np.zeros((N,4), 'f')
+    self.xyz_buf     = np.zeros((N,4), 'f')
+
+    self.qxdyqz_buf  = np.zeros((N,4), 'f')
+
+    self.face_buf    = np.zeros((N,4), 'f')
+    self.qxqz_buf    = np.zeros((N,4), 'f')
+    self.model_buf   = np.zeros((N,4), 'f')
+
+    self.gridinds_buf = np.zeros((N,2,4), 'i1')
+
+    # Scratch space, reused from frame to frame
+    self._dxyz = np.zeros((N,3), 'f')
+    self._cxyz = np.zeros((N,3), 'f')
+    self._inds = np.zeros((N,2,3), 'f')
+    self.capacity = N
+
+  def _labels(self):
+    # The bytes of the w component of model_buf, where the labels live
+    return self.model_buf.view('u1').reshape(-1,16)[:self.length,12:]
+
+  def matrices(self):
+    """The three matrices normal_compute_ONE takes (see opencl.normal_matrices)."""
+    mats = self._mats
+    if mats is None:
+      import opencl
+      mats = opencl.kernel_mats
+    if not self._matrices_for is mats:
+      KK, RT = mats
+      self._matrices = (np.linalg.inv(KK).transpose().astype('f'),
+                        np.dot(RT, KK).astype('f'),
+                        np.linalg.inv(RT).transpose().astype('f'))
+      self._matrices_for = mats
+    return self._matrices
+
+  def set_rect(self, rect):
+    self.rect = rect
+    (L,T),(R,B) = rect;
+    self.length = (B-T)*(R-L)
+    if self.length > self.capacity:
+      self._allocate(self.length)
+
+  def _shape(self):
+    (L,T),(R,B) = self.rect
+    return B-T, R-L
+
+  def load_mask(self, mask):
+    (L,T),(R,B) = self.rect
+    assert mask.dtype == np.uint8
+    assert mask.shape[0] == B-T
+    assert mask.shape[1] == R-L
+    self.mask_buf[:self.length] = mask.reshape(-1)
+    return _Event()
+
+  def load_raw(self, depth):
+    (L,T),(R,B) = self.rect
+    assert depth.dtype == np.float32
+    assert depth.shape[0] == B-T
+    assert depth.shape[1] == R-L
+    self.raw_buf[:self.length] = depth.reshape(-1)
+    return _Event()
+
+  def load_filt(self, filt):
+    (L,T),(R,B) = self.rect
+    assert filt.dtype == np.float32
+    assert filt.shape[0] == B-T
+    assert filt.shape[1] == R-L
+    self.filt_buf[:self.length] = filt.reshape(-1)
+    return _Event()
+
+  def get_xyz(self):
+    return self.xyz_buf[:self.length].copy()
+
+  def get_normals(self):
+    return self.normals_buf[:self.length].reshape(self._shape()+(4,)).copy()
+
+  def get_flatrot(self):
+    return self.qxdyqz_buf[:self.length].copy()
+
+  def get_modelxyz(self):
+    return self.model_buf[:self.length].copy()
+
+  def get_face_debug(self):
+    shape = self._shape()
+    face = self.face_buf[:self.length].reshape(shape+(4,)).copy()
+    cxyz_ = self._labels().view('i1').copy()
+    return face, cxyz_.reshape(shape+(4,))
+
+  def get_gridinds_debug(self):
+    return self.get_gridinds().reshape(self._shape()+(2,4))
+
+  def get_gridinds(self):
+    return self.gridinds_buf[:self.length].copy()
+
+  def compute_normals(self):
+    (L,T),(R,B) = self.rect
+    height, width = self._shape()
+    mat, matw, matr = self.matrices()
+
+    filt = self.filt_buf[:self.length].reshape(height, width)
+    raw = self.raw_buf[:self.length].reshape(height, width)
+    mask = self.mask_buf[:self.length].reshape(height, width)
+    output = self.normals_buf[:self.length].reshape(height, width, 4)
+    xoutput = self.xyz_buf[:self.length].reshape(height, width, 4)
+    output[:] = 0
+    xoutput[:] = 0
+
+    # Central differences on the interior, the border stays zero
+    dx = (filt[1:-1,2:] - filt[1:-1,:-2])/2
+    dy = (filt[2:,1:-1] - filt[:-2,1:-1])/2
+    f = filt[1:-1,1:-1]
+    ok = ((mask[1:-1,1:-1] != 0) & ~(f < -1000) &
+          ~(np.abs(dx)+np.abs(dy) > 10))
+    y, x = np.nonzero(ok)
+    dx, dy, f = dx[y,x], dy[y,x], f[y,x]
+    r = raw[1:-1,1:-1][y,x]
+    y += 1; x += 1
+    index = y*width + x
+    x = (x + L).astype('f')
+    y = (y + T).astype('f')
+
+    # Project the normal vector
+    XYZW = (-dx, -dy, np.ones_like(dx), -(-dx*x + -dy*y + f))
+    xyz = [sum(mat[i,j]*XYZW[j] for j in range(4)) for i in range(3)]
+
+    xXYZW = (x, y, r, np.ones_like(r))
+    _xyz = [sum(matw[i,j]*xXYZW[j] for j in range(4)) for i in range(4)]
+    _w = 1/_xyz[3]
+
+    norm = 1/np.sqrt(xyz[0]*xyz[0] + xyz[1]*xyz[1] + xyz[2]*xyz[2])
+    norm[xyz[2] < 0] *= -1
+    xyz = [c*norm for c in xyz] + [np.ones_like(norm)]
+    w = xyz[2] > 0.1
+
+    normals = self.normals_buf[:self.length]
+    xyzs = self.xyz_buf[:self.length]
+    for i in range(3):
+      normals[index,i] = sum(matr[i,j]*xyz[j] for j in range(4))
+      xyzs[index,i] = _xyz[i]*_w
+    normals[index,3] = w
+    xyzs[index,3] = 1
+    return _Event()
+
+  def compute_flatrot(self, mat):
+    assert mat.dtype == np.float32
+    assert mat.shape == (3,4)
+
+    n = self.normals_buf[:self.length]
+    d = self._dxyz[:self.length]
+    np.dot(n, mat.transpose(), out=d)
+    dx, dy, dz = d[:,0], d[:,1], d[:,2]
+
+    output = self.qxdyqz_buf[:self.length]
+    output[:,1] = 0
+    output[:,3] = (n[:,3] != 0) & (dy < 0.3)
+    output[:,0] = (dx*dx*dx*dx - 6*dx*dx*dz*dz + dz*dz*dz*dz)*output[:,3]
+    output[:,2] = (4*dz*dx*dx*dx - 4*dz*dz*dz*dx)*output[:,3]
+    return _Event()
+
+  def compute_lattice2(self, modelmat, modulo):
+    assert modelmat.dtype == np.float32
+    assert modelmat.shape == (3,4)
+    modulo = np.float32(1.0/modulo)
+
+    norm = self.normals_buf[:self.length]
+    xyz = self.xyz_buf[:self.length]
+    valid = norm[:,3] != 0
+
+    # Project the depth image, and the normals
+    modelxyz = self.model_buf[:self.length]
+    np.dot(xyz, modelmat.transpose(), out=self._dxyz[:self.length])
+    modelxyz[:,:3] = self._dxyz[:self.length]
+    d = self._dxyz[:self.length]
+    np.dot(norm[:,:3], modelmat[:,:3].transpose(), out=d)
+
+    # Threshold the normals and pack it into one number as a label
+    cxyz_ = self._cxyz[:self.length]
+    cxyz_[:] = d <= -CLIM
+    cxyz_ += d <= CLIM
+    cxyz_ -= 1
+    cxyz_[~valid] = 0
+    label = self._labels()
+    label[:,:3] = cxyz_+1
+    label[:,3] = 1
+
+    face_label = self.face_buf[:self.length]
+    face_label[:,:3] = cxyz_ != 0
+    face_label[:,3] = 0
+
+    # Finally do the trig functions
+    qx2z2 = self.qxqz_buf[:self.length]
+    X = modelxyz[:,0] * modulo * TAU
+    Z = modelxyz[:,2] * modulo * TAU
+    qx2z2[:,0] = np.cos(X) * face_label[:,0]
+    qx2z2[:,1] = np.sin(X) * face_label[:,0]
+    qx2z2[:,2] = np.cos(Z) * face_label[:,2]
+    qx2z2[:,3] = np.sin(Z) * face_label[:,2]
+
+    modelxyz[~valid,:3] = 0
+    modelxyz[~valid,3] = _ONES
+    return _Event()
+
+  def compute_gridinds(self, xfix, zfix, LW, LH, gridmin, gridmax):
+    assert gridmin.shape == (4,)
+    assert gridmin.dtype == np.float32
+    assert gridmin[3] == 0
+    assert gridmax.shape == (4,)
+    assert gridmax.dtype == np.float32
+    assert gridmax[3] == 0
+
+    xyzf = self.model_buf[:self.length]
+    cxyz_ = self._cxyz[:self.length]
+    cxyz_[:] = self._labels()[:,:3]
+    cxyz_ -= 1
+
+    fix = np.array((xfix,0,zfix),'f')
+    mod = np.array((LW,LH,LW),'f')
+    inds = self._inds[:self.length]
+    occ, vac = inds[:,0,:], inds[:,1,:]
+    np.subtract(xyzf[:,:3], fix, out=occ)
+    occ /= mod
+    occ -= gridmin[:3]
+    occ += cxyz_*0.5
+    np.floor(occ, out=occ)
+    np.subtract(occ, cxyz_, out=vac)
+
+    w = cxyz_[:,0]*4 + cxyz_[:,1]*2 + cxyz_[:,2]
+    width = gridmax[:3]-gridmin[:3]
+    occ_ok = np.all((occ >= 0) & (occ < width), 1)
+    vac_ok = np.all((vac >= 0) & (vac < width-1), 1)
+
+    gridinds = self.gridinds_buf[:self.length]
+    with np.errstate(invalid='ignore'):
+      gridinds[:,:,:3] = inds.clip(-128,127)
+    gridinds[:,0,3] = w*occ_ok
+    gridinds[:,1,3] = w*vac_ok
+    return _Event()
+
+  def compute_occvac(self, xfix, zfix, LW, LH, gridmin, gridmax,
+                     threshold=30):
+    self.compute_gridinds(xfix, zfix, LW, LH, gridmin, gridmax)
+    shape = tuple(int(w) for w in (gridmax-gridmin)[:3])
+    gridinds = self.gridinds_buf[:self.length]
+
+    # Counting past where speedup_cy.occvac saturates doesn't change which
+    # voxels pass the threshold
+    def hist(inds):
+      inds = inds[inds[:,3] != 0,:3].astype('i')
+      flat = np.ravel_multi_index(inds.transpose(), shape)
+      counts = np.bincount(flat, minlength=int(np.prod(shape)))
+      return counts.reshape(shape) > threshold
+    self._occvac = hist(gridinds[:,0,:]), hist(gridinds[:,1,:])
+    return _Event()
+
+  def get_occvac(self):
+    occ, vac = self._occvac
+    return occ.copy(), vac.copy()
+
+  def reduce_flatrot(self):
+    return self.qxdyqz_buf[:self.length].sum(0, dtype='d').astype('f')
+
+  def reduce_lattice2(self):
+    qxqz = self.qxqz_buf[:self.length].sum(0, dtype='d').astype('f')
+    cxcz = self.face_buf[:self.length].sum(0, dtype='d').astype('f')
+    return cxcz,qxqz
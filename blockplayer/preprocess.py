@@ -21,41 +21,157 @@ speedup_ctypes.inrange.argtypes = [PTR(c_ushort), PTR(c_byte), PTR(c_ushort),
 import speedup_cy
 
 
-def threshold_and_mask(depth,bg):
+def threshold_and_mask(depth, bg, mask=None):
+    """The foreground (between bgLo and bgHi) and a rect around it, leaving
+    out specks: the rect is of what's left of the foreground after taking
+    every third pixel and eroding twice. This is all one pass of
+    speedup_cy.inrange_bounds; threshold_and_mask_reference does the same
+    in steps.
+    Params:
+        mask: uint8 array the shape of depth to write the mask into, or
+              None for a new one
+    Returns:
+        mask, ((l,t),(r,b))
+    Raises:
+        IndexError if there's nothing in the foreground
+    """
+    height, width = depth.shape
+    if mask is None:
+        mask = np.empty(depth.shape, 'u1')
+    dec = 3
+    bounds = speedup_cy.inrange_bounds(depth, bg['bgLo'], bg['bgHi'],
+                                       mask, dec)
+    if bounds is None:
+        raise IndexError('Nothing in the foreground')
+    top, bottom, left, right = bounds
+    return mask, _rect(slice(top, bottom), slice(left, right), dec,
+                       width, height)
+
+
+# Three ways of finding the mask, kept for checking threshold_and_mask
+# against (see threshold_and_mask_reference)
+def inrange_numpy(depth, bg):
+    return (depth>bg['bgLo']) & (depth<bg['bgHi'])  # background
+
+
+def inrange_ctypes(depth, bg):
+    mm = np.empty(depth.shape,'bool')
+    speedup_ctypes.inrange(depth.ctypes.data_as(PTR(c_ushort)),
+                           mm.ctypes.data_as(PTR(c_byte)),
+                           bg['bgHi'].ctypes.data_as(PTR(c_ushort)),
+                           bg['bgLo'].ctypes.data_as(PTR(c_ushort)),
+                           depth.size)
+    return mm
+
+
+def inrange_cy(depth, bg):
+    mm = np.empty(depth.shape,'u1')
+    speedup_cy.inrange(depth,
+                       mm,
+                       bg['bgHi'],
+                       bg['bgLo'], depth.size)
+    return mm
+
+
+def threshold_and_mask_reference(depth, bg, inrange=inrange_cy):
+    """threshold_and_mask the long way round: one of the inrange functions,
+    then scipy's binary_erosion and find_objects."""
     import scipy
     from scipy.ndimage import binary_erosion
 
-    def m_():
-        # Optimize this in C?
-        return (depth>bg['bgLo']) & (depth<bg['bgHi'])  # background
-
-    def m2_():
-        mm = np.empty((480,640),'bool')
-        speedup_ctypes.inrange(depth.ctypes.data_as(PTR(c_ushort)),
-                               mm.ctypes.data_as(PTR(c_byte)),
-                               bg['bgHi'].ctypes.data_as(PTR(c_ushort)),
-                               bg['bgLo'].ctypes.data_as(PTR(c_ushort)),
-                               480*640)
-        return mm
-
-    def m3_():
-        mm = np.empty((480,640),'u1')
-        speedup_cy.inrange(depth,
-                           mm,
-                           bg['bgHi'],
-                           bg['bgLo'], 480*640)
-        return mm
-
-    mask = m3_()
+    height, width = depth.shape
+    mask = inrange(depth, bg)
     dec = 3
     dil = binary_erosion(mask[::dec,::dec],iterations=2)
     slices = scipy.ndimage.find_objects(dil)
     a,b = slices[0]
+    return mask, _rect(a, b, dec, width, height)
+
+
+def _rect(a, b, dec, width, height):
+    # The rect around the rows a and columns b of the decimated, eroded mask
     (l,t),(r,b) = (b.start*dec-10,a.start*dec-10),(b.stop*dec+7,a.stop*dec+7)
     b += -(b-t)%16
     r += -(r-l)%16
     if t<0: t+= 16
     if l<0: l+= 16
-    if r>=640: r-= 16
-    if b>=480: b-= 16
-    return mask, ((l,t),(r,b))
+    if r>=width: r-= 16
+    if b>=height: b-= 16
+    return ((l,t),(r,b))
+
+
+def track_mask(depth, bg, previous, band=32, mask=None):
+    """threshold_and_mask, looking only within band pixels of the previous
+    frame's rect. It gives the same result as long as the object is still
+    inside the band; when it may not be (or there's nothing there), this
+    returns None, and threshold_and_mask should be used instead. Anything
+    that shows up outside the band isn't seen, so do a full search now and
+    then.
+    Params:
+        mask: as threshold_and_mask; it's cleared outside the band
+    Returns:
+        mask, rect (as threshold_and_mask), or None
+    """
+    height, width = depth.shape
+    dec = 3
+    (l,t),(r,b) = previous
+    # Line the window up with the full search's decimation
+    L, T = max(0, l-band), max(0, t-band)
+    L, T = L - L%dec, T - T%dec
+    R, B = min(width, r+band), min(height, b+band)
+
+    if mask is None:
+        mask = np.zeros(depth.shape,'u1')
+    else:
+        mask.fill(0)
+    bounds = speedup_cy.inrange_bounds(depth[T:B,L:R], bg['bgLo'][T:B,L:R],
+                                       bg['bgHi'][T:B,L:R], mask[T:B,L:R],
+                                       dec)
+    if bounds is None:
+        return None
+    top, bottom, left, right = bounds
+
+    # The erosion treats the edges of the window as background. Away from
+    # them it's the same as eroding the whole mask, but near them, the
+    # object may carry on past the window
+    h, w = (B-T+dec-1)//dec, (R-L+dec-1)//dec
+    edge = 3
+    if (top < edge and T > 0) or (left < edge and L > 0) or \
+       (bottom > h-edge and B < height) or (right > w-edge and R < width):
+        return None
+
+    rect = _rect(slice(top+T//dec, bottom+T//dec),
+                 slice(left+L//dec, right+L//dec), dec, width, height)
+    (l,t),(r,b) = rect
+    if (l < L and L > 0) or (t < T and T > 0) or \
+       (r > R and R < width) or (b > B and B < height):
+        return None
+    return mask, rect
+
+
+def decimate(depth, mask, rect, factor):
+    """Averages of depth over blocks of factor x factor pixels, within rect,
+    for finding the normals and the lattice on a smaller image. Missing
+    readings (0) are left out of the averages. A block is in the mask if
+    most of its pixels are. The rect is moved to line up with the blocks.
+    Returns:
+        depth, mask: the image shrunk by factor, zero outside the rect
+        rect: the rect in the smaller image
+    """
+    (l,t),(r,b) = rect
+    l, t = l - l%factor, t - t%factor
+    w, h = (r-l)//factor, (b-t)//factor
+    r, b = l + w*factor, t + h*factor
+
+    d = depth[t:b,l:r].reshape(h,factor,w,factor)
+    n = (d > 0).sum(3).sum(1)
+    s = d.sum(3, dtype='u4').sum(1)
+    m = mask[t:b,l:r].reshape(h,factor,w,factor).sum(3).sum(1)
+
+    shape = (depth.shape[0]//factor, depth.shape[1]//factor)
+    l, t = l//factor, t//factor
+    small = np.zeros(shape, 'u2')
+    small[t:t+h,l:l+w] = (s + n//2) // np.maximum(n, 1)
+    small_mask = np.zeros(shape, 'u1')
+    small_mask[t:t+h,l:l+w] = m*2 > factor*factor
+    return small, small_mask, ((l,t),(l+w,t+h))
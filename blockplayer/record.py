@@ -16,6 +16,11 @@ import os
 import shutil
 import cv
 import subprocess
+import threading
+import Queue
+import time
+import gzip_patch
+import gzip
 import dataset
 import colormap
 import pylab
@@ -46,7 +51,92 @@ def go():
         pylab.waitforbuttonpress(0.005)
 
 
-def record(filename=None):
+class Recorder(object):
+    """Writes frames to a dataset folder from background threads, so the
+    capture loop never waits on the disk. Frames go into a ring of `slots`
+    preallocated buffers. If the writers fall far enough behind that the
+    ring is full, the frame is dropped and counted in `dropped`.
+
+    The frames that are kept are numbered consecutively from 0, and written
+    as depth_%05d.npy.gz and rgb_%05d.png, the depth compressed with
+    gzip level `compresslevel` as it's written. The capture time of each
+    one goes in timestamps.txt (see dataset.load_timestamps).
+    """
+    def __init__(self, foldername, slots=30, threads=2, compresslevel=1,
+                 depth_shape=(480,640), rgb_shape=(480,640,3)):
+        self.foldername = foldername
+        self.compresslevel = compresslevel
+        self.frames = 0
+        self.dropped = 0
+        self._slots = [(np.empty(depth_shape,'u2'), np.empty(rgb_shape,'u1'))
+                       for _ in range(slots)]
+        self._free = Queue.Queue()
+        for i in range(slots):
+            self._free.put(i)
+        self._filled = Queue.Queue()
+        self._timestamps = open(dataset.timestamps_path(foldername), 'w')
+        self._errors = []
+        self._threads = [threading.Thread(target=self._work)
+                         for _ in range(threads)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def push(self, depth, rgb, timestamp=None):
+        """Queue a frame to be written. Returns its frame number, or None if
+        it was dropped."""
+        if timestamp is None:
+            timestamp = time.time()
+        if self._errors:
+            raise self._errors[0]
+        try:
+            i = self._free.get_nowait()
+        except Queue.Empty:
+            self.dropped += 1
+            return None
+        slot_depth, slot_rgb = self._slots[i]
+        slot_depth[:] = depth
+        slot_rgb[:] = rgb
+        frame = self.frames
+        self.frames += 1
+        self._filled.put((frame, i))
+        self._timestamps.write('%d %.6f\n' % (frame, timestamp))
+        return frame
+
+    def _work(self):
+        while True:
+            item = self._filled.get()
+            if item is None:
+                return
+            frame, i = item
+            depth, rgb = self._slots[i]
+            try:
+                # The depth goes last, it's what marks the frame as there
+                cv.CvtColor(rgb, rgb, cv.CV_RGB2BGR)
+                cv.SaveImage(dataset.rgb_path(self.foldername, frame), rgb)
+                path = dataset.depth_path(self.foldername, frame)
+                with gzip.open(path + '.tmp', 'wb', self.compresslevel) as f:
+                    np.save(f, depth)
+                os.rename(path + '.tmp', path)
+            except Exception as e:
+                self._errors.append(e)
+            self._free.put(i)
+
+    def pending(self):
+        return self._filled.qsize()
+
+    def close(self):
+        """Wait for the queued frames to be written."""
+        for _ in self._threads:
+            self._filled.put(None)
+        for t in self._threads:
+            t.join()
+        self._timestamps.close()
+        if self._errors:
+            raise self._errors[0]
+
+
+def record(filename=None, slots=30, threads=2):
     opennpy.align_depth_to_rgb()
     if filename is None:
         filename = str(np.random.rand())
@@ -58,27 +148,27 @@ def record(filename=None):
     shutil.copytree('data/newest_calibration/config', '%s/config' % foldername)
     print "Created new dataset: %s" % foldername
 
-    frame = 0
+    recorder = Recorder(foldername, slots, threads)
     try:
         while 1:
             opennpy.sync_update()
             (depth,_) = opennpy.sync_get_depth()
             (rgb,_) = opennpy.sync_get_video()
 
-            np.save('%s/depth_%05d.npy' % (foldername,frame), depth)
+            frame = recorder.push(depth, rgb)
 
-            cv.CvtColor(rgb, rgb, cv.CV_RGB2BGR)
-            cv.SaveImage('%s/rgb_%05d.png' % (foldername,frame), rgb)
-
-            if frame % 30 == 0:
-                print 'frame: %d' % frame
-            frame = frame + 1
+            if frame is not None and frame % 30 == 0:
+                print 'frame: %d (%d dropped, %d waiting to be written)' % \
+                    (frame, recorder.dropped, recorder.pending())
     except KeyboardInterrupt:
-        print "Captured %d frames" % frame
-        compress()
+        print "Captured %d frames (%d dropped), finishing writing %d" % \
+            (recorder.frames, recorder.dropped, recorder.pending())
+        recorder.close()
 
 
 def compress():
+    # For datasets recorded before the frames were compressed as they were
+    # written
     cmd = "gzip %s/*.npy" % (dataset.folder,)
     print "Running %s" % cmd
     import sys
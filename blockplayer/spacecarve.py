@@ -30,26 +30,88 @@ def depth_inds(modelmat, X, Y, Z):
     return x/w, y/w, z/w
 
 
-def carve(depth, modelmat):
+def visible_box(modelmat, rect, bounds=None, bg=None, cubes=False):
+    """The smallest box within bounds (by default config.bounds) holding
+    every voxel whose center (or any part, if cubes) is in front of the
+    camera and projects into rect ((L,T),(R,B), in pixels).
+    Returns:
+        ((xmin,ymin,zmin),(xmax,ymax,zmax)) like bounds, or None if no voxel
+        is seen through rect
+    """
+    if bg is None:
+        bg = config.bg
+    if bounds is None:
+        bounds = config.bounds
+    (L,T),(R,B) = rect
+    gridmin = np.array(bounds[0], 'f8')
+    gridmax = np.array(bounds[1], 'f8') - 1
+    m = 0.5 if cubes else 0.
+
+    # Voxel i,j,k has its center at p = (i*LW, j*LH, k*LW) + o. Each side of
+    # rect, and w > 0, is a plane n.(i,j,k) + c >= 0
+    D = np.array([config.LW, config.LH, config.LW])
+    o = D/2
+    P = np.linalg.inv(np.dot(np.dot(modelmat, bg['Ktable']), bg['KK']))
+    rows = np.array([P[0]-L*P[3], R*P[3]-P[0], P[1]-T*P[3], B*P[3]-P[1],
+                     P[3]], 'f8')
+    n = np.vstack([rows[:,:3]*D, np.eye(3), -np.eye(3)])
+    c = np.concatenate([np.dot(rows[:,:3], o) + rows[:,3],
+                        -(gridmin - m), gridmax + m])
+    scale = np.sqrt(np.sum(n**2, 1))
+    n, c = n/scale[:,None], c/scale
+
+    region = speedup_cy.region_bounds(n, c)
+    if region is None:
+        return None
+    lo = np.ceil(region[0] - m - 1e-6).astype(int)
+    hi = np.floor(region[1] + m + 1e-6).astype(int) + 1
+    lo = np.maximum(lo, bounds[0])
+    hi = np.minimum(hi, bounds[1])
+    if np.any(hi <= lo):
+        return None
+    return tuple(lo.tolist()), tuple(hi.tolist())
+
+
+def carve(depth, modelmat, bg=None, bounds=None, rect=None):
+    """The voxels within bounds (by default config.bounds) that the depth
+    image sees right through. Only the voxels whose centers project into
+    rect (by default, the whole image) are looked at (see visible_box)."""
+    if bg is None:
+        bg = config.bg
+    if bounds is None:
+        bounds = config.bounds
+    if rect is None:
+        rect = ((0,0), depth.shape[::-1])
+
+    vac = np.zeros([b1-b0 for b0, b1 in zip(*bounds)], 'u1')
+    box = visible_box(modelmat, rect, bounds, bg)
+    if box is None:
+        return vac
 
     if 1:
-        gridmin, gridmax = config.bounds
+        gridmin, gridmax = box
         gridmin = np.array(gridmin).astype('i')
         gridmax = np.array(gridmax).astype('i')
         length = np.sqrt((config.LW**2+
                           config.LH**2+
                           config.LW**2))/2
-        vac = np.zeros((gridmax[0]-gridmin[0],
-                        gridmax[1]-gridmin[1],
-                        gridmax[2]-gridmin[2]), 'u1')
-        mat = config.bg['KK']
+        if box == tuple(map(tuple, bounds)):
+            vac_box = vac
+        else:
+            vac_box = np.zeros((gridmax[0]-gridmin[0],
+                                gridmax[1]-gridmin[1],
+                                gridmax[2]-gridmin[2]), 'u1')
+        mat = bg['KK']
         modelmat = np.linalg.inv(np.dot(np.dot(modelmat,
-                                               config.bg['Ktable']),
-                                        config.bg['KK']))
+                                               bg['Ktable']),
+                                        bg['KK']))
         modelmat = np.ascontiguousarray(modelmat)
-        speedup_cy.spacecarve(depth, vac, modelmat, mat,
+        speedup_cy.spacecarve(depth, vac_box, modelmat, mat,
                               gridmin, gridmax,
                               config.LW, config.LH, length)
+        if not vac_box is vac:
+            vac[tuple(slice(b0-g0, b1-g0) for g0, b0, b1
+                      in zip(bounds[0], *box))] = vac_box
     if 0:
         vac_numpy = carve_numpy(depth, modelmat)
         assert np.all(vac == vac_numpy)
@@ -25,13 +25,13 @@ cdef stencil_carve_(np.float32_t * depthB,
                     np.float32_t * b_total,
                     np.float32_t * b_occ,
                     np.float32_t * b_vac,
-                    int T, int L, int B, int R):
+                    int T, int L, int B, int R, int W):
                     
     cdef int GYGZ = GY*GZ
     cdef int ind, dB, d, x, y, z, coord, p1
     cdef int i, j
     for i in range(T, B):
-        p1 = i*640
+        p1 = i*W
         for j in range(L, R):
             ind = p1+j
             dB = <int> depthB[ind]
@@ -81,7 +81,7 @@ def stencil_carve(np.ndarray[np.float32_t, ndim=2, mode='c'] depthB,
                    <np.float32_t *> b_total.data,
                    <np.float32_t *> b_occ.data,
                    <np.float32_t *> b_vac.data,
-                   T, L, B, R)                   
+                   T, L, B, R, depth.shape[1])
 
 
 @cython.cdivision(True)
@@ -91,7 +91,8 @@ def stencil_finish(np.ndarray[np.float32_t, ndim=2, mode='c'] depth_,
                    np.ndarray[np.uint8_t, ndim=3, mode='c'] readpixelsA_,
                    int T, int L, int B, int R):
     cdef int i = 0
-    cdef int indd = 640*T + L
+    cdef int W = depth_.shape[1]
+    cdef int indd = W*T + L
     cdef int y, x
     cdef np.float32_t *depth = <np.float32_t *>depth_.data
     cdef np.float32_t *readpixels = <np.float32_t *>readpixels_.data
@@ -103,7 +104,7 @@ def stencil_finish(np.ndarray[np.float32_t, ndim=2, mode='c'] depth_,
            coords[indd] = readpixelsA[i]
            indd += 1
            i += 1
-       indd += 640-(R-L)
+       indd += W-(R-L)
 
 
 def grid_vertices(grid):
@@ -138,7 +139,8 @@ cdef depth_inds(np.float32_t *m,
                 np.int32_t *gridmin,
                 np.int32_t *gridmax,
                 np.uint8_t *vac,
-                float LW, float LH, float length):
+                float LW, float LH, float length,
+                int W, int H):
 
     cdef int xmin = gridmin[0]
     cdef int ymin = gridmin[1]
@@ -179,10 +181,10 @@ cdef depth_inds(np.float32_t *m,
 
                 ix = 0 if ix < 0 else ix
                 iy = 0 if iy < 0 else iy
-                ix = 639 if ix > 639 else ix
-                iy = 479 if iy > 479 else iy
+                ix = W-1 if ix > W-1 else ix
+                iy = H-1 if iy > H-1 else iy
 
-                d = depth[iy*640+ix]
+                d = depth[iy*W+ix]
                 d = 1000. / d if not d == 0 else 0
 
                 z = x*KK[ 8] + y*KK[ 9] + d*KK[10] + KK[11]
@@ -211,13 +213,67 @@ def spacecarve(np.ndarray[np.uint16_t, ndim=2, mode='c'] depth,
                <np.uint16_t *> depth.data,
                <np.int32_t *> gridmin.data,
                <np.int32_t *> gridmax.data,
-               <np.uint8_t *> vac.data, LW, LH, length)
+               <np.uint8_t *> vac.data, LW, LH, length,
+               depth.shape[1], depth.shape[0])
+
+def region_bounds(np.ndarray[np.float64_t, ndim=2, mode='c'] n_,
+                  np.ndarray[np.float64_t, ndim=1, mode='c'] c_):
+    """The bounding box of the region where n[i].p + c[i] >= 0 for every
+    plane i, if it's closed. Its corners are where three planes meet.
+    Returns:
+        (lo, hi) arrays of the smallest and largest x,y,z, or None if
+        nothing is inside every plane
+    """
+    cdef int k = n_.shape[0]
+    cdef double *n = <double *> n_.data
+    cdef double *c = <double *> c_.data
+    cdef double lo[3]
+    cdef double hi[3]
+    cdef double p[3]
+    cdef double a[3]
+    cdef double b[3]
+    cdef double d[3]
+    cdef double det
+    cdef int i, j, l, q, found = 0
+    for i in range(k):
+        for j in range(i+1, k):
+            for l in range(j+1, k):
+                # Cramer's rule, with n_j x n_l and so on
+                a[0] = n[3*j+1]*n[3*l+2] - n[3*j+2]*n[3*l+1]
+                a[1] = n[3*j+2]*n[3*l+0] - n[3*j+0]*n[3*l+2]
+                a[2] = n[3*j+0]*n[3*l+1] - n[3*j+1]*n[3*l+0]
+                det = n[3*i+0]*a[0] + n[3*i+1]*a[1] + n[3*i+2]*a[2]
+                if -1e-9 < det < 1e-9:
+                    continue
+                b[0] = n[3*l+1]*n[3*i+2] - n[3*l+2]*n[3*i+1]
+                b[1] = n[3*l+2]*n[3*i+0] - n[3*l+0]*n[3*i+2]
+                b[2] = n[3*l+0]*n[3*i+1] - n[3*l+1]*n[3*i+0]
+                d[0] = n[3*i+1]*n[3*j+2] - n[3*i+2]*n[3*j+1]
+                d[1] = n[3*i+2]*n[3*j+0] - n[3*i+0]*n[3*j+2]
+                d[2] = n[3*i+0]*n[3*j+1] - n[3*i+1]*n[3*j+0]
+                for q in range(3):
+                    p[q] = -(c[i]*a[q] + c[j]*b[q] + c[l]*d[q]) / det
+                for q in range(k):
+                    if (n[3*q]*p[0] + n[3*q+1]*p[1] + n[3*q+2]*p[2] +
+                        c[q] < -1e-6):
+                        break
+                else:
+                    for q in range(3):
+                        if not found or p[q] < lo[q]: lo[q] = p[q]
+                        if not found or p[q] > hi[q]: hi[q] = p[q]
+                    found = 1
+    if not found:
+        return None
+    return (np.array([lo[0], lo[1], lo[2]]),
+            np.array([hi[0], hi[1], hi[2]]))
+
 
 def occvac(np.ndarray[np.int8_t, ndim=3, mode='c'] gridinds_,
            np.ndarray[np.uint8_t, ndim=3, mode='c'] occ_,
            np.ndarray[np.uint8_t, ndim=3, mode='c'] vac_,
            np.ndarray[np.int32_t, ndim=1, mode='c'] gridmin,
-           np.ndarray[np.int32_t, ndim=1, mode='c'] gridmax):
+           np.ndarray[np.int32_t, ndim=1, mode='c'] gridmax,
+           int threshold=30):
 
     cdef int i
     cdef int length = gridinds_.shape[0]
@@ -230,13 +286,14 @@ def occvac(np.ndarray[np.int8_t, ndim=3, mode='c'] gridinds_,
     cdef np.int8_t *gridinds = <np.int8_t *> gridinds_.data
     cdef np.uint8_t *occ = <np.uint8_t *> occ_.data
     cdef np.uint8_t *vac = <np.uint8_t *> vac_.data
+    assert threshold < 255, 'the counters are bytes'
     
     for i in range(length):
         if gridinds[8*i+0+3] != 0:
             x = gridinds[8*i+0+0]
             y = gridinds[8*i+0+1]
             z = gridinds[8*i+0+2]
-            if occ[x*wywz + y*wz + z] < 35:
+            if occ[x*wywz + y*wz + z] <= threshold:
                 #assert x >= 0 and z >= 0, 'vac >0'
                 #assert x < wx and z < wz and y < wy, 'vac < max'
                 occ[x*wywz + y*wz + z] += 1
@@ -247,12 +304,12 @@ def occvac(np.ndarray[np.int8_t, ndim=3, mode='c'] gridinds_,
             z = gridinds[8*i+4+2]
             #assert x >= 0 and z >= 0, 'vac >0'
             #assert x < wx and z < wz and y < wy, 'vac < max'
-            if vac[x*wywz + y*wz + z] < 35:
+            if vac[x*wywz + y*wz + z] <= threshold:
                 vac[x*wywz + y*wz + z] += 1
 
     for i in range(wx*wy*wz):
-        occ[i] = occ[i] > 30
-        vac[i] = vac[i] > 30
+        occ[i] = occ[i] > threshold
+        vac[i] = vac[i] > threshold
 
 
 cdef diff_coord(int xa, int ya, int za, int ra,
@@ -264,19 +321,73 @@ cdef diff_coord(int xa, int ya, int za, int ra,
     return x,y,z,(r-ra)%4
 
 
-def match_features(A, B, sq):
-    ymax = max([y for _,y,_,_ in A])
-    yA = [[_ for _ in A if _[1] == y] for y in range(ymax)]
-    yB = [[_ for _ in B if _[1] == y] for y in range(ymax)]
-    d = {}
-    for y in range(ymax):
-        for a in yA[y]:
-            for b in yB[y]:
-                m = diff_coord(a[0], a[1], a[2], a[3],
-                               b[0], b[1], b[2], b[3])
-                d.setdefault(m,0)
-                d[m] += 1
-    return d
+def match_features(np.ndarray[np.int32_t, ndim=2, mode='c'] A_,
+                   np.ndarray[np.int32_t, ndim=2, mode='c'] B_,
+                   int sq, int k=4):
+    """Every pair of features (x,y,z,r from find_features) of A and B in the
+    same layer votes for the correction (diff_coord) that lines them up.
+    Only the layers below A's top feature are used.
+    Params:
+        sq: the width of the (square) grids
+        k: how many corrections to keep for each rotation
+    Returns:
+        int32 array of (x,y,z,r,votes): the k corrections of each rotation
+        with the most votes, by rotation, then most votes first
+    """
+    cdef int na = A_.shape[0], nb = B_.shape[0]
+    if not na or not nb:
+        return np.zeros((0,5), np.int32)
+    cdef np.int32_t *A = <np.int32_t *> A_.data
+    cdef np.int32_t *B = <np.int32_t *> B_.data
+    cdef int ymax = A_[:,1].max()
+
+    # Features of B by layer
+    cdef np.ndarray[np.int32_t, ndim=1, mode='c'] order_
+    order_ = np.argsort(B_[:,1], kind='mergesort').astype(np.int32)
+    cdef np.ndarray[np.int32_t, ndim=1, mode='c'] start_
+    start_ = np.searchsorted(B_[:,1][order_],
+                             np.arange(ymax+1)).astype(np.int32)
+    cdef np.int32_t *order = <np.int32_t *> order_.data
+    cdef np.int32_t *start = <np.int32_t *> start_.data
+
+    # A correction x,z,r is the key (r*W + x+sq)*W + z+sq
+    cdef int W = 2*sq
+    cdef np.ndarray[np.int32_t, ndim=1, mode='c'] votes_
+    votes_ = np.zeros(4*W*W, np.int32)
+    cdef np.int32_t *votes = <np.int32_t *> votes_.data
+    cdef int i, j, x, z, t, ra, y
+    cdef np.int32_t *a
+    cdef np.int32_t *b
+    for i in range(na):
+        a = A + 4*i
+        y = a[1]
+        if y >= ymax:
+            continue
+        ra = a[3]
+        for j in range(start[y], start[y+1]):
+            b = B + 4*order[j]
+            x = a[0] - b[0]
+            z = a[2] - b[2]
+            if ra == 1:
+                x, z = z, -x
+            elif ra == 2:
+                x, z = -x, -z
+            elif ra == 3:
+                x, z = -z, x
+            votes[(((b[3] - ra) & 3)*W + x+sq)*W + z+sq] += 1
+
+    keys = np.flatnonzero(votes_)
+    counts = votes_[keys]
+    # Most votes first, then by key, so ties always come out the same
+    keys = keys[np.lexsort((keys, -counts))]
+    r = keys // (W*W)
+    keys = np.concatenate([keys[r == rot][:k] for rot in range(4)])
+    out = np.zeros((len(keys), 5), np.int32)
+    out[:,0] = keys // W % W - sq
+    out[:,2] = keys % W - sq
+    out[:,3] = keys // (W*W)
+    out[:,4] = votes_[keys]
+    return out
 
 
 def find_features(np.ndarray[np.uint8_t, ndim=3, mode='c'] A):
@@ -349,6 +460,243 @@ def grid_error(np.ndarray[np.uint8_t, ndim=3, mode='c'] occA,
 
         #print lower, upper
 
+# Bit-packed boolean grids (see bitgrid.py): voxel i of the flattened grid
+# is bit i%64 of word i/64
+
+cdef extern from *:
+    int __builtin_popcountll(unsigned long long)
+
+
+cdef inline np.uint64_t _bits(np.uint64_t *words, long nwords, long pos):
+    # The 64 bits starting at bit pos, which can be anywhere. Bits outside
+    # the words are 0
+    cdef long q = pos >> 6
+    cdef int s = pos & 63
+    cdef np.uint64_t w0 = words[q] if 0 <= q < nwords else 0
+    if s == 0:
+        return w0
+    cdef np.uint64_t w1 = words[q+1] if 0 <= q+1 < nwords else 0
+    return (w0 >> s) | (w1 << (64 - s))
+
+
+cdef void _copy_bits(np.uint64_t *src, long nsrc, long sp,
+                     np.uint64_t *dst, long dp, long n):
+    # Bits sp..sp+n of src into dst at dp, which must be 0 there
+    cdef int c
+    cdef np.uint64_t v
+    while n > 0:
+        c = 64 - (dp & 63)
+        if c > n:
+            c = n
+        v = _bits(src, nsrc, sp)
+        if c < 64:
+            v &= ((<np.uint64_t>1) << c) - 1
+        dst[dp >> 6] |= v << (dp & 63)
+        sp += c
+        dp += c
+        n -= c
+
+
+def pack_bits(np.ndarray[np.uint8_t, ndim=1, mode='c'] a_):
+    """The bits of a (nonzero or not), 64 to a uint64 word."""
+    cdef long n = a_.shape[0]
+    cdef np.ndarray[np.uint64_t, ndim=1, mode='c'] words_
+    words_ = np.empty((n + 63) // 64, np.uint64)
+    cdef np.uint64_t *words = <np.uint64_t *> words_.data
+    cdef np.uint8_t *a = <np.uint8_t *> a_.data
+    cdef long w, i, end
+    cdef np.uint64_t v
+    for w in range(words_.shape[0]):
+        v = 0
+        end = min(64, n - (w << 6))
+        for i in range(end):
+            v |= (<np.uint64_t>(a[(w << 6) + i] != 0)) << i
+        words[w] = v
+    return words_
+
+
+def unpack_bits(np.ndarray[np.uint64_t, ndim=1, mode='c'] words_, long n):
+    """The first n bits of words, as a uint8 array of 0s and 1s."""
+    cdef np.ndarray[np.uint8_t, ndim=1, mode='c'] a_
+    a_ = np.empty(n, np.uint8)
+    cdef np.uint64_t *words = <np.uint64_t *> words_.data
+    cdef np.uint8_t *a = <np.uint8_t *> a_.data
+    cdef long i
+    for i in range(n):
+        a[i] = (words[i >> 6] >> (i & 63)) & 1
+    return a_
+
+
+def roll_bits(np.ndarray[np.uint64_t, ndim=1, mode='c'] words_,
+              int WX, int WY, int WZ, int bx, int bz):
+    """np.roll(np.roll(grid, bx, 0), bz, 2) of a packed (WX,WY,WZ) grid.
+    Each row (along z) is moved a word at a time."""
+    cdef np.ndarray[np.uint64_t, ndim=1, mode='c'] out_
+    out_ = np.zeros(words_.shape[0], np.uint64)
+    cdef np.uint64_t *words = <np.uint64_t *> words_.data
+    cdef np.uint64_t *out = <np.uint64_t *> out_.data
+    cdef long nwords = words_.shape[0]
+    cdef int x, y
+    cdef long src, dst
+    bx = bx % WX
+    bz = bz % WZ
+    for x in range(WX):
+        for y in range(WY):
+            src = (((x - bx + WX) % WX)*WY + y) * <long>WZ
+            dst = (x*WY + y) * <long>WZ
+            _copy_bits(words, nwords, src + WZ - bz, out, dst, bz)
+            _copy_bits(words, nwords, src, out, dst + bz, WZ - bz)
+    return out_
+
+
+cdef inline np.uint64_t _reverse64(np.uint64_t v):
+    # The bits of v in the opposite order
+    v = ((v >> 1) & 0x5555555555555555ULL) | ((v & 0x5555555555555555ULL) << 1)
+    v = ((v >> 2) & 0x3333333333333333ULL) | ((v & 0x3333333333333333ULL) << 2)
+    v = ((v >> 4) & 0x0F0F0F0F0F0F0F0FULL) | ((v & 0x0F0F0F0F0F0F0F0FULL) << 4)
+    v = ((v >> 8) & 0x00FF00FF00FF00FFULL) | ((v & 0x00FF00FF00FF00FFULL) << 8)
+    v = ((v >> 16) & 0x0000FFFF0000FFFFULL) | \
+        ((v & 0x0000FFFF0000FFFFULL) << 16)
+    return (v >> 32) | (v << 32)
+
+
+cdef void _transpose64(np.uint64_t *a):
+    # a is a 64x64 bit matrix, bit j of a[i] being (i,j). Transpose it in
+    # place, swapping the off-diagonal halves of ever smaller blocks
+    cdef int j = 32, b, k
+    cdef np.uint64_t m = 0x00000000FFFFFFFFULL, t
+    while j:
+        for b in range(0, 64, 2*j):
+            for k in range(b, b+j):
+                t = ((a[k] >> j) ^ a[k+j]) & m
+                a[k+j] ^= t
+                a[k] ^= t << j
+        j >>= 1
+        m ^= m << j
+
+
+def rot90_bits(np.ndarray[np.uint64_t, ndim=1, mode='c'] words_,
+               int WX, int WY, int WZ, int r):
+    """hashalign's rotation of a packed (WX,WY,WZ) grid by r quarter turns
+    about y (np.swapaxes(np.rot90(np.swapaxes(grid,1,2), r), 1,2)).
+    A half turn reverses each row (along z), a word at a time. A quarter
+    turn transposes each xz slice, in 64x64 blocks of bits.
+    Returns:
+        words, (WX,WY,WZ) of the turned grid
+    """
+    r = r % 4
+    cdef int OX = WZ if r % 2 else WX
+    cdef int OZ = WX if r % 2 else WZ
+    cdef np.ndarray[np.uint64_t, ndim=1, mode='c'] out_
+    out_ = np.zeros(words_.shape[0], np.uint64)
+    cdef np.uint64_t *words = <np.uint64_t *> words_.data
+    cdef np.uint64_t *out = <np.uint64_t *> out_.data
+    cdef long nwords = words_.shape[0]
+    cdef np.uint64_t block[64]
+    cdef np.uint64_t v, any
+    cdef int x, y, i, n, rows, bx, bz
+    cdef long src, dst
+    if r == 0:
+        out_[:] = words_
+        return out_, (OX, WY, OZ)
+    if r == 2:
+        # Row x is row WX-1-x backwards
+        for x in range(WX):
+            for y in range(WY):
+                src = ((WX-1-x)*WY + y) * <long>WZ
+                dst = (x*WY + y) * <long>WZ
+                for bz in range(0, WZ, 64):
+                    n = min(64, WZ - bz)
+                    v = _reverse64(_bits(words, nwords, src + bz))
+                    _copy_bits(&v, 1, 64 - n, out, dst + WZ - bz - n, n)
+        return out_, (OX, WY, OZ)
+    # Column z of a slice becomes row WZ-1-z (r=1), or row z backwards (r=3)
+    for y in range(WY):
+        for bx in range(0, WX, 64):
+            rows = min(64, WX - bx)
+            for bz in range(0, WZ, 64):
+                any = 0
+                for i in range(64):
+                    block[i] = _bits(words, nwords,
+                                     ((bx+i)*WY + y) * <long>WZ + bz) \
+                        if i < rows else 0
+                    any |= block[i]
+                if not any:
+                    # Nothing to move (blocks are often empty)
+                    continue
+                _transpose64(block)
+                for i in range(min(64, WZ - bz)):
+                    if r == 1:
+                        dst = ((WZ-1-bz-i)*WY + y) * <long>WX + bx
+                        _copy_bits(&block[i], 1, 0, out, dst, rows)
+                    else:
+                        v = _reverse64(block[i])
+                        dst = ((bz+i)*WY + y) * <long>WX + WX - bx - rows
+                        _copy_bits(&v, 1, 64 - rows, out, dst, rows)
+    return out_, (OX, WY, OZ)
+
+
+def grid_error_bits(np.ndarray[np.uint64_t, ndim=1, mode='c'] occA,
+                    np.ndarray[np.uint64_t, ndim=1, mode='c'] vacA,
+                    np.ndarray[np.uint64_t, ndim=1, mode='c'] occB,
+                    np.ndarray[np.uint64_t, ndim=1, mode='c'] vacB,
+                    int WX, int WY, int WZ, int bx, int bz, int term):
+    """grid_error of packed grids, 64 voxels at a time with popcounts. It
+    gives the same result, including where it gives up (above term)."""
+    cdef long offset = -(bz + bx*<long>WZ*WY)
+    cdef long lower = 0 if offset>0 else -offset
+    cdef long upper = WX*<long>WY*WZ
+    upper = upper if offset<0 else upper-offset
+    cdef long nwords = occA.shape[0]
+    cdef np.uint64_t *oA_ = <np.uint64_t *> occA.data
+    cdef np.uint64_t *vA_ = <np.uint64_t *> vacA.data
+    cdef np.uint64_t *oB_ = <np.uint64_t *> occB.data
+    cdef np.uint64_t *vB_ = <np.uint64_t *> vacB.data
+    assert vacA.shape[0] == occB.shape[0] == vacB.shape[0] == nwords
+    cdef float total
+    cdef int term_ = int((term-100)*2 * 1.5)
+    cdef long total_ = 0
+    cdef long w, pos
+    cdef int k
+    cdef np.uint64_t oA, vA, oB, vB, both, gain_a, gain_b, m
+    # B outside the grid counts as empty, which is the same as only going
+    # over the voxels where A and the shifted B overlap
+    for w in range(nwords):
+        oA = oA_[w]
+        vA = vA_[w]
+        pos = (w << 6) + offset
+        oB = _bits(oB_, nwords, pos)
+        if not oA and not oB:
+            continue
+        vB = _bits(vB_, nwords, pos)
+        gain_a = vB & oA
+        gain_b = oB & vA
+        both = oB & oA
+        pos = 2*(__builtin_popcountll(gain_a) + __builtin_popcountll(gain_b))
+        if total_ + pos <= term_:
+            total_ += pos - __builtin_popcountll(both)
+            continue
+        # It may go over term partway through this word. Find out where,
+        # a voxel at a time, like grid_error (which checks after each voxel
+        # in A's range that's occupied in either)
+        oA |= oB
+        for k in range(64):
+            m = (<np.uint64_t>1) << k
+            if not oA & m or not lower <= (w << 6) + k < upper:
+                continue
+            if gain_a & m: total_ += 2
+            if gain_b & m: total_ += 2
+            if both & m: total_ -= 1
+            if total_ > term_:
+                break
+        else:
+            continue
+        break
+
+    total = total_/float(2.) + 100
+    return total
+
+
 def inrange(np.ndarray[np.uint16_t, ndim=2, mode='c'] depth_,
             np.ndarray[np.uint8_t, ndim=2, mode='c'] mm_,
             np.ndarray[np.uint16_t, ndim=2, mode='c'] bgHi_,
@@ -363,6 +711,123 @@ def inrange(np.ndarray[np.uint16_t, ndim=2, mode='c'] depth_,
     for i in range(length):
         mm[i] = depth[i] > bgLo[i] and depth[i] < bgHi[i]
 
+
+cdef inline void _erode_row(np.uint8_t *small, int r, int Wd, int *bounds):
+    # Row r of the mask eroded twice with a cross (so, with a diamond of
+    # radius 2), and outside counting as empty. Grow the bounds to take in
+    # what's left of it. r must be at least 2 from the top and the bottom
+    cdef np.uint8_t *m = small + r*Wd
+    cdef int j
+    for j in range(2, Wd-2):
+        if (m[j] and m[j-1] and m[j+1] and m[j-2] and m[j+2] and
+            m[j-Wd] and m[j-Wd-1] and m[j-Wd+1] and
+            m[j+Wd] and m[j+Wd-1] and m[j+Wd+1] and
+            m[j-2*Wd] and m[j+2*Wd]):
+            if r < bounds[0]: bounds[0] = r
+            bounds[1] = r+1
+            if j < bounds[2]: bounds[2] = j
+            if j+1 > bounds[3]: bounds[3] = j+1
+
+
+@cython.cdivision(True)
+def inrange_bounds(np.ndarray[np.uint16_t, ndim=2] depth_,
+                   np.ndarray[np.uint16_t, ndim=2] bgLo_,
+                   np.ndarray[np.uint16_t, ndim=2] bgHi_,
+                   np.ndarray[np.uint8_t, ndim=2] mask_,
+                   int dec):
+    """inrange into mask, and in the same pass, the bounding box of every
+    dec'th pixel of the mask eroded twice (as binary_erosion(mask[::dec,
+    ::dec], iterations=2)). The arrays can be views into bigger ones, as
+    long as their rows are contiguous.
+    Returns:
+        (top, bottom, left, right) of the eroded mask, in decimated pixels,
+        or None if nothing is left of it
+    """
+    cdef int H = depth_.shape[0]
+    cdef int W = depth_.shape[1]
+    assert bgLo_.shape[0] == bgHi_.shape[0] == mask_.shape[0] == H
+    assert bgLo_.shape[1] == bgHi_.shape[1] == mask_.shape[1] == W
+    assert depth_.strides[1] == bgLo_.strides[1] == bgHi_.strides[1] == 2
+    assert mask_.strides[1] == 1
+    cdef int sd = depth_.strides[0] // 2
+    cdef int slo = bgLo_.strides[0] // 2
+    cdef int shi = bgHi_.strides[0] // 2
+    cdef int sm = mask_.strides[0]
+    cdef np.uint16_t *depth = <np.uint16_t *> depth_.data
+    cdef np.uint16_t *bgLo = <np.uint16_t *> bgLo_.data
+    cdef np.uint16_t *bgHi = <np.uint16_t *> bgHi_.data
+    cdef np.uint8_t *mask = <np.uint8_t *> mask_.data
+
+    cdef int Hd = (H + dec - 1) // dec
+    cdef int Wd = (W + dec - 1) // dec
+    cdef np.ndarray[np.uint8_t, ndim=2, mode='c'] small_
+    small_ = np.empty((Hd, Wd), 'u1')
+    cdef np.uint8_t *small = <np.uint8_t *> small_.data
+    cdef int bounds[4]
+    bounds[0], bounds[1], bounds[2], bounds[3] = Hd, -1, Wd, -1
+
+    cdef int y, x, i, j, d
+    cdef np.uint16_t *drow
+    cdef np.uint16_t *lorow
+    cdef np.uint16_t *hirow
+    cdef np.uint8_t *mrow
+    for y in range(H):
+        drow, lorow, hirow, mrow = depth+y*sd, bgLo+y*slo, bgHi+y*shi, mask+y*sm
+        for x in range(W):
+            d = drow[x]
+            mrow[x] = d > lorow[x] and d < hirow[x]
+        if y % dec == 0:
+            i = y // dec
+            for j in range(Wd):
+                small[i*Wd+j] = mrow[j*dec]
+            # Row i-2 of the erosion has all the rows it needs now. The top
+            # and bottom two rows are always eroded away
+            if i >= 4:
+                _erode_row(small, i-2, Wd, bounds)
+
+    if bounds[1] < 0:
+        return None
+    return bounds[0], bounds[1], bounds[2], bounds[3]
+
+
+
+def tile_sums(np.ndarray[np.uint16_t, ndim=2, mode='c'] depth_,
+              np.ndarray[np.int64_t, ndim=2, mode='c'] sums_,
+              np.ndarray[np.int32_t, ndim=2, mode='c'] counts_,
+              int tile, int i0, int j0, int i1, int j1):
+    """The sum of the valid (nonzero) depths in each tile x tile square of
+    depth, and how many there are, into sums and counts (which have a
+    value for each tile, the ones along the right and bottom being cut
+    short). Only the tiles in rows i0:i1 and columns j0:j1 are done."""
+    cdef int H = depth_.shape[0]
+    cdef int W = depth_.shape[1]
+    cdef int nj = sums_.shape[1]
+    assert sums_.shape[0] == counts_.shape[0] == (H + tile - 1) // tile
+    assert counts_.shape[1] == nj == (W + tile - 1) // tile
+    assert 0 <= i0 and i1 <= sums_.shape[0] and 0 <= j0 and j1 <= nj
+    cdef np.uint16_t *depth = <np.uint16_t *> depth_.data
+    cdef np.int64_t *sums = <np.int64_t *> sums_.data
+    cdef np.int32_t *counts = <np.int32_t *> counts_.data
+    cdef int i, j, y, x, x1, d, n
+    cdef np.int64_t total
+    cdef np.uint16_t *row
+    for i in range(i0, i1):
+        for j in range(j0, j1):
+            sums[i*nj+j] = 0
+            counts[i*nj+j] = 0
+        for y in range(i*tile, min((i+1)*tile, H)):
+            row = depth + y*W
+            for j in range(j0, j1):
+                total = 0
+                n = 0
+                x1 = min((j+1)*tile, W)
+                for x in range(j*tile, x1):
+                    d = row[x]
+                    if d:
+                        total += d
+                        n += 1
+                sums[i*nj+j] += total
+                counts[i*nj+j] += n
         
 grid_q = [[[1,1,0],[0,1,0],[0,1,1],[1,1,1]], \
          [[1,0,1],[0,0,1],[0,0,0],[1,0,0]], \
@@ -17,9 +17,21 @@ import config
 import blockdraw
 import cv
 import speedup_cy
+import threading
+import os
 
-if not 'initialized' in globals():
-    initialized = False
+# How render_blocks draws the blocks:
+#   'gl':    with OpenGL, into a framebuffer object. Needs a current context.
+#   'numpy': in software (see stencil_numpy), for running headless
+# Set BLOCKPLAYER_RENDERER to choose at import time, or call set_renderer().
+if not 'renderer' in globals():
+    renderer = os.environ.get('BLOCKPLAYER_RENDERER', 'gl')
+
+# Framebuffer objects belong to a GL context, and a GL context can only be
+# current in one thread. Keep one fbo per thread, so each worker thread that
+# makes its own context current can call render_blocks.
+if not '_local' in globals():
+    _local = threading.local()
 
 
 # Color targets, defined as hues from 0 to 180
@@ -40,26 +52,29 @@ def color_dict():
 def print_colors():    
     print color_dict()
 
-def setup():
-    global initialized
-    if initialized:
-        return
-
-    global fbo
-    global rb, rbc, rbs
+def setup(size=(640,480)):
+    """The framebuffer object for this thread, with renderbuffers of size
+    (width, height). They're made again if the size changes."""
+    fbo = getattr(_local, 'fbo', None)
+    if fbo is not None and _local.size == tuple(size):
+        return fbo
 
-    fbo = glGenFramebuffers(1)
+    if fbo is None:
+        fbo = glGenFramebuffers(1)
+        rb,rbc = glGenRenderbuffers(2)
+    else:
+        rb,rbc = _local.rb, _local.rbc
     glBindFramebuffer(GL_FRAMEBUFFER, fbo);
 
-    rb,rbc = glGenRenderbuffers(2)
+    width, height = size
     glBindRenderbuffer(GL_RENDERBUFFER, rb);
-    glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, 640, 480)
+    glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, width, height)
     glFramebufferRenderbuffer(GL_FRAMEBUFFER,
                               GL_DEPTH_ATTACHMENT,
                               GL_RENDERBUFFER, rb);
 
     glBindRenderbuffer(GL_RENDERBUFFER, rbc)
-    glRenderbufferStorage(GL_RENDERBUFFER, GL_RGB8, 640, 480)
+    glRenderbufferStorage(GL_RENDERBUFFER, GL_RGB8, width, height)
     glFramebufferRenderbuffer(GL_FRAMEBUFFER,
                               GL_COLOR_ATTACHMENT0,
                               GL_RENDERBUFFER, rbc)
@@ -67,40 +82,77 @@ def setup():
     #      glCheckFramebufferStatus(GL_FRAMEBUFFER)==
     #      GL_FRAMEBUFFER_COMPLETE_EXT)
     glBindFramebuffer(GL_FRAMEBUFFER, 0)
-    initialized = True
+    _local.fbo = fbo
+    _local.rb, _local.rbc = rb, rbc
+    _local.size = tuple(size)
+    return fbo
 
 
-def render_blocks(occ_grid, modelmat, rect=((0,0),(640,480))):
+def set_renderer(name):
+    """Draw with 'gl' or 'numpy' from now on (see renderer above)."""
+    assert name in ('gl', 'numpy'), name
+    global renderer
+    renderer = name
+
+
+def render_blocks(occ_grid, modelmat, rect=None, bg=None, size=None,
+                  bounds=None):
     """
     Returns the result of rendering occ_grid from the point of view of the
-    camera.
+    camera, with the selected renderer.
+        params:
+            rect: the part of the image to draw, by default all of it
+            size: (width, height) of the image, by default that of bg
+            bounds: the part of the grid occ_grid covers, by default
+                    config.bounds
         returns:
-            depthB: numpy array shape=(480,640) dtype=np.float32,
+            coords: numpy array shape=(H,W,4) dtype=np.uint8,
+                    the grid index of the block drawn at each pixel
+            depthB: numpy array shape=(H,W) dtype=np.float32,
                     distance in mm, just like the kinect (openni)
     """
-    setup()
+    if renderer == 'numpy':
+        import stencil_numpy
+        return stencil_numpy.render_blocks(occ_grid, modelmat, rect, bg, size,
+                                           bounds)
+    return render_blocks_gl(occ_grid, modelmat, rect, bg, size, bounds)
+
+
+def render_blocks_gl(occ_grid, modelmat, rect=None, bg=None, size=None,
+                     bounds=None):
+    """render_blocks, drawn with OpenGL in the current context."""
+    if bg is None:
+        bg = config.bg
+    if bounds is None:
+        bounds = config.bounds
+    if size is None:
+        size = config.image_size(bg)
+    if rect is None:
+        rect = ((0,0),size)
+    W, H = size
+    fbo = setup(size)
     glBindFramebuffer(GL_FRAMEBUFFER, fbo);
 
     (L,T),(R,B) = rect
 
     glDisable(GL_TEXTURE_2D)
     glEnable(GL_DEPTH_TEST)
-    #glViewport(L, 480-B, R-L, B-T)
-    glViewport(0, 0, 640, 480)
+    #glViewport(L, H-B, R-L, B-T)
+    glViewport(0, 0, W, H)
     glClearColor(0,0,0,0)
     glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
     glMatrixMode(GL_PROJECTION)
     glLoadIdentity()
     #glOrtho(L, R, T, B, 0, -3000)
-    glOrtho(0, 640, 0, 480, -10, 0)
+    glOrtho(0, W, 0, H, -10, 0)
     glMatrixMode(GL_MODELVIEW)
     glLoadIdentity()
-    KtableKK = np.dot(config.bg['Ktable'], config.bg['KK'])
+    KtableKK = np.dot(bg['Ktable'], bg['KK'])
     glMultMatrixf(np.linalg.inv(KtableKK).transpose())
     glMultMatrixf(np.linalg.inv(modelmat).transpose())
 
     glScale(config.LW, config.LH, config.LW)
-    glTranslate(*config.bounds[0])
+    glTranslate(*bounds[0])
 
     blocks = blockdraw.grid_vertices(occ_grid, None)
 
@@ -117,43 +169,85 @@ def render_blocks(occ_grid, modelmat, rect=((0,0),(640,480))):
     readpixels = glReadPixels(L, T, R-L, B-T, GL_DEPTH_COMPONENT, GL_FLOAT)
     readpixelsA = glReadPixels(L, T, R-L, B-T, GL_RGBA, GL_UNSIGNED_BYTE,
                               outputType='array')
-    depth = np.empty((480,640),dtype='f')
-    coords = np.empty((480,640,4),dtype='u1')
+    depth = np.empty((H,W),dtype='f')
+    coords = np.empty((H,W,4),dtype='u1')
     speedup_cy.stencil_finish(depth, coords, readpixels, readpixelsA, T, L, B, R)
     glBindFramebuffer(GL_FRAMEBUFFER,0)
     return coords, depth
 
 
-def stencil_carve(depth, modelmat, occ_grid, rgb=None, rect=((0,0),(640,480))):
+def stencil_carve(depth, modelmat, occ_grid, rgb=None, rect=None):
+    """
+    Render occ_grid and compare it against the depth image, counting for each
+    voxel the pixels that land on it (b_total), that agree (b_occ) and that
+    see through it (b_vac). The results are also stored in the module
+    globals (see stencil_stats).
     """
+    stats = stencil_stats(depth, modelmat, occ_grid, rgb, rect)
+    publish(stats)
+    return stats['b_occ'], stats['b_vac'], stats['b_total']
+
 
+def publish(stats):
+    """Store a stencil_stats() result in the module globals (b_occ, RGB, ...)
+    where the demos look for them."""
+    globals().update(stats)
+
+
+def stencil_stats(depth, modelmat, occ_grid, rgb=None,
+                  rect=None, bg=None, bounds=None, box=None):
     """
-    global coords, b_total, b_occ, b_vac, depthB
+    Same as stencil_carve, but returns everything it computes instead of
+    keeping it in module globals. occ_grid covers bounds, by default
+    config.bounds. If box (within bounds) is given, only the voxels in box
+    are drawn and counted, and the rest are left 0. Any box holding every
+    voxel seen through rect (see spacecarve.visible_box) gives the same
+    result as all of bounds.
 
+    Returns:
+        dict(b_occ, b_vac, b_total, RGB, coords, depthB). coords are the
+        grid indices within box.
+    """
+    size = depth.shape[::-1]
+    if rect is None:
+        rect = ((0,0),size)
     (L,T),(R,B) = rect
     L,T,R,B = map(int, (L,T,R,B))
+    if bounds is None:
+        bounds = config.bounds
+    if not box is None and tuple(map(tuple, box)) != tuple(map(tuple, bounds)):
+        inside = tuple(slice(b0-g0, b1-g0)
+                       for g0, b0, b1 in zip(bounds[0], *box))
+        stats = stencil_stats(depth, modelmat, occ_grid[inside], rgb, rect,
+                              bg, box)
+        for name in ('b_occ', 'b_vac', 'b_total', 'RGB'):
+            a = np.zeros(occ_grid.shape + stats[name].shape[3:],
+                         stats[name].dtype)
+            a[inside] = stats[name]
+            stats[name] = a
+        return stats
     coords, depthB = render_blocks(occ_grid,
                                    modelmat,
-                                   rect=rect)
+                                   rect=rect, bg=bg, size=size,
+                                   bounds=bounds)
     #print depth.mean(), occ_grid.mean(), rect, depthB.mean()
     assert coords.dtype == np.uint8
     assert depthB.dtype == np.float32
     assert depth.dtype == np.uint16
     assert coords.shape[2] == 4
-    assert coords.shape[:2] == depthB.shape == depth.shape == (480,640)
+    assert coords.shape[:2] == depthB.shape == depth.shape
 
     b_total = np.zeros(occ_grid.shape, 'f')
     b_occ = np.zeros(occ_grid.shape, 'f')
     b_vac = np.zeros(occ_grid.shape, 'f')
 
-    gridmin = np.array(config.bounds[0])
-    gridmax = np.array(config.bounds[1])
+    gridmin = np.array(bounds[0])
+    gridmax = np.array(bounds[1])
     gridlen = gridmax-gridmin
 
     if rgb is None:
-        rgb = np.empty((480,640,3),'u1')
+        rgb = np.empty(depth.shape+(3,),'u1')
 
-    global RGBacc, RGB, HSV
     RGBacc = np.zeros((b_total.shape[0],
                        b_total.shape[1],
                        b_total.shape[2], 3),'i')
@@ -200,4 +294,5 @@ def stencil_carve(depth, modelmat, occ_grid, rgb=None, rect=((0,0),(640,480))):
         RGB = np.asarray(RGBm).reshape(RGB.shape)
     else:
         RGB = (RGB.astype('i')*4).clip(0,255)
-    return b_occ, b_vac, b_total
+    return dict(b_occ=b_occ, b_vac=b_vac, b_total=b_total, RGB=RGB,
+                coords=coords, depthB=depthB)
@@ -0,0 +1,193 @@
+# Andrew Miller <amiller@cs.ucf.edu> 2011
+#
+# BlockPlayer - 3D model reconstruction using the Lattice-First algorithm
+# See:
+#    "Interactive 3D Model Acquisition and Tracking of Building Block Structures"
+#    Andrew Miller, Brandyn White, Emiko Charbonneau, Zach Kanzler, and Joseph J. LaViola Jr.
+#    IEEE VR 2012, IEEE TVGC 2012
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# A software version of stencil.render_blocks, for running without an
+# OpenGL context. It's selected with stencil.set_renderer('numpy') (or
+# BLOCKPLAYER_RENDERER=numpy). The blocks are drawn the way the fixed
+# function pipeline draws them in render_blocks: the same modelview matrix,
+# pixels sampled at their centers, a GL_LESS depth test, and near/far
+# clipping from the glOrtho call.
+import numpy as np
+import config
+
+# The four corners of each face of a unit cube, going around the face,
+# along with the axis and the side of the cube it's on
+_faces = []
+for _axis in range(3):
+    for _side in (0,1):
+        _a, _b = [i for i in range(3) if i != _axis]
+        _quad = np.zeros((4,3),'i')
+        _quad[:,_axis] = _side
+        _quad[:,_a] = [0,1,1,0]
+        _quad[:,_b] = [0,0,1,1]
+        _faces.append((_axis, _side, _quad))
+
+
+def modelview(modelmat, bg, bounds=None):
+    """The matrix render_blocks builds with glMultMatrix/glScale/glTranslate,
+    taking grid vertices to (u*w, v*w, q*w, w) where q is the reciprocal
+    depth in 1/meters. The grid covers bounds, by default config.bounds."""
+    if bounds is None:
+        bounds = config.bounds
+    KtableKK = np.dot(bg['Ktable'], bg['KK'])
+    S = np.diag([config.LW, config.LH, config.LW, 1])
+    T = np.eye(4)
+    T[:3,3] = bounds[0]
+    return reduce(np.dot, [np.linalg.inv(KtableKK),
+                           np.linalg.inv(modelmat), S, T])
+
+
+def _camera_center(M):
+    # The grid point that projects to u*w = v*w = w = 0
+    _,_,V = np.linalg.svd(M[[0,1,3],:])
+    C = V[-1]
+    return C[:3] / C[3]
+
+
+def render_blocks(occ_grid, modelmat, rect=None, bg=None, size=None,
+                  bounds=None):
+    """
+    Same as stencil.render_blocks, computed with numpy. Only the faces that
+    point toward the camera are drawn, which gives the same picture for
+    closed blocks. The image is size (width, height), by default that of
+    the calibration bg.
+        returns:
+            coords: numpy array shape=(H,W,4) dtype=np.uint8, the grid
+                    index of the block seen at each pixel (0 where there is
+                    none), then 255 like the alpha GL reads from an RGB fbo
+            depthB: numpy array shape=(H,W) dtype=np.float32,
+                    distance in mm, just like the kinect (openni)
+    """
+    if bg is None:
+        bg = config.bg
+    if size is None:
+        size = config.image_size(bg)
+    if rect is None:
+        rect = ((0,0),size)
+    (L,T),(R,B) = rect
+    L,T,R,B = map(int, (L,T,R,B))
+
+    # Outside the rect, and where no block is drawn, this is what comes out
+    # of an empty depth buffer in stencil_finish
+    W, H = size
+    coords = np.zeros((H,W,4),'u1')
+    coords[T:B,L:R,3] = 255
+    depthB = np.empty((H,W),'f')
+    depthB[:] = 100.0/(1.000001 - 1)
+
+    blocks = np.array(occ_grid.nonzero()).transpose()
+    if len(blocks) == 0 or R <= L or B <= T:
+        return coords, depthB
+
+    M = modelview(modelmat, bg, bounds)
+    C = _camera_center(M)
+
+    # Gather the corners of the faces that can be seen: the ones facing the
+    # camera, that aren't against a neighboring block
+    occ = np.zeros(np.add(occ_grid.shape, 2), bool)
+    occ[1:-1,1:-1,1:-1] = occ_grid
+    quads = []
+    for axis, side, quad in _faces:
+        front = (C[axis] - (blocks[:,axis] + side)) * (side*2-1) > 0
+        step = np.zeros(3,'i')
+        step[axis] = side*2-1
+        n = blocks[front] + 1 + step
+        front[front] = ~occ[n[:,0],n[:,1],n[:,2]]
+        quads.append((blocks[front].reshape(-1,1,3) + quad,
+                      blocks[front]))
+    verts = np.concatenate([q for q,_ in quads]).astype('f')
+    owner = np.concatenate([b for _,b in quads])
+    if len(verts) == 0:
+        return coords, depthB
+
+    # Project the corners to the screen
+    M = M.astype('f')
+    X = np.dot(verts, M[:3,:3].transpose()) + M[:3,3]
+    Xw = np.dot(verts, M[3,:3]) + M[3,3]
+    # Anything crossing behind the camera would be clipped by GL; drop it
+    ok = np.all(Xw > 0, 1)
+    X, Xw, owner = X[ok], Xw[ok], owner[ok]
+    u = X[:,:,0] / Xw
+    v = X[:,:,1] / Xw
+    q = X[:,:,2] / Xw
+
+    # The reciprocal depth of a plane is linear in screen space. Fit it from
+    # three corners
+    du1, dv1, dq1 = u[:,1]-u[:,0], v[:,1]-v[:,0], q[:,1]-q[:,0]
+    du2, dv2, dq2 = u[:,2]-u[:,0], v[:,2]-v[:,0], q[:,2]-q[:,0]
+    area = du1*dv2 - dv1*du2
+    ok = np.abs(area) > 1e-6
+    u, v, q, owner, area = u[ok], v[ok], q[ok], owner[ok], area[ok]
+    du1, dv1, dq1 = du1[ok], dv1[ok], dq1[ok]
+    du2, dv2, dq2 = du2[ok], dv2[ok], dq2[ok]
+    qu = (dq1*dv2 - dv1*dq2) / area
+    qv = (du1*dq2 - dq1*du2) / area
+    q0 = q[:,0] - qu*u[:,0] - qv*v[:,0]
+
+    # Each edge as a line a*u + b*v + c, positive on the inside
+    sign = np.sign(area)
+    ub, vb = np.roll(u, -1, 1), np.roll(v, -1, 1)
+    ea = (v - vb) * sign[:,None]
+    eb = (ub - u) * sign[:,None]
+    ec = -(ea*u + eb*v)
+
+    # The rows (by their centers) each face covers
+    i0 = np.maximum(np.ceil(v.min(1) - 0.5), T).astype('i')
+    i1 = np.minimum(np.floor(v.max(1) - 0.5), B-1).astype('i')
+    h = np.maximum(i1-i0+1, 0)
+    if h.sum() == 0:
+        return coords, depthB
+    rf = np.repeat(np.arange(len(h), dtype='i'), h)
+    py = i0[rf] + np.arange(h.sum(), dtype='i') - np.repeat(np.cumsum(h)-h, h)
+    pv = py + np.float32(0.5)
+
+    # Along each row, each edge bounds the face on the left (a > 0) or the
+    # right (a < 0). Find the span of pixel centers inside all four.
+    a = ea[rf]
+    c = eb[rf]*pv[:,None] + ec[rf]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = -c / a
+    lo = np.where(a > 0, t, -np.inf).max(1)
+    hi = np.where(a < 0, t, np.inf).min(1)
+    hi[np.any((a == 0) & (c < 0), 1)] = -np.inf
+    j0 = np.maximum(np.ceil(lo - 0.5), L)
+    j1 = np.minimum(np.floor(hi - 0.5), R-1)
+    n = np.maximum(j1-j0+1, 0).astype('i')
+    if n.sum() == 0:
+        return coords, depthB
+
+    span = np.repeat(np.arange(len(n), dtype='i'), n)
+    face = rf[span]
+    py = py[span]
+    px = j0.astype('i')[span] + (np.arange(n.sum(), dtype='i') -
+                                 np.repeat(np.cumsum(n)-n, n))
+    pq = q0[face] + qu[face]*(px + np.float32(0.5)) + qv[face]*pv[span]
+
+    # glOrtho(..., -10, 0) puts the near plane at 10cm
+    ok = (pq >= 0) & (pq <= 10)
+    face, px, py, pq = face[ok], px[ok], py[ok], pq[ok]
+    if len(face) == 0:
+        return coords, depthB
+
+    # Depth test: the nearest (largest reciprocal depth) face at each pixel.
+    # pq is positive, so its bits sort the same way it does
+    pix = py*W + px
+    key = (pix.astype('i8') << 32) | pq.astype('f').view('u4')
+    order = np.argsort(key)
+    pix, face, pq = pix[order], face[order], pq[order]
+    last = np.ones(len(pix), bool)
+    last[:-1] = pix[1:] != pix[:-1]
+    pix, face, pq = pix[last], face[last], pq[last]
+
+    coords.reshape(-1,4)[pix,:3] = owner[face]
+    depthB.reshape(-1)[pix] = 100.0/(0.1*pq + 0.000001)
+    return coords, depthB
@@ -0,0 +1,309 @@
+# Andrew Miller <amiller@cs.ucf.edu> 2011
+#
+# BlockPlayer - 3D model reconstruction using the Lattice-First algorithm
+# See:
+#    "Interactive 3D Model Acquisition and Tracking of Building Block Structures"
+#    Andrew Miller, Brandyn White, Emiko Charbonneau, Zach Kanzler, and Joseph J. LaViola Jr.
+#    IEEE VR 2012, IEEE TVGC 2012
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Synthetic kinect frames of a block structure sitting on a table, for
+# running the tracker without a camera or a recorded dataset, and at sizes
+# we can't record. The table and the calibration for it are made up too
+# (see calibration()), in the same form table_calibration produces.
+#
+#   bg = synthetic.calibration()
+#   for depth, rgb, modelmat in synthetic.generate(occ, bg,
+#                                                  synthetic.turntable(150)):
+#       main.update_frame(depth, rgb)
+#
+# The camera stays where the calibration puts it, as it does for the real
+# system (the background model depends on it). Trajectories move the
+# structure around on the table instead, which from the structure's point
+# of view is the same as moving the camera.
+import numpy as np
+import os
+import cPickle as pickle
+import config
+import calibkinect
+import stencil_numpy
+
+# The kinect's disparity to depth conversion: depth (mm) is
+# 1000 / (raw*kinect_disparity[0] + kinect_disparity[1]) for integer raw
+kinect_disparity = (-0.0030711016, 3.3309495161)
+
+
+def look_at(eye, target=(0,0,0)):
+    """Ktable for a camera at eye (in table coordinates, meters, Y up)
+    pointed at target. The camera looks down its -Z axis."""
+    eye = np.asarray(eye, 'f8')
+    back = eye - target
+    back /= np.linalg.norm(back)
+    right = np.cross([0,1,0], back)
+    right /= np.linalg.norm(right)
+    up = np.cross(back, right)
+    Ktable = np.eye(4)
+    Ktable[:3,:3] = np.vstack((right, up, back)).T
+    Ktable[:3,3] = eye
+    return Ktable.astype('f')
+
+
+def camera(distance=0.8, elevation=np.pi/4, azimuth=0.0, target=(0,0,0)):
+    """Ktable for a camera distance meters from target, elevation radians
+    above the table, azimuth radians around it."""
+    eye = np.array(target, 'f8') + distance * np.array(
+        [np.cos(elevation)*np.sin(azimuth), np.sin(elevation),
+         np.cos(elevation)*np.cos(azimuth)])
+    return look_at(eye, target)
+
+
+def projection(size=(640,480)):
+    """calibkinect.projection(), for an image of size (width, height) with
+    the same field of view."""
+    P = calibkinect.projection().astype('f8')
+    P[0] *= size[0] / 640.
+    P[1] *= size[1] / 480.
+    return P
+
+
+def _pixels(size):
+    v,u = np.mgrid[:size[1],:size[0]].astype('f')
+    return u+0.5, v+0.5
+
+
+def table_depth(bg, size=None):
+    """Depth (mm) of the table plane at each pixel, and where it's inside
+    the table (within boundptsM)."""
+    if size is None:
+        size = config.image_size(bg)
+    M = np.dot(bg['Ktable'], bg['KK']).astype('f8')
+    u,v = _pixels(size)
+    # The table is y=0. Solve for the reciprocal depth there
+    q = -(M[1,0]*u + M[1,1]*v + M[1,3]) / M[1,2]
+    X = [M[i,0]*u + M[i,1]*v + M[i,2]*q + M[i,3] for i in range(4)]
+    x, z = X[0]/X[3], X[2]/X[3]
+    (x0,_,z0),(x1,_,z1) = np.min(bg['boundptsM'],0), np.max(bg['boundptsM'],0)
+    inside = (q > 0) & (x >= x0) & (x <= x1) & (z >= z0) & (z <= z1)
+    depth = np.zeros(q.shape)
+    depth[inside] = 1000. / q[inside]
+    return depth, inside
+
+
+def calibration(Ktable=None, table=0.6, margin=8, size=(640,480)):
+    """A bg dict for a square table, table meters on a side, seen by a camera
+    at Ktable (see camera()) making images of size (width, height). bgHi is
+    the table depth less margin mm, so anything that far above the table is
+    foreground."""
+    if Ktable is None:
+        Ktable = camera()
+    h = table/2.
+    boundptsM = [[-h,0,-h], [h,0,-h], [h,0,h], [-h,0,h]]
+    KK = np.linalg.inv(projection(size)).astype('f')
+    bg = dict(KK=np.ascontiguousarray(KK),
+              Ktable=np.ascontiguousarray(Ktable, 'f'),
+              boundptsM=boundptsM)
+    depth, inside = table_depth(bg, size)
+    bg['bgHi'] = np.where(inside, np.maximum(depth-margin, 0), 0).astype('u2')
+    bg['bgLo'] = np.zeros(depth.shape,'u2')
+
+    # Where the corners of the table are in the image
+    M = np.linalg.inv(np.dot(bg['Ktable'], bg['KK']))
+    uvqw = np.dot(M, np.hstack((boundptsM, np.ones((4,1)))).T)
+    bg['boundpts'] = (uvqw[:2] / uvqw[3]).T
+    return bg
+
+
+def modelmat(angle=0.0, offset=(0,0)):
+    """The modelmat (see main.Tracker.R_correct) for the structure turned
+    angle radians about the vertical and moved offset meters across the
+    table, in x and z."""
+    c, s = np.cos(angle), np.sin(angle)
+    R = np.eye(4)
+    R[0,0], R[0,2], R[2,0], R[2,2] = c, s, -s, c
+    R[0,3], R[2,3] = offset
+    return np.linalg.inv(R)
+
+
+def turntable(frames=150, speed=np.pi/150, offset=(0,0)):
+    """A trajectory (a list of modelmats) of the structure being turned in
+    place, speed radians per frame: a half turn in five seconds, by
+    default."""
+    return [modelmat(i*speed, offset) for i in range(frames)]
+
+
+def wander(frames=150, seed=0, turn=0.02, move=0.002, reach=0.1):
+    """A trajectory of the structure being pushed around the table: a random
+    walk of up to turn radians and move meters per frame, kept within reach
+    meters of the middle."""
+    rng = np.random.RandomState(seed)
+    angle, pos, vel = 0.0, np.zeros(2), np.zeros(2)
+    spin = 0.0
+    mats = []
+    for i in range(frames):
+        mats.append(modelmat(angle, pos))
+        spin = np.clip(spin + rng.randn()*turn/4, -turn, turn)
+        vel = vel + rng.randn(2)*move/4 - pos/reach*move/4
+        vel *= min(1, move/max(np.linalg.norm(vel), 1e-9))
+        angle += spin
+        pos = pos + vel
+    return mats
+
+
+def random_structure(blocks=40, seed=0, shape=(36,9,36)):
+    """A random occupancy grid of `blocks` blocks, each sitting on the
+    table or on another block, grown outward from the middle."""
+    rng = np.random.RandomState(seed)
+    occ = np.zeros(shape, bool)
+    X, _, Z = shape
+    occ[X/2, 0, Z/2] = True
+    count = 1
+    while count < blocks:
+        # Pick a block, and put a new one next to it or on top of it
+        xs, ys, zs = occ.nonzero()
+        i = rng.randint(len(xs))
+        x, y, z = xs[i], ys[i], zs[i]
+        dx, dy, dz = [(1,0,0),(-1,0,0),(0,0,1),(0,0,-1),(0,1,0)][rng.randint(5)]
+        x, y, z = x+dx, y+dy, z+dz
+        if not (2 <= x < X-2 and 0 <= y < shape[1] and 2 <= z < Z-2):
+            continue
+        # Let it fall until it's resting on something
+        while y > 0 and not occ[x,y-1,z]:
+            y -= 1
+        if not occ[x,y,z]:
+            occ[x,y,z] = True
+            count += 1
+    return occ
+
+
+class NoiseBank(object):
+    """Stands in for a np.random.RandomState in kinect_noise and generate(),
+    handing out windows of a few frames worth of noise made up front, at
+    random offsets. Making fresh noise for each frame takes longer than
+    rendering it."""
+    def __init__(self, size, seed=0):
+        self.rng = np.random.RandomState(seed)
+        self._normal = self.rng.standard_normal(size*2).astype('f')
+        self._uniform = self.rng.random_sample(size*2).astype('f')
+
+    def _window(self, bank, size):
+        n = int(np.prod(size))
+        assert n <= len(bank)/2
+        i = self.rng.randint(len(bank) - n + 1)
+        return bank[i:i+n].reshape(size)
+
+    def standard_normal(self, size):
+        return self._window(self._normal, size)
+
+    def random_sample(self, size):
+        return self._window(self._uniform, size)
+
+
+def kinect_noise(depth, rng, sigma=2.85e-6, quantize=True, dropout=0.002,
+                 edges=0.5):
+    """Make a clean depth image (mm, float) look like the kinect's.
+    Params:
+        sigma: the noise grows with the square of the depth: its standard
+               deviation is sigma*depth**2 (mm), about 1.8mm at 80cm
+        quantize: round to the depths the kinect can report (its disparity
+                  steps, see kinect_disparity), not just to the mm
+        dropout: the fraction of pixels, anywhere, with no reading
+        edges: the fraction of the pixels at depth discontinuities (where
+               the kinect has trouble matching) with no reading
+    Returns:
+        uint16 depth
+    """
+    valid = depth > 0
+    d = depth.copy()
+    if sigma:
+        d += rng.standard_normal(d.shape) * sigma * d*d
+    if quantize:
+        a, b = kinect_disparity
+        raw = np.round((1000. / np.maximum(d[valid], 1) - b) / a)
+        d[valid] = 1000. / (raw*a + b)
+    if edges:
+        jump = np.zeros(d.shape, bool)
+        dv = np.abs(np.diff(depth, axis=0)) > 0.02*depth[1:]
+        du = np.abs(np.diff(depth, axis=1)) > 0.02*depth[:,1:]
+        jump[1:] |= dv
+        jump[:-1] |= dv
+        jump[:,1:] |= du
+        jump[:,:-1] |= du
+        valid &= ~(jump & (rng.random_sample(d.shape) < edges))
+    if dropout:
+        valid &= rng.random_sample(d.shape) >= dropout
+    d[~valid] = 0
+    return np.clip(np.round(d), 0, 65535).astype('u2')
+
+
+def render(occ, mat, bg, table=None, table_color=(90,90,90)):
+    """A clean frame of occ at modelmat mat on the table of bg.
+    Params:
+        table: table_depth(bg), if it's already been computed
+    Returns:
+        depth: (height,width) float, mm, 0 where there's nothing
+        rgb: (height,width,3) uint8
+    """
+    size = config.image_size(bg)
+    if table is None:
+        table = table_depth(bg, size)
+    depth, inside = table[0].copy(), table[1]
+    coords, depthB = stencil_numpy.render_blocks(occ, mat, ((0,0),size), bg,
+                                                 size)
+    blocks = depthB < 1e6
+    depth[blocks] = depthB[blocks]
+
+    rgb = np.zeros(depth.shape + (3,),'u1')
+    rgb[inside] = table_color
+    # Color each block by its position, so neighbors look different
+    c = coords[blocks,:3].astype('i4')
+    rgb[blocks] = 64 + (c * [53,97,29] + c[:,[1,2,0]] * [17,41,71]) % 160
+    return depth, rgb
+
+
+def generate(occ, bg, trajectory, noise=(), rgb_noise=2.0, seed=0):
+    """Frames of occ following trajectory (a sequence of modelmats, see
+    turntable() and wander()), as the kinect would see them from the camera
+    of bg. Pass noise=None for exact depths (rounded to the mm), or the
+    arguments for kinect_noise (a dict, or (name, value) pairs).
+    Yields:
+        depth (uint16, mm), rgb (uint8), modelmat
+    """
+    table = table_depth(bg)
+    rng = NoiseBank(table[0].size*3, seed)
+    for mat in trajectory:
+        depth, rgb = render(occ, mat, bg, table)
+        if noise is None:
+            depth = np.round(depth).astype('u2')
+        else:
+            depth = kinect_noise(depth, rng, **dict(noise))
+        if rgb_noise:
+            n = rng.standard_normal(rgb.shape) * rgb_noise
+            rgb = np.clip(rgb + n, 0, 255).astype('u1')
+        yield depth, rgb, mat
+
+
+def write_dataset(path, occ, bg, trajectory, fps=30., **kwargs):
+    """Generate frames (see generate) into a new dataset at path, that
+    dataset.load_dataset can read: the calibration and ground truth under
+    config/, and the frames, with timestamps fps apart, in a container.
+    Returns the number of frames."""
+    import container
+    import grid
+    os.makedirs(os.path.join(path, 'config'))
+    with open(os.path.join(path, 'config', 'config.pkl'), 'w') as f:
+        pickle.dump(dict(bg=bg, LH=config.LH, LW=config.LW), f)
+    with open(os.path.join(path, 'config', 'gt.txt'), 'w') as f:
+        f.write(grid.grid2gt(occ))
+
+    size = config.image_size(bg)
+    frames = 0
+    with container.Writer(container.container_path(path), size[::-1],
+                          size[::-1] + (3,)) as w:
+        for depth, rgb, _ in generate(occ, bg, trajectory, **kwargs):
+            # Numbered from 1, where dataset.advance() starts
+            frames += 1
+            w.add(frames, depth, rgb, frames / fps)
+    return frames
@@ -92,7 +92,8 @@ def find_plane(depth, boundpts):
         window = CameraWindow()
 
     # Build a mask of the image inside the convex points clicked
-    mask = make_mask(boundpts)
+    H, W = depth.shape
+    mask = make_mask(boundpts, (W,H))
 
     # Borrow the initialization from calibkinect
     KK = np.linalg.inv(calibkinect.projection()).astype('f')
@@ -146,18 +147,18 @@ def find_plane(depth, boundpts):
 
     rb,rbc = glGenRenderbuffers(2)
     glBindRenderbuffer(GL_RENDERBUFFER, rb);
-    glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, 640, 480)
+    glRenderbufferStorage(GL_RENDERBUFFER, GL_DEPTH_COMPONENT24, W, H)
     glFramebufferRenderbuffer(GL_FRAMEBUFFER,
                               GL_DEPTH_ATTACHMENT,
                               GL_RENDERBUFFER, rb);
     glEnable(GL_DEPTH_TEST)
     glClear(GL_DEPTH_BUFFER_BIT)
-    glViewport(0, 0, 640, 480)
+    glViewport(0, 0, W, H)
     glMatrixMode(GL_MODELVIEW)
     glLoadIdentity()
     glMatrixMode(GL_PROJECTION)
     glLoadIdentity()
-    glOrtho(0,640,0,480,0,-10)
+    glOrtho(0,W,0,H,0,-10)
     glMultMatrixf(np.linalg.inv(KtableKK).T)
 
     def draw():
@@ -179,14 +180,14 @@ def find_plane(depth, boundpts):
     gf = glGetIntegerv(GL_FRONT_FACE)
     glFrontFace(GL_CCW)
     draw()
-    openglbgHi = glReadPixels(0, 0, 640, 480,
-                              GL_DEPTH_COMPONENT, GL_FLOAT).reshape(480,640)
+    openglbgHi = glReadPixels(0, 0, W, H,
+                              GL_DEPTH_COMPONENT, GL_FLOAT).reshape(H,W)
 
     # Rendering the interior faces gives us the table plane and the far walls
     glFrontFace(GL_CW)
     draw()
-    openglbgLo = glReadPixels(0, 0, 640, 480,
-                              GL_DEPTH_COMPONENT, GL_FLOAT).reshape(480,640)
+    openglbgLo = glReadPixels(0, 0, W, H,
+                              GL_DEPTH_COMPONENT, GL_FLOAT).reshape(H,W)
     glFrontFace(gf)
 
     # We need to invert the depth measurements to obtain kinect-style range
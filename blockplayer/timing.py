@@ -0,0 +1,147 @@
+# Andrew Miller <amiller@cs.ucf.edu> 2011
+#
+# BlockPlayer - 3D model reconstruction using the Lattice-First algorithm
+# See:
+#    "Interactive 3D Model Acquisition and Tracking of Building Block Structures"
+#    Andrew Miller, Brandyn White, Emiko Charbonneau, Zach Kanzler, and Joseph J. LaViola Jr.
+#    IEEE VR 2012, IEEE TVGC 2012
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+# Timers for the stages of main.Tracker.update_frame. Each stage keeps its
+# most recent `window` durations, which the histograms and percentiles are
+# computed from when asked for, along with a running count and total. Adding
+# a sample is a couple of time.time() calls and an array store, so this is
+# left on. BLOCKPLAYER_TIMING=0 turns it off.
+import numpy as np
+import time
+import json
+import os
+
+enabled = os.environ.get('BLOCKPLAYER_TIMING', '1') != '0'
+
+# Histogram bins, in seconds: 10us to 10s, four per decade
+edges = np.logspace(-5, 1, 25)
+
+
+class _Stage(object):
+    # The context manager returned by Timings.stage. One per stage name, so
+    # timing a stage doesn't allocate anything
+    __slots__ = ('timings', 'name', 't0')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.time()
+
+    def __exit__(self, *args):
+        self.timings.add(self.name, time.time() - self.t0)
+
+
+class _Null(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+_null = _Null()
+
+
+class Timings(object):
+    """Durations of named stages, and counts of how frames turned out.
+
+        with timings.stage('normals'):
+            ...
+        timings.outcome('ok')
+    """
+    def __init__(self, window=1000):
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.names = []
+        self.outcomes = {}
+        self._stages = {}
+        self._samples = {}
+        self._count = {}
+        self._total = {}
+
+    def stage(self, name):
+        """A context manager that adds the time spent inside it to name."""
+        if not enabled:
+            return _null
+        try:
+            return self._stages[name]
+        except KeyError:
+            s = self._stages[name] = _Stage(self, name)
+            return s
+
+    def add(self, name, seconds):
+        if not name in self._samples:
+            self.names.append(name)
+            self._samples[name] = np.zeros(self.window)
+            self._count[name] = 0
+            self._total[name] = 0.0
+        n = self._count[name]
+        self._samples[name][n % self.window] = seconds
+        self._count[name] = n + 1
+        self._total[name] += seconds
+
+    def outcome(self, reason):
+        """Count a frame as having ended with reason (e.g. 'ok', or why
+        update_frame gave up on it)."""
+        self.outcomes[reason] = self.outcomes.get(reason, 0) + 1
+
+    def samples(self, name):
+        """The most recent durations of name, oldest first."""
+        a, n = self._samples[name], self._count[name]
+        if n <= self.window:
+            return a[:n].copy()
+        i = n % self.window
+        return np.concatenate((a[i:], a[:i]))
+
+    def histogram(self, name):
+        """Counts of the recent durations of name in each of the bins
+        between edges. The first and last also take anything outside."""
+        s = np.clip(self.samples(name), edges[0], edges[-1])
+        return np.histogram(s, edges)[0]
+
+    def summary(self, name):
+        """Stats for name, in seconds. count/total/mean are over every
+        sample, the percentiles and max over the recent ones."""
+        s = self.samples(name)
+        count, total = self._count[name], self._total[name]
+        p50, p90, p99 = np.percentile(s, [50,90,99]) if len(s) else (0,0,0)
+        return dict(count=count, total=total,
+                    mean=total/count if count else 0.0,
+                    p50=p50, p90=p90, p99=p99,
+                    max=s.max() if len(s) else 0.0)
+
+    def as_dict(self):
+        return dict(edges=edges.tolist(),
+                    outcomes=self.outcomes,
+                    stages=[dict(name=name,
+                                 histogram=self.histogram(name).tolist(),
+                                 **self.summary(name))
+                            for name in self.names])
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def report(self):
+        """A table of the stages, in milliseconds."""
+        lines = ['%-24s %7s %8s %8s %8s %8s' %
+                 ('stage', 'count', 'mean', 'p50', 'p90', 'p99')]
+        for name in self.names:
+            s = self.summary(name)
+            lines.append('%-24s %7d %8.2f %8.2f %8.2f %8.2f' %
+                         (name, s['count'], s['mean']*1e3, s['p50']*1e3,
+                          s['p90']*1e3, s['p99']*1e3))
+        lines.append(', '.join('%s: %d' % kv
+                               for kv in sorted(self.outcomes.items())))
+        return '\n'.join(lines)
@@ -0,0 +1,88 @@
+import sys
+import timeit
+import numpy as np
+
+from blockplayer import config
+from blockplayer import opencl
+from blockplayer import opencl_numpy
+
+
+def synthetic_frame(rect):
+    """A tilted table with a box sitting on it, in the form the kernels
+    take as input (reciprocal depth, see calibkinect.recip_depth_openni)"""
+    (L,T),(R,B) = rect
+    v,u = np.mgrid[T:B,L:R].astype('f')
+    raw = 1.2 + 0.001*(v-T) + 0.0004*(u-L)
+    h, w = B-T, R-L
+    raw[h/4:h/2,w/4:w/2] += 0.08
+    raw = raw.astype('f')
+    mask = np.ones(raw.shape, 'u1')
+    return raw, raw.copy(), mask
+
+
+def run_stages(buffers, rect, iters):
+    raw, filt, mask = synthetic_frame(rect)
+    M = np.eye(4,dtype='f')[:3,:]
+    gridmin = np.zeros((4,),'f')
+    gridmax = np.zeros((4,),'f')
+    gridmin[:3] = config.bounds[0]
+    gridmax[:3] = config.bounds[1]
+
+    def normals():
+        buffers.set_rect(rect)
+        buffers.load_filt(filt)
+        buffers.load_raw(raw)
+        buffers.load_mask(mask)
+        buffers.compute_normals().wait()
+
+    def flatrot():
+        buffers.compute_flatrot(M)
+        buffers.reduce_flatrot()
+
+    def lattice2():
+        buffers.compute_lattice2(M, config.LW)
+        buffers.reduce_lattice2()
+
+    def gridinds():
+        buffers.compute_gridinds(0, 0, config.LW, config.LH,
+                                 gridmin, gridmax)
+        buffers.get_gridinds()
+
+    def occvac():
+        buffers.compute_occvac(0, 0, config.LW, config.LH,
+                               gridmin, gridmax)
+        buffers.get_occvac()
+
+    stages = [('normals', normals), ('flatrot', flatrot),
+              ('lattice2', lattice2), ('gridinds', gridinds),
+              ('occvac', occvac)]
+    normals()  # Warm up, and leave valid inputs for the later stages
+    return [(name, timeit.timeit(f, number=iters)/iters)
+            for name, f in stages]
+
+
+def run(iters=20, sizes=(64, 128, 256, 480)):
+    mats = opencl.default_mats()
+    backends = [('numpy', opencl_numpy.Buffers(mats))]
+    try:
+        opencl.setup_context()
+        backends.insert(0, ('opencl', opencl.Buffers(mats)))
+    except Exception as e:
+        print "Skipping the opencl backend (%s)" % e
+
+    print '%8s %8s' % ('backend', 'pixels'),
+    print ' '.join('%10s' % name
+                   for name in ('normals','flatrot','lattice2','gridinds',
+                                'occvac')),
+    print '%10s' % 'total (ms)'
+    for size in sizes:
+        rect = ((0,0),(size,size))
+        for name, buffers in backends:
+            times = run_stages(buffers, rect, iters)
+            print '%8s %8d' % (name, size*size),
+            print ' '.join('%10.3f' % (t*1000) for _,t in times),
+            print '%10.3f' % (sum(t for _,t in times)*1000)
+
+
+if __name__ == '__main__':
+    run(*map(int, sys.argv[1:2]))
@@ -0,0 +1,140 @@
+"""Accuracy against frame rate for each setting of main.decimate, to choose
+one for a machine.
+
+Each sequence is replayed at every setting. The synthetic sequences (the
+ground truth structures of data/experiments/gt/, turned and moved around
+on the table, with kinect noise) come with the true pose of every frame.
+Recorded datasets (--sets) don't, so their poses are compared with those
+of the full resolution run instead.
+
+    python experiments/bench_decimate.py [--settings 1 2 4] [--sets ...]
+"""
+import os
+import glob
+import json
+import argparse
+import numpy as np
+
+from blockplayer import grid
+from blockplayer import synthetic
+import bench_replay
+
+
+def sequences(frames, trajectories=('turntable', 'wander')):
+    """Yields (name, frames, bg, GT, true poses)"""
+    bg = synthetic.calibration()
+    for filename in sorted(glob.glob(os.path.join(bench_replay.gt_path,
+                                                  'gt*.txt'))):
+        with open(filename) as f:
+            GT = grid.gt2grid(f.read())
+        gt = os.path.splitext(os.path.basename(filename))[0]
+        for trajectory in trajectories:
+            traj = getattr(synthetic, trajectory)(frames)
+            seq, mats = [], []
+            for depth, rgb, mat in synthetic.generate(GT, bg, traj):
+                seq.append((depth, rgb))
+                mats.append(mat)
+            yield '%s_%s' % (gt, trajectory), seq, bg, GT, mats
+
+
+def pose_errors(poses, truth):
+    """The distance (mm) and angle (degrees) between each pose and the true
+    one. Frames with no pose yet are nan."""
+    dist, angle = [], []
+    for R, T in zip(poses, truth):
+        if R is None or T is None:
+            dist.append(np.nan)
+            angle.append(np.nan)
+            continue
+        dist.append(np.sqrt(np.sum((R[:3,3] - T[:3,3])**2)) * 1000)
+        c = (np.trace(np.dot(R[:3,:3], np.transpose(T[:3,:3]))) - 1) / 2
+        angle.append(np.degrees(np.arccos(np.clip(c, -1, 1))))
+    return np.array(dist), np.array(angle)
+
+
+def compare(seq, bg, GT, truth, settings):
+    """Replay seq at each setting.
+    Returns:
+        {setting: dict(fps, p50 ms, ok fraction, pose errors, grid errors)}
+    """
+    results = {}
+    for decimate in settings:
+        t, elapsed, poses = bench_replay.track(seq, bg, GT, decimate)
+        if truth is None:
+            # Against the full resolution run, which is always first
+            truth = poses
+        dist, angle = pose_errors(poses, truth)
+        lost = np.isnan(dist)
+        dist, angle = dist[~lost], angle[~lost]
+        r = results[decimate] = dict(
+            fps=len(seq)/elapsed,
+            p50=t.timings.summary('update_frame')['p50']*1e3,
+            ok=t.timings.outcomes.get('ok', 0) / float(len(seq)),
+            lost=int(lost.sum()),
+            mm_mean=float(dist.mean()) if len(dist) else np.nan,
+            mm_max=float(dist.max()) if len(dist) else np.nan,
+            deg_max=float(angle.max()) if len(angle) else np.nan)
+        if not GT is None:
+            r['grid_errors'] = int(np.sum(t.grid.dense('occ') != GT))
+    return results
+
+
+def report(name, results):
+    print name
+    print '  %8s %8s %8s %6s %9s %9s %9s %6s' % (
+        'decimate', 'fps', 'p50 ms', 'ok', 'mm mean', 'mm max', 'deg max',
+        'grid')
+    for decimate, r in sorted(results.items()):
+        print '  %8d %8.1f %8.2f %5.0f%% %9.2f %9.2f %9.2f %6s' % (
+            decimate, r['fps'], r['p50'], r['ok']*100, r['mm_mean'],
+            r['mm_max'], r['deg_max'], r.get('grid_errors', '-'))
+
+
+def summarize(all_results, settings):
+    """Each setting's fps and pose error, averaged over the sequences."""
+    print 'all sequences'
+    print '  %8s %8s %8s %9s' % ('decimate', 'fps', 'ok', 'mm mean')
+    for decimate in settings:
+        rs = [r[decimate] for r in all_results.values()]
+        print '  %8d %8.1f %7.0f%% %9.2f' % (
+            decimate, np.mean([r['fps'] for r in rs]),
+            np.mean([r['ok'] for r in rs])*100,
+            np.nanmean([r['mm_mean'] for r in rs]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--frames', type=int, default=90,
+                        help='frames per sequence')
+    parser.add_argument('--settings', type=int, nargs='*', default=[1,2,4],
+                        help='values of main.decimate to try')
+    parser.add_argument('--sets', nargs='*', default=[],
+                        help='recorded datasets to replay as well')
+    parser.add_argument('--no-synthetic', action='store_true',
+                        help="don't replay the synthetic scenes")
+    parser.add_argument('--save', help='write the results here (json)')
+    args = parser.parse_args()
+    settings = sorted(set([1] + args.settings))
+
+    sources = []
+    if not args.no_synthetic:
+        sources.append(sequences(args.frames))
+    sources.append(bench_replay.recorded_sequence(p, args.frames) + (None,)
+                   for p in args.sets)
+
+    all_results = {}
+    for source in sources:
+        for name, seq, bg, GT, truth in source:
+            if not seq:
+                print '%s: no frames' % name
+                continue
+            all_results[name] = compare(seq, bg, GT, truth, settings)
+            report(name, all_results[name])
+    if all_results:
+        summarize(all_results, settings)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(dict((name, dict((str(d), r) for d, r in rs.items()))
+                           for name, rs in all_results.items()),
+                      f, indent=2, sort_keys=True)
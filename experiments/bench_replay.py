@@ -0,0 +1,249 @@
+"""Replay sequences through the tracker and report how fast it runs.
+
+The sequences are synthetic scenes built from the ground truth grids in
+data/experiments/gt/ (so this runs on a clean checkout), and optionally any
+recorded datasets given with --sets. The frames of each sequence are loaded
+into memory first, so only update_frame is timed.
+
+    python experiments/bench_replay.py --save baseline.json
+    ... change things ...
+    python experiments/bench_replay.py --baseline baseline.json
+
+With --baseline, anything that's slower than the baseline by more than
+--threshold (a fraction) is flagged, and the exit status is 1.
+"""
+import os
+import re
+import sys
+import glob
+import json
+import time
+import platform
+import argparse
+import numpy as np
+
+from blockplayer import config
+from blockplayer import dataset
+from blockplayer import grid
+from blockplayer import hashalign
+from blockplayer import keyframes
+from blockplayer import main
+from blockplayer import opencl
+from blockplayer import stencil
+from blockplayer import synthetic
+
+gt_path = 'data/experiments/gt'
+
+# Stage times below this (ms) are too small to call a regression on
+min_stage_ms = 0.2
+
+
+def synthetic_sequences(frames):
+    """A turntable sequence of each ground truth structure.
+    Yields (name, frames, bg, GT)"""
+    bg = synthetic.calibration()
+    for filename in sorted(glob.glob(os.path.join(gt_path, 'gt*.txt'))):
+        with open(filename) as f:
+            GT = grid.gt2grid(f.read())
+        name = 'synthetic_' + os.path.splitext(os.path.basename(filename))[0]
+        seq = [(depth, rgb) for depth, rgb, _ in
+               synthetic.generate(GT, bg, synthetic.turntable(frames),
+                                  noise=None, rgb_noise=0)]
+        yield name, seq, bg, GT
+
+
+def recorded_sequence(pathname, frames):
+    """The first frames of a recorded dataset, with its ground truth if it
+    has one (config/gt.txt, or the gt file for its _z?m_ number)."""
+    dataset.load_dataset(pathname)
+    name = os.path.basename(os.path.normpath(pathname))
+    GT = config.GT
+    m = re.match('.*_z(\d)m_.*', name)
+    if GT is None and m:
+        with open(os.path.join(gt_path, 'gt%s.txt' % m.group(1))) as f:
+            GT = grid.gt2grid(f.read())
+    seq = []
+    while len(seq) < frames:
+        try:
+            dataset.advance()
+        except IOError:
+            break
+        seq.append((dataset.depth.copy(), dataset.rgb.copy()))
+    return name, seq, config.bg, GT
+
+
+def track(seq, bg, GT=None, decimate=1, target_latency=None,
+          skip_unchanged=False):
+    """Run the frames of seq through a fresh Tracker. With target_latency
+    (seconds), it reconstructs only keyframes (see keyframes.Scheduler).
+    With skip_unchanged, it skips frames that are the same as the last (see
+    keyframes.ChangeDetector).
+    Returns:
+        the tracker, the seconds it took, and its R_correct after each frame
+    """
+    buffers = opencl.make_buffers((bg['KK'], bg['Ktable']))
+
+    def tracker():
+        scheduler = None
+        if not target_latency is None:
+            scheduler = keyframes.Scheduler(target_latency)
+        detector = keyframes.ChangeDetector() if skip_unchanged else None
+        t = main.Tracker(bg=bg, buffers=buffers, decimate=decimate,
+                         scheduler=scheduler, detector=detector)
+        t.initialize()
+        if not GT is None:
+            t.grid.initialize_with_groundtruth(GT)
+        return t
+
+    # The first frame pays for setting things up (compiling kernels and so
+    # on). Get that out of the way with a tracker we throw away
+    tracker().update_frame(*seq[0])
+
+    t = tracker()
+    poses = []
+    elapsed = 0
+    for depth, rgb in seq:
+        t0 = time.time()
+        t.update_frame(depth, rgb)
+        elapsed += time.time() - t0
+        poses.append(t.R_correct)
+    return t, elapsed, poses
+
+
+def replay(seq, bg, GT=None, decimate=1, target_latency=None,
+           skip_unchanged=False):
+    """Run the frames of seq through a fresh Tracker.
+    Returns:
+        dict of the fps, the stage timings (ms) and how the frames turned out
+    """
+    t, elapsed, _ = track(seq, bg, GT, decimate, target_latency,
+                          skip_unchanged)
+
+    stages = {}
+    for name in t.timings.names:
+        s = t.timings.summary(name)
+        stages[name] = dict((k, s[k]*1e3) for k in ('mean','p50','p90','p99'))
+        stages[name]['count'] = s['count']
+    result = dict(frames=len(seq), seconds=elapsed,
+                  fps=len(seq)/elapsed, stages=stages,
+                  outcomes=t.timings.outcomes, roi_searches=t.roi_searches,
+                  aligns=t.aligns)
+    if not t.scheduler is None:
+        result['keyframes'] = t.scheduler.counts
+    if not t.detector is None:
+        result['skips'] = t.detector.counts
+    if not GT is None:
+        result['grid_errors'] = int(np.sum(t.grid.dense('occ') != GT))
+    return result
+
+
+def run(frames=90, sets=(), synthetic_scenes=True, decimate=1,
+        target_latency=None, skip_unchanged=False):
+    results = dict(host=platform.node(),
+                   backend=opencl.resolve_backend(),
+                   renderer=stencil.renderer,
+                   grid=grid.storage,
+                   align=hashalign.search,
+                   decimate=decimate,
+                   target_latency=target_latency,
+                   skip_unchanged=skip_unchanged,
+                   frames=frames,
+                   sequences={})
+    sequences = []
+    if synthetic_scenes:
+        sequences.append(synthetic_sequences(frames))
+    sequences.append(recorded_sequence(p, frames) for p in sets)
+    for source in sequences:
+        for name, seq, bg, GT in source:
+            if not seq:
+                print '%s: no frames' % name
+                continue
+            r = results['sequences'][name] = replay(seq, bg, GT, decimate,
+                                                    target_latency,
+                                                    skip_unchanged)
+            print '%-28s %4d frames %7.1f fps' % (name, r['frames'], r['fps'])
+    return results
+
+
+def report(results):
+    seqs = results['sequences']
+    names = sorted(set(s for r in seqs.values() for s in r['stages']))
+    print
+    print '%-24s' % 'p50 / p99 (ms)' + ''.join('%16s' % n[:16]
+                                                for n in sorted(seqs))
+    for stage in names:
+        row = '%-24s' % stage
+        for seq in sorted(seqs):
+            s = seqs[seq]['stages'].get(stage)
+            row += '%16s' % ('%.2f / %.2f' % (s['p50'], s['p99'])
+                             if s else '-')
+        print row
+
+
+def compare(results, baseline, threshold=0.1):
+    """The ways results is slower than baseline by more than threshold: the
+    fps of each sequence, and the p50 of each stage.
+    Returns:
+        a list of (sequence, what, baseline value, new value)
+    """
+    regressions = []
+    for name, base in sorted(baseline['sequences'].items()):
+        if not name in results['sequences']:
+            continue
+        new = results['sequences'][name]
+        if new['fps'] < base['fps'] * (1 - threshold):
+            regressions.append((name, 'fps', base['fps'], new['fps']))
+        for stage, b in sorted(base['stages'].items()):
+            n = new['stages'].get(stage)
+            if n is None or max(b['p50'], n['p50']) < min_stage_ms:
+                continue
+            if n['p50'] > b['p50'] * (1 + threshold):
+                regressions.append((name, stage + ' p50 ms',
+                                    b['p50'], n['p50']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--frames', type=int, default=90,
+                        help='frames per sequence')
+    parser.add_argument('--sets', nargs='*', default=[],
+                        help='recorded datasets to replay as well')
+    parser.add_argument('--no-synthetic', action='store_true',
+                        help="don't replay the synthetic scenes")
+    parser.add_argument('--decimate', type=int, default=1,
+                        help='find the lattice on images shrunk by this '
+                        'factor (see main.decimate)')
+    parser.add_argument('--target-latency', type=float,
+                        help='reconstruct only keyframes, keeping to this '
+                        'many ms a frame on average (see keyframes.Scheduler)')
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help='skip frames whose depth is the same as the '
+                        "last one's (see keyframes.ChangeDetector)")
+    parser.add_argument('--save', help='write the results here (json)')
+    parser.add_argument('--baseline', help='results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown (fraction) that counts as a '
+                        'regression')
+    args = parser.parse_args()
+
+    target_latency = args.target_latency
+    if not target_latency is None:
+        target_latency /= 1000.
+    results = run(args.frames, args.sets, not args.no_synthetic,
+                  args.decimate, target_latency, args.skip_unchanged)
+    report(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        print
+        if not regressions:
+            print 'No regressions against %s' % args.baseline
+        for name, what, old, new in regressions:
+            print 'REGRESSION %s %s: %.2f -> %.2f' % (name, what, old, new)
+        sys.exit(1 if regressions else 0)
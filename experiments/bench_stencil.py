@@ -0,0 +1,69 @@
+import sys
+import timeit
+import numpy as np
+
+from blockplayer import config
+from blockplayer import calibkinect
+from blockplayer import stencil
+from blockplayer import stencil_numpy
+
+
+def synthetic_scene(seed=0):
+    """A random structure on the table, seen from about 70cm away, looking
+    down at it at an angle. Returns (occ_grid, modelmat, bg)."""
+    rng = np.random.RandomState(seed)
+    occ = np.zeros((36,9,36), bool)
+    occ[12:24,:4,12:24] = rng.rand(12,4,12) > 0.5
+    occ[12:24,0,12:24] = True
+
+    a = 0.8
+    RT = np.eye(4)
+    RT[1:3,1:3] = [[np.cos(a),-np.sin(a)],
+                   [np.sin(a), np.cos(a)]]
+    RT[:3,3] = [0, -0.1, -0.7]
+    bg = dict(KK=np.linalg.inv(calibkinect.projection()),
+              Ktable=np.eye(4))
+    return occ, np.linalg.inv(RT), bg
+
+
+def compare(a, b, rect):
+    """Fraction of the pixels in rect, covered by either rendering, that have
+    the same block in both, and the largest depth difference between them
+    (mm). The gl renderer leaves everything outside rect undefined."""
+    (L,T),(R,B) = rect
+    (coordsA, depthA), (coordsB, depthB) = a, b
+    coordsA, depthA = coordsA[T:B,L:R], depthA[T:B,L:R]
+    coordsB, depthB = coordsB[T:B,L:R], depthB[T:B,L:R]
+    drawn = (depthA < 1e6) | (depthB < 1e6)
+    same = np.all(coordsA[drawn,:3] == coordsB[drawn,:3], 1)
+    both = (depthA < 1e6) & (depthB < 1e6)
+    return same.mean(), np.abs(depthA[both] - depthB[both]).max()
+
+
+def run(iters=20, rects=(((220,140),(420,340)), ((0,0),(640,480)))):
+    occ, modelmat, bg = synthetic_scene()
+    renderers = [('numpy', stencil_numpy.render_blocks)]
+    try:
+        import glxcontext
+        glxcontext.makecurrent()
+        renderers.insert(0, ('gl', stencil.render_blocks_gl))
+    except Exception as e:
+        print "Skipping the gl renderer (%s)" % e
+
+    print '%8s %12s %10s %10s %12s' % ('renderer', 'rect', 'ms',
+                                      'agree', 'max diff mm')
+    for rect in rects:
+        (L,T),(R,B) = rect
+        results = {}
+        for name, render in renderers:
+            results[name] = render(occ, modelmat, rect, bg)
+            t = timeit.timeit(lambda: render(occ, modelmat, rect, bg),
+                              number=iters)/iters
+            first = results[renderers[0][0]]
+            agree, diff = compare(results[name], first, rect)
+            print '%8s %12s %10.3f %10.4f %12.3f' % \
+                (name, '%dx%d' % (R-L,B-T), t*1000, agree, diff)
+
+
+if __name__ == '__main__':
+    run(*map(int, sys.argv[1:2]))
@@ -0,0 +1,50 @@
+"""How the tracker's frame rate scales with the size of the structure, and
+how fast synthetic frames can be made at larger resolutions.
+
+    python experiments/bench_synthetic.py [frames]
+"""
+import sys
+import time
+import numpy as np
+
+from blockplayer import synthetic
+import bench_replay
+
+
+def scene_sizes(frames=60, sizes=(10, 40, 160, 640), trajectory='wander'):
+    """Replay random structures of each size through the tracker."""
+    bg = synthetic.calibration()
+    print '%8s %8s %10s %10s  %s' % ('blocks', 'fps', 'p50 ms', 'p99 ms',
+                                     'outcomes')
+    for blocks in sizes:
+        occ = synthetic.random_structure(blocks, seed=blocks)
+        traj = getattr(synthetic, trajectory)(frames)
+        seq = [(depth, rgb) for depth, rgb, _ in
+               synthetic.generate(occ, bg, traj)]
+        r = bench_replay.replay(seq, bg, occ)
+        s = r['stages']['update_frame']
+        print '%8d %8.1f %10.2f %10.2f  %s' % \
+            (blocks, r['fps'], s['p50'], s['p99'],
+             ', '.join('%s: %d' % kv for kv in sorted(r['outcomes'].items())))
+
+
+def resolutions(frames=10, sizes=((320,240), (640,480), (1280,960)),
+                blocks=160):
+    """Time generating frames, with noise, at each resolution."""
+    occ = synthetic.random_structure(blocks)
+    print '%12s %12s' % ('size', 'ms/frame')
+    for size in sizes:
+        bg = synthetic.calibration(size=size)
+        gen = synthetic.generate(occ, bg, synthetic.turntable(frames+1))
+        next(gen)  # Making the noise bank isn't part of it
+        t0 = time.time()
+        for _ in gen:
+            pass
+        print '%12s %12.1f' % ('%dx%d' % size, (time.time()-t0)/frames*1e3)
+
+
+if __name__ == '__main__':
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    scene_sizes(frames)
+    print
+    resolutions()
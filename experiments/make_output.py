@@ -1,24 +1,37 @@
 import os
+import sys
+import re
 import shutil
 import numpy as np
 import time
 import json
+import traceback
 import glob
+import functools
+import itertools
+import multiprocessing
 import cPickle as pickle
 import glxcontext
 
 from blockplayer import dataset
 from blockplayer import grid
 from blockplayer import main
+from blockplayer import opencl
+from blockplayer import stencil
 
 
 out_path = os.path.join('data/experiments','output')
 
 
-# Create an offscreen opengl context
-glxcontext.makecurrent()
-from OpenGL.GL import glGetString, GL_VERSION
-print("GL Version String: ", glGetString(GL_VERSION))
+def setup_context():
+    # Create an offscreen opengl context. Each worker process needs its own,
+    # so this happens after the pool has forked rather than at import. The
+    # software renderer (BLOCKPLAYER_RENDERER=numpy) doesn't need one.
+    if stencil.renderer == 'numpy':
+        return
+    glxcontext.makecurrent()
+    from OpenGL.GL import glGetString, GL_VERSION
+    print("GL Version String: ", glGetString(GL_VERSION))
 
 
 def once():
@@ -27,8 +40,87 @@ def once():
     main.update_frame(depth, rgb)
 
 
-def run_grid():
-    datasets = glob.glob('data/sets/study_*')
+def run_one(pathname, verbose=False):
+    """Process one dataset into out_path/<name>/output.pkl,
+    final_output.txt and timings.json. A fresh Tracker is used for each
+    run, so the result doesn't depend on which worker ran it or what it ran
+    before. A run that fails doesn't stop the others; its error is returned
+    instead.
+    Returns:
+        dict(name, frames, time) for progress reporting, and error if the
+        run failed
+    """
+    name = os.path.split(pathname)[1]
+    try:
+        return _run_one(pathname, name, verbose)
+    except Exception as e:
+        traceback.print_exc()
+        return dict(name=name, frames=0, time=0,
+                    error='%s: %s' % (type(e).__name__, e))
+
+
+def _run_one(pathname, name, verbose):
+    dataset.load_dataset(pathname)
+
+    d = dict(name=name)
+    folder = os.path.join(out_path, name)
+    os.mkdir(folder)
+
+    # The opencl buffers are only allocated once per process
+    t = main.Tracker(buffers=opencl.default_buffers())
+    t.initialize()
+
+    number = int(re.match('.*_z(\d)m_.*', name).groups()[0])
+    with open('data/experiments/gt/gt%d.txt' % number) as f:
+        GT = grid.gt2grid(f.read())
+    t.grid.initialize_with_groundtruth(GT)
+
+    total = 0
+    output = []
+    try:
+        while 1:
+            try:
+                dataset.advance()
+            except (IOError, ValueError):
+                break
+            if verbose and dataset.frame_num % 30 == 0:
+                print name, dataset.frame_num
+            t1 = time.time()
+            t.update_frame(dataset.depth, dataset.rgb)
+            t2 = time.time()
+            total += t2-t1
+
+            R_correct = None if t.R_correct is None else t.R_correct.copy()
+            output.append((R_correct, t.grid.dense('occ').copy()))
+    except Exception as e:
+        print name, e
+
+    d['frames'] = dataset.frame_num
+    d['time'] = total
+    d['output'] = output
+    with open(os.path.join(folder, 'output.pkl'),'w') as f:
+        pickle.dump(d, f)
+
+    with open(os.path.join(folder, 'final_output.txt'),'w') as f:
+        f.write(grid.grid2gt(t.grid.dense('occ')))
+
+    # Where the time went, stage by stage
+    t.timings.dump(os.path.join(folder, 'timings.json'))
+    if verbose:
+        print t.timings.report()
+
+    return dict(name=name, frames=d['frames'], time=total)
+
+
+def run_grid(processes=1):
+    """Process every run in data/sets/study_*. With processes > 1, the runs
+    are spread over a pool of worker processes, each with its own GL context
+    and opencl buffers. Each run writes only to its own output folder, so the
+    output is the same as running them one after another. A summary of all
+    the runs, sorted by name, is written to out_path/summary.json. Runs that
+    failed are in it with their error.
+    """
+    datasets = sorted(glob.glob('data/sets/study_*'))
     try:
         os.mkdir(out_path)
     except OSError:
@@ -36,50 +128,41 @@ def run_grid():
         print "Remove it and try again."
         return False
 
-    for name in datasets:
-        dataset.load_dataset(name)
-        name = os.path.split(name)[1]
-
-        d = dict(name=name)
-        folder = os.path.join(out_path, name)
-        os.mkdir(folder)
-
-        main.initialize()
-
-        import re
-        number = int(re.match('.*_z(\d)m_.*', name).groups()[0])
-        with open('data/experiments/gt/gt%d.txt' % number) as f:
-            GT = grid.gt2grid(f.read())
-        grid.initialize_with_groundtruth(GT)
-
-        total = 0
-        output = []
-        try:
-            while 1:
-                try:
-                    dataset.advance()
-                except (IOError, ValueError):
-                    break
-                if dataset.frame_num % 30 == 0:
-                    print name, dataset.frame_num
-                t1 = time.time()
-                once()
-                t2 = time.time()
-                total += t2-t1
-
-                output.append((main.R_correct.copy(), grid.occ.copy()))
-        except Exception as e:
-            print e
-
-        d['frames'] = dataset.frame_num
-        d['time'] = total
-        d['output'] = output
-        with open(os.path.join(folder, 'output.pkl'),'w') as f:
-            pickle.dump(d, f)
-
-        with open(os.path.join(folder, 'final_output.txt'),'w') as f:
-            f.write(grid.grid2gt(grid.occ))
+    pool = None
+    if processes == 1:
+        setup_context()
+        results = itertools.imap(functools.partial(run_one, verbose=True),
+                                 datasets)
+    else:
+        pool = multiprocessing.Pool(processes, initializer=setup_context)
+        results = pool.imap_unordered(run_one, datasets)
+
+    # Report the runs as they finish, in whatever order that is
+    summary = []
+    t0 = time.time()
+    for i, r in enumerate(results):
+        if 'error' in r:
+            print '[%d/%d] %s: failed, %s (%.0fs elapsed)' % \
+                (i+1, len(datasets), r['name'], r['error'], time.time()-t0)
+        else:
+            fps = r['frames'] / r['time'] if r['time'] else 0
+            print '[%d/%d] %s: %d frames, %.1f fps (%.0fs elapsed)' % \
+                (i+1, len(datasets), r['name'], r['frames'], fps,
+                 time.time()-t0)
+        summary.append(r)
+    if not pool is None:
+        pool.close()
+        pool.join()
+
+    summary.sort(key=lambda r: r['name'])
+    with open(os.path.join(out_path, 'summary.json'),'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
 
 
 if __name__ == "__main__":
-    run_grid()
+    if len(sys.argv) > 1:
+        processes = int(sys.argv[1])
+    else:
+        processes = multiprocessing.cpu_count()
+    run_grid(processes)
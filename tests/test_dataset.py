@@ -1,5 +1,12 @@
 import unittest
+import os
+import tempfile
+import shutil
+import gzip
+import numpy as np
+import cv
 from blockplayer import dataset
+from blockplayer import container
 
 class Test(unittest.TestCase):
     @unittest.skip
@@ -11,5 +18,96 @@ class Test(unittest.TestCase):
         dataset.load_random_dataset()
 
 
+class TestReader(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.frames = {}
+        for i in range(1, 21):
+            depth = rng.randint(0, 2000, (48,64)).astype('u2')
+            rgb = rng.randint(0, 255, (48,64,3)).astype('u1')
+            with gzip.open(dataset.depth_path(self.path, i), 'wb') as f:
+                np.save(f, depth)
+            cv.SaveImage(dataset.rgb_path(self.path, i),
+                         cv.fromarray(rgb[:,:,::-1].copy()))
+            self.frames[i] = depth, rgb
+
+    def tearDown(self):
+        dataset.close_reader()
+        dataset.close_container()
+        shutil.rmtree(self.path)
+
+    def read_all(self, prefetch, skip=1):
+        dataset.prefetch = prefetch
+        dataset.current_path = self.path
+        dataset.frame_num = 0
+        seen = []
+        while True:
+            try:
+                dataset.advance(skip)
+            except dataset.EndOfDataset:
+                break
+            depth, rgb = self.frames[dataset.frame_num]
+            self.assertTrue(np.all(dataset.depth == depth))
+            self.assertTrue(np.all(dataset.rgb == rgb))
+            seen.append(dataset.frame_num)
+        return seen
+
+    def test_prefetch(self):
+        self.assertEqual(self.read_all(0), range(1, 21))
+        self.assertEqual(self.read_all(8), range(1, 21))
+        self.assertEqual(self.read_all(8, skip=3), range(3, 21, 3))
+
+    def test_end(self):
+        self.read_all(8)
+        # Still an IOError, for the loops that catch that
+        self.assertRaises(IOError, dataset.advance)
+
+    def test_container(self):
+        for compress in (0, 6):
+            self.assertEqual(container.convert(self.path, chunk_frames=6,
+                                               compress=compress), 20)
+            dataset.current_container = container.Reader(
+                container.container_path(self.path))
+            self.assertEqual(dataset.current_container.compressed,
+                             bool(compress))
+            self.assertEqual(self.read_all(0), range(1, 21))
+            self.assertEqual(self.read_all(8, skip=3), range(3, 21, 3))
+
+            # Seeking goes straight to the frame
+            dataset.seek(14)
+            dataset.advance()
+            self.assertEqual(dataset.frame_num, 14)
+            self.assertTrue(np.all(dataset.depth == self.frames[14][0]))
+            dataset.close_reader()
+            dataset.close_container()
+
+    def test_container_failed(self):
+        # A container that wasn't finished isn't left behind
+        path = container.container_path(self.path)
+        def write():
+            with container.Writer(path, (48,64), (48,64,3)) as w:
+                w.add(1, *self.frames[1])
+                w.add(1, *self.frames[2])
+        self.assertRaises(AssertionError, write)
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+    def test_timestamps(self):
+        with open(dataset.timestamps_path(self.path), 'w') as f:
+            for i in range(1, 21):
+                f.write('%d %.6f\n' % (i, 100 + i*0.04))
+        dataset.timestamps = dataset.load_timestamps(self.path)
+        self.read_all(0, skip=19)
+        self.assertAlmostEqual(dataset.timestamp, 100.76)
+
+        # They go into the container too
+        container.convert(self.path)
+        dataset.current_container = container.Reader(
+            container.container_path(self.path))
+        self.read_all(0, skip=7)
+        self.assertAlmostEqual(dataset.timestamp, 100.56)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,107 @@
+import numpy as np
+from blockplayer import bitgrid
+from blockplayer import bricks
+from blockplayer import config
+from blockplayer import grid
+from blockplayer import hashalign
+from blockplayer import speedup_cy
+
+
+def test_bricks():
+    b = bricks.Bricks('u1', (3,))
+    bounds = ((-20,0,-20),(20,9,20))
+    a = np.zeros((40,9,40,3),'u1')
+    a[3,4,5] = (1,2,3)
+    a[30:35,0:2,30:35] = 7
+    b.write(bounds, a)
+    assert np.all(b.read(bounds) == a)
+    # Only the bricks with something in them are kept
+    assert len(b) == 2
+    # Writing part of it leaves the rest alone
+    b.write(((10,0,10),(20,9,20)), np.zeros((10,9,10,3),'u1'))
+    assert len(b) == 1
+    assert np.all(b.read(((-17,4,-15),(-16,5,-14)))[0,0,0] == (1,2,3))
+    assert b.read(((100,0,100),(104,4,104))).sum() == 0
+
+
+def test_sparse_grid():
+    GT = np.zeros([config.bounds[1][i]-config.bounds[0][i] for i in range(3)],
+                  bool)
+    GT[16:20,0:3,17:19] = True
+    dense, sparse = grid.Grid(False), grid.Grid(True)
+    for g in dense, sparse:
+        g.initialize_with_groundtruth(GT)
+        assert np.all(g.dense('occ') == GT)
+    # The window is centered, and smaller than the whole grid
+    (x0,_,z0),(x1,_,z1) = sparse.bounds
+    assert x0 == -x1 == z0 == -z1 and x1 < config.GRIDRAD
+    assert sparse.occ.sum() == GT.sum()
+
+    # A frame seeing a block off to one side is moved to the middle
+    occ = np.zeros_like(GT)
+    occ[30,0,4] = True
+    R = np.eye(4, dtype='f')
+    R_, occ_, vac_ = sparse.frame_window(R, occ, occ & False)
+    assert occ_.shape == sparse.occ.shape and occ_.sum() == 1
+    x, _, z = [int(i) for i in np.transpose(np.nonzero(occ_))[0]]
+    bx = x + sparse.bounds[0][0] - (30 + config.bounds[0][0])
+    bz = z + sparse.bounds[0][2] - (4 + config.bounds[0][2])
+    assert np.allclose(R_[[0,2],3], [bx*config.LW, bz*config.LW])
+
+
+def test_freezing():
+    GT = np.zeros([config.bounds[1][i]-config.bounds[0][i] for i in range(3)],
+                  bool)
+    GT[16:20,0:3,17:19] = True
+    g = grid.Grid(False, freeze_after=3)
+    g.initialize_with_groundtruth(GT)
+    nothing = GT & False
+    for i in range(3):
+        assert not g.frozen().any()
+        g.merge_with_previous(GT.copy(), ~GT, GT, nothing)
+    assert g.frozen().all()
+
+    # A block that's gone thaws, and the rest stay frozen
+    vac = ~GT
+    vac[16,2,17] = True
+    g.merge_with_previous(GT.copy(), vac, nothing, nothing)
+    assert not g.occ[16,2,17] and g.occ.sum() == GT.sum() - 1
+    assert np.all(g.frozen() == (g.stable == 3))
+    assert g.frozen().sum() == GT.size - 1
+    g.thaw(GT)
+    assert not np.any(g.frozen() & GT)
+
+
+def test_bitgrid():
+    np.random.seed(0)
+    grids = [np.random.rand(13,3,11) < 0.2 for _ in range(4)]
+    occA, vacA, occB, vacB = [bitgrid.pack(g) for g in grids]
+    assert np.all(occA.unpack() == grids[0])
+    for r in range(4):
+        a = hashalign.apply_correction(grids[0], 3, 0, -2, r)
+        assert np.all(occA.apply_correction(3, 0, -2, r).unpack() == a)
+    # Bigger than a 64x64 block of bits each way
+    big = np.random.rand(70,2,130) < 0.2
+    for r in range(4):
+        a = hashalign.apply_correction(big, 0, 0, 0, r)
+        assert np.all(bitgrid.pack(big).rot90(r).unpack() == a)
+    for bx, bz, term in ((0,0,10000), (2,-3,10000), (-1,4,110), (1,1,40)):
+        err = speedup_cy.grid_error(*[g.astype('u1') for g in grids] +
+                                    [bx, bz, term])
+        assert bitgrid.grid_error(occA, vacA, occB, vacB, bx, bz,
+                                  term) == err
+
+
+def test_packed():
+    GT = np.zeros([config.bounds[1][i]-config.bounds[0][i] for i in range(3)],
+                  bool)
+    GT[16:20,0:3,17:19] = True
+    g = grid.Grid(False)
+    g.initialize_with_groundtruth(GT)
+    occ, vac = g.packed()
+    assert np.all(occ.unpack() == GT) and np.all(vac.unpack() == ~GT)
+    assert g.packed()[0] is occ
+    # Merging changes the grid, so it's packed again
+    nothing = GT & False
+    g.merge_with_previous(GT.copy(), ~GT, GT, nothing)
+    assert not g.packed()[0] is occ
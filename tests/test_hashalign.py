@@ -0,0 +1,72 @@
+import numpy as np
+from blockplayer import config
+from blockplayer import hashalign
+from blockplayer import speedup_cy
+
+
+def test_alignment_errors():
+    np.random.seed(0)
+    occA, vacA, occB, vacB = [np.random.rand(7,3,7) < 0.3 for _ in range(4)]
+    errors = hashalign.alignment_errors(occA, vacA, occB, vacB)
+    assert errors.shape == (4,13,13)
+    for r in range(4):
+        oB, vB = [np.ascontiguousarray(hashalign.apply_correction(
+            g, 0, 0, 0, r), 'u1') for g in (occB, vacB)]
+        for bx, bz in ((0,0), (2,-3), (-6,6), (5,1)):
+            err = speedup_cy.grid_error(occA.astype('u1'), vacA.astype('u1'),
+                                        oB, vB, bx, bz, 100000)
+            assert errors[r,bx+6,bz+6] == err
+
+
+def test_find_best_alignment_fft():
+    A = np.zeros((12,4,12), bool)
+    A[3:7,0:2,4:6] = 1
+    A[3,2,4] = 1
+    vacA = ~A
+    # A turned a quarter turn and moved
+    B = hashalign.apply_correction(A, -1, 0, 2, 1)
+    correction, err = hashalign.find_best_alignment_fft(A, vacA, B, ~B)
+    assert np.all(hashalign.apply_correction(B, *correction) == A)
+
+
+def test_match_features():
+    np.random.seed(1)
+    A, B = [np.random.rand(10,4,10) < 0.3 for _ in range(2)]
+    featureA = speedup_cy.find_features(A.astype('u1'))
+    featureB = speedup_cy.find_features(B.astype('u1'))
+    votes = hashalign.match_features(featureA.tolist(), featureB.tolist(), 10)
+    matches = speedup_cy.match_features(featureA, featureB, 10, 1000)
+    assert len(matches) == len(votes)
+    for x, y, z, r, n in matches:
+        assert votes[(x,y,z,r)] == n
+    # The best 4 of each rotation
+    top = speedup_cy.match_features(featureA, featureB, 10, 4)
+    for r in range(4):
+        best = sorted([n for m, n in votes.items() if m[3] == r])[::-1][:4]
+        assert top[top[:,3] == r, 4].tolist() == best
+
+
+def test_snap_to_previous():
+    occ = np.zeros((8,3,8), bool)
+    occ[2:5,0:2,3:5] = 1
+    vac = ~occ
+    R = np.eye(4, dtype='f')
+    # Moved a little, less than a block, from the previous pose
+    R_aligned = R.copy()
+    R_aligned[0,3] = 0.2 * config.LW
+    R_aligned[2,3] = -1.9 * config.LW
+    occA, vacA = np.roll(occ, 2, 2), np.roll(vac, 2, 2)
+    c, occ_, vac_ = hashalign.snap_to_previous(occA, vacA, occ, vac,
+                                               R_aligned, R)
+    assert c == (0,0,2,0)
+    assert np.all(occ_ == occA)
+    # Too far from a block to tell which way to round
+    R_aligned[0,3] = 0.5 * config.LW
+    assert hashalign.snap_to_previous(occ, vac, occ, vac, R_aligned,
+                                      R) is None
+    # Close, but the voxels don't line up
+    R_aligned[0,3] = 0
+    R_aligned[2,3] = 0
+    assert hashalign.snap_to_previous(occ, vac, np.roll(occ, 1, 0),
+                                      np.roll(vac, 1, 0), R_aligned,
+                                      R) is None
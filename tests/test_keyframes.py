@@ -0,0 +1,66 @@
+import numpy as np
+from blockplayer import config
+from blockplayer import keyframes
+
+
+def test_scheduler():
+    s = keyframes.Scheduler(max_interval=5)
+    depth = np.zeros((48,64), 'u2') + 1000
+    rect = ((10,10),(50,40))
+    R = np.eye(4)
+    assert s.keyframe(depth, rect, 0, 0, R, True) == 'first'
+    s.update('first', R, depth)
+
+    # Nothing has changed
+    for i in range(4):
+        assert s.keyframe(depth, rect, 0.01, 0.05, R, True) is None
+        s.update(None)
+    assert s.keyframe(depth, rect, 0.01, 0.05, R, True) == 'interval'
+    assert s.keyframe(depth, rect, 0.5, 0, R, True) == 'lost'
+
+    s.update('interval', R, depth)
+    changed = depth.copy()
+    changed[20:30,20:30] += 50
+    assert s.keyframe(changed, rect, 0, 0, R, True) == 'changed'
+    # but not from a lattice estimate that's no good
+    assert s.keyframe(changed, rect, 0, 0, R, False) is None
+    moved = R.copy()
+    moved[0,3] += config.LW
+    assert s.keyframe(depth, rect, 0, 0, moved, False) == 'moved'
+    assert s.counts['tracked'] == 4
+
+
+def test_target_latency():
+    s = keyframes.Scheduler(target_latency=0.010, max_interval=30)
+    for i in range(20):
+        s.record(0.030, True)
+        s.record(0.005, False)
+    # (30 + 5*(n-1))/n <= 10
+    assert s.min_interval == 5
+    s.record(0.011, False)
+    s.target_latency = 0.002
+    s.record(0.005, False)
+    assert s.min_interval == 30
+
+
+def test_change_detector():
+    d = keyframes.ChangeDetector(tile=16, margin=0, max_skip=5)
+    rng = np.random.RandomState(0)
+    depth = np.zeros((48,64), 'u2') + 1000
+    rect = ((16,16),(48,32))
+    noisy = lambda: depth + rng.randint(-1, 2, depth.shape).astype('u2')
+    assert not d.unchanged(noisy(), rect)
+    for i in range(4):
+        assert d.unchanged(noisy(), rect)
+    # max_skip
+    assert not d.unchanged(noisy(), rect)
+
+    changed = depth.copy()
+    changed[16:24,20:28] = 900
+    assert not d.unchanged(changed, rect)
+    # Changes outside the rect go unnoticed
+    outside = changed.copy()
+    outside[:16] = 0
+    assert d.unchanged(outside, rect)
+    assert not d.unchanged(outside, None)
+    assert d.counts == dict(skipped=5, processed=4)
@@ -0,0 +1,74 @@
+import numpy as np
+from blockplayer import opencl_numpy
+
+
+def make_buffers(shape=(8,8)):
+    b = opencl_numpy.Buffers((np.eye(4,dtype='f'), np.eye(4,dtype='f')))
+    b.set_rect(((10,20),(10+shape[1],20+shape[0])))
+    return b
+
+
+def test_normals_flat():
+    b = make_buffers()
+    depth = np.ones((8,8),'f')
+    b.load_filt(depth)
+    b.load_raw(depth)
+    b.load_mask(np.ones((8,8),'u1'))
+    b.compute_normals().wait()
+    n = b.get_normals()
+    # The border is left empty, like the kernel
+    assert np.all(n[0,:,:] == 0) and np.all(n[:,-1,:] == 0)
+    assert np.allclose(n[1:-1,1:-1], [0,0,1,1])
+
+
+def test_flatrot():
+    b = make_buffers((1,3))
+    n = np.array([[0.6,0,0.8,1],
+                  [0.6,0,0.8,0],
+                  [0,1,0,1]],'f')
+    b.normals_buf[:3] = n
+    b.compute_flatrot(np.eye(4,dtype='f')[:3,:])
+    dx, dz = 0.6, 0.8
+    qx = dx**4 - 6*dx*dx*dz*dz + dz**4
+    qz = 4*dz*dx**3 - 4*dz**3*dx
+    assert np.allclose(b.get_flatrot(), [[qx,0,qz,1],[0,0,0,0],[0,0,0,0]])
+    assert np.allclose(b.reduce_flatrot(), [qx,0,qz,1])
+
+
+def test_lattice2_gridinds():
+    b = make_buffers((1,2))
+    b.normals_buf[:2] = [[1,0,0,1],[0,0,0,0]]
+    b.xyz_buf[:2] = [[0.004,0.01,0.008,1],[0,0,0,0]]
+    b.compute_lattice2(np.eye(4,dtype='f')[:3,:], 0.016)
+    cxcz, qxqz = b.reduce_lattice2()
+    assert np.allclose(cxcz, [1,0,0,0])
+    assert np.allclose(qxqz, [0,1,0,0], atol=1e-5)
+
+    gridmin = np.array([-2,0,-2,0],'f')
+    gridmax = np.array([2,2,2,0],'f')
+    b.compute_gridinds(0, 0, 0.016, 0.02, gridmin, gridmax)
+    gridinds = b.get_gridinds()
+    # A face pointing along +x gets label -1, so the voxel behind it (x=1)
+    # is occupied and the one in front of it (x=2) is vacant
+    assert gridinds[0].tolist() == [[1,0,2,-4],[2,0,2,-4]]
+    assert np.all(gridinds[1,:,3] == 0)
+
+
+def test_occvac():
+    # 40 +x faces in each of two voxels, 20 in a third
+    b = make_buffers((1,100))
+    b.normals_buf[:100] = [1,0,0,1]
+    b.xyz_buf[:100] = [0.004,0.01,0.008,1]
+    b.xyz_buf[40:80,0] += 0.016
+    b.xyz_buf[80:100,2] += 0.016
+    b.compute_lattice2(np.eye(4,dtype='f')[:3,:], 0.016)
+
+    gridmin = np.array([-2,0,-2,0],'f')
+    gridmax = np.array([2,2,2,0],'f')
+    b.compute_occvac(0, 0, 0.016, 0.02, gridmin, gridmax)
+    occ, vac = b.get_occvac()
+    assert occ.shape == vac.shape == (4,2,4)
+    # More than 30 hits are needed to count. The vacant voxel in front of the
+    # second group is off the edge of the grid
+    assert zip(*np.nonzero(occ)) == [(1,0,2),(2,0,2)]
+    assert zip(*np.nonzero(vac)) == [(2,0,2)]
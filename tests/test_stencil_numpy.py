@@ -0,0 +1,65 @@
+import numpy as np
+from blockplayer import stencil_numpy
+
+
+def scene():
+    # The camera looks down -z at the grid, whose origin is 1m away. This is
+    # calibkinect.projection()
+    KK = np.linalg.inv([[528, 0, -320, 0],
+                        [0, -528, -267, 0],
+                        [0, 0, 0, 1],
+                        [0, 0, -1, 0]])
+    bg = dict(KK=KK, Ktable=np.eye(4))
+    modelmat = np.eye(4)
+    modelmat[2,3] = 1
+    occ = np.zeros((36,9,36), bool)
+    occ[18,0,18] = True
+    return occ, modelmat, bg
+
+
+def test_front_face():
+    occ, modelmat, bg = scene()
+    coords, depthB = stencil_numpy.render_blocks(occ, modelmat, bg=bg)
+    assert coords.shape == (480,640,4) and coords.dtype == np.uint8
+    assert depthB.shape == (480,640) and depthB.dtype == np.float32
+
+    # The front face is at z=-0.984 and spans x in [0, 0.016] and y in
+    # [0, 0.0192]. It covers the pixels whose centers project inside it.
+    drawn = depthB < 1e6
+    ys, xs = np.nonzero(drawn)
+    assert (ys.min(), ys.max(), xs.min(), xs.max()) == (257, 266, 320, 328)
+    assert drawn.sum() == 10*9
+    assert np.allclose(depthB[drawn], 984, atol=0.1)
+    assert np.all(coords[drawn,:3] == [18,0,18])
+    assert np.all(coords[~drawn,:3] == 0)
+
+
+def test_occlusion_and_rect():
+    occ, modelmat, bg = scene()
+    occ[18,0,17] = True  # directly behind, hidden
+    occ[17,0,18] = True  # to the left
+    rect = ((300,250),(325,270))
+    coords, depthB = stencil_numpy.render_blocks(occ, modelmat, rect, bg)
+    drawn = depthB < 1e6
+    assert not np.any(drawn[:250]) and not np.any(drawn[:,325:])
+    assert np.all(coords[drawn,2] == 18)
+    assert set(coords[drawn,0]) == set([17,18])
+
+
+def test_visible_box():
+    from blockplayer import spacecarve
+    occ, modelmat, bg = scene()
+    bounds = ((-18,0,-18),(18,9,18))
+    KK = np.linalg.inv(np.dot(modelmat, bg['KK']))
+    X,Y,Z = np.mgrid[-18:18,0:9,-18:18] + 0.5
+    p = np.array([X*0.016, Y*0.0192, Z*0.016, np.ones(X.shape)])
+    x, y, _, w = np.tensordot(KK, p, 1)
+    for (L,T),(R,B) in (((0,0),(640,480)), ((300,250),(325,270))):
+        box = spacecarve.visible_box(modelmat, ((L,T),(R,B)), bounds, bg)
+        seen = (w > 0) & (x/w >= L) & (x/w <= R) & (y/w >= T) & (y/w <= B)
+        inds = np.transpose(np.nonzero(seen)) + bounds[0]
+        # Holds every voxel seen through rect, and not much else
+        assert np.all(inds.min(0) >= box[0]) and np.all(inds.max(0) < box[1])
+        assert np.all(inds.min(0) - box[0] <= 1)
+        assert np.all(box[1] - inds.max(0) <= 2)
+    assert spacecarve.visible_box(modelmat, ((0,0),(1,1)), bounds, bg) is None
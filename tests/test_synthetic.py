@@ -0,0 +1,111 @@
+import numpy as np
+from blockplayer import synthetic
+from blockplayer import preprocess
+from blockplayer import stencil_numpy
+from blockplayer import config
+
+
+def test_render():
+    bg = synthetic.calibration()
+    occ = np.zeros((36,9,36), bool)
+    occ[17:20,0:2,17:20] = True
+    (depth, rgb, _), = synthetic.generate(occ, bg, [synthetic.modelmat()],
+                                          noise=None)
+    assert depth.dtype == np.uint16 and rgb.shape == (480,640,3)
+
+    # The table is seen all around, and the block stands out from it
+    table, inside = synthetic.table_depth(bg)
+    assert np.all(depth[inside] > 0) and np.all(depth[~inside] == 0)
+    fg = (depth > bg['bgLo']) & (depth < bg['bgHi'])
+    assert 1000 < fg.sum() < 10000
+    # 80cm away, and looking down at the block from 45 degrees
+    assert 700 < depth[fg].min() < depth[fg].max() < 800
+
+    mask, ((l,t),(r,b)) = preprocess.threshold_and_mask(depth, bg)
+    v,u = np.nonzero(fg)
+    assert l <= u.min() and u.max() < r and t <= v.min() and v.max() < b
+
+
+def test_kinect_noise():
+    depth = np.zeros((100,100))
+    depth[:,:50] = 800
+    depth[:,50:] = 1200
+    rng = np.random.RandomState(0)
+    noisy = synthetic.kinect_noise(depth, rng, sigma=0, dropout=0.1)
+    # Quantized to the kinect's steps, which are coarser further away
+    assert len(np.unique(noisy[noisy > 0])) == 2
+    assert abs(noisy[noisy > 0].astype('f') - depth[noisy > 0]).max() < 3
+    # Readings missing at random, and along the edge
+    assert 0.05 < (noisy == 0).mean() < 0.15
+    assert (noisy[:,49:51] == 0).mean() > 0.4
+
+
+def test_small_frames():
+    # A kinect calibration scaled down for every other pixel, against one
+    # made for 320x240 in the first place
+    bg = config.scale_bg(synthetic.calibration(), 2)
+    assert config.image_size(bg) == (320,240)
+    assert np.allclose(bg['KK'], synthetic.calibration(size=(320,240))['KK'])
+    assert config.voxel_pixels((640,480)) == 30
+    assert config.voxel_pixels((320,240)) < 10
+
+    occ = np.zeros((36,9,36), bool)
+    occ[17:20,0:2,17:20] = True
+    (depth, _, mat), = synthetic.generate(occ, bg, [synthetic.modelmat()],
+                                          noise=None)
+    assert depth.shape == (240,320)
+    mask, ((l,t),(r,b)) = preprocess.threshold_and_mask(depth, bg)
+    assert mask.shape == (240,320) and 0 <= l < r <= 320 and 0 <= t < b <= 240
+    coords, depthB = stencil_numpy.render_blocks(occ, mat, bg=bg)
+    assert depthB.shape == (240,320)
+    # The blocks are where the mask is
+    assert mask[depthB < 1e6].mean() > 0.9
+
+
+def test_decimate():
+    depth = np.zeros((480,640),'u2')
+    depth[100:200,100:200] = 1000
+    depth[100:200:2,100:200] = 1002
+    depth[120,120] = 0
+    mask = (depth > 0).astype('u1')
+    small, small_mask, ((l,t),(r,b)) = preprocess.decimate(
+        depth, mask, ((97,98),(97+64,98+32)), 2)
+    assert small.shape == small_mask.shape == (240,320)
+    # The rect lines up with the blocks, and keeps its size
+    assert ((l,t),(r,b)) == ((48,49),(80,65))
+    assert np.all(small[:t] == 0) and np.all(small_mask[:,:l] == 0)
+    # Missing readings are left out of the averages
+    assert small[60,60] == 1001 and small[60,61] == 1001
+    assert np.all(small_mask[50:65,50:80]) and not np.any(small_mask[49,:])
+
+
+def test_track_mask():
+    bg = synthetic.calibration()
+    occ = np.zeros((36,9,36), bool)
+    occ[17:20,0:2,17:20] = True
+    (depth, _, _), = synthetic.generate(occ, bg, [synthetic.modelmat()],
+                                        noise=None)
+    mask, rect = preprocess.threshold_and_mask(depth, bg)
+    (l,t),(r,b) = rect
+
+    # Near where it was, the same as searching everywhere
+    found = preprocess.track_mask(depth, bg, ((l+8,t-4),(r+8,b-4)))
+    assert found[1] == rect and np.all(found[0][t:b,l:r] == mask[t:b,l:r])
+    # Gone from the band, or running off the edge of it
+    assert preprocess.track_mask(depth, bg, ((0,0),(32,32))) is None
+    assert preprocess.track_mask(depth, bg, ((l,t),(l+16,t+16)), 8) is None
+
+
+def test_threshold_and_mask_reference():
+    bg = synthetic.calibration()
+    occ = synthetic.random_structure(40, seed=1)
+    traj = synthetic.wander(3)
+    for depth, _, _ in synthetic.generate(occ, bg, traj):
+        buf = np.empty(depth.shape, 'u1')
+        mask, rect = preprocess.threshold_and_mask(depth, bg, buf)
+        assert mask is buf
+        for inrange in (preprocess.inrange_numpy, preprocess.inrange_ctypes,
+                        preprocess.inrange_cy):
+            mask_, rect_ = preprocess.threshold_and_mask_reference(depth, bg,
+                                                                   inrange)
+            assert rect_ == rect and np.all(mask_ == mask)
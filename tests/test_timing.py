@@ -0,0 +1,36 @@
+import json
+import tempfile
+import os
+import numpy as np
+from blockplayer import timing
+
+
+def test_stages():
+    t = timing.Timings(window=4)
+    for s in [0.001, 0.002, 0.003, 0.004, 0.005, 0.006]:
+        t.add('a', s)
+    with t.stage('b'):
+        pass
+    t.outcome('ok')
+    t.outcome('ok')
+    t.outcome('no_mask')
+
+    assert t.names == ['a', 'b']
+    # The window only keeps the most recent samples, the totals keep all
+    assert np.allclose(t.samples('a'), [0.003, 0.004, 0.005, 0.006])
+    s = t.summary('a')
+    assert s['count'] == 6 and np.allclose(s['total'], 0.021)
+    assert np.allclose(s['max'], 0.006)
+    assert t.histogram('a').sum() == 4
+    assert t.outcomes == dict(ok=2, no_mask=1)
+
+    fd, name = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        t.dump(name)
+        with open(name) as f:
+            d = json.load(f)
+    finally:
+        os.remove(name)
+    assert [s['name'] for s in d['stages']] == ['a', 'b']
+    assert d['outcomes'] == dict(ok=2, no_mask=1)